@@ -0,0 +1,136 @@
+#    Copyright 2021 Abigail Schubert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Micro-benchmarks for RecipeDB, UserDB, markdown rendering and the views.
+
+    python benchmarks/bench_micro.py --size 100k [--output results.json] [--only view]
+
+Runs against a synthetic book (see datagen.py), copied so write benchmarks
+don't change the cached original. Writes JSON results to --output or stdout;
+compare two runs with compare.py.
+"""
+import argparse
+from pathlib import Path
+import random
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+# pylint:disable=wrong-import-position
+from omnom.app import create_app
+from omnom.recipe_db import RecipeDB
+from omnom.render import process_markdown, render_full, render_simple
+from omnom.user_db import UserDB
+from datagen import get_book, make_ingredients, make_instructions, make_recipe
+from harness import measure, parse_size, write_results
+
+
+def recipe_db_benchmarks(db_filename, rnd, n_recipes):
+    """ Yield (name, func, options) for RecipeDB operations """
+    rdb = RecipeDB(db_filename)
+    type_ids = list(rdb.get_all_types())
+    yield 'recipe_db.get_all_recipes', rdb.get_all_recipes, {'min_runs': 1}
+    yield 'recipe_db.get_recipe', lambda: rdb.get_recipe(rnd.randint(1, n_recipes)), {}
+    yield 'recipe_db.get_recipes_page', rdb.get_recipes_page, {}
+    yield ('recipe_db.get_recipe[x20]',
+           lambda: [rdb.get_recipe(rnd.randint(1, n_recipes)) for _ in range(20)], {})
+    yield ('recipe_db.get_recipe_fields[x20]',
+           lambda: rdb.get_recipe_fields([rnd.randint(1, n_recipes) for _ in range(20)]), {})
+    yield 'recipe_db.add_recipe', lambda: rdb.add_recipe(make_recipe(rnd, type_ids)), {}
+
+
+def user_db_benchmarks(db_filename, rnd, n_users):
+    """ Yield (name, func, options) for UserDB operations """
+    udb = UserDB(db_filename)
+    yield 'user_db.get_user', lambda: udb.get_user(rnd.randint(1, n_users)), {}
+    yield ('user_db.get_user_by_name',
+           lambda: udb.get_user_by_name('user{}'.format(rnd.randrange(n_users))), {})
+
+
+def render_benchmarks(rnd):
+    """ Yield (name, func, options) for markdown rendering: the mixed corpus
+    through process_markdown, and simple dialect text (plain lists, which
+    render_simple handles) through each renderer.
+    """
+    texts = [make_instructions(rnd) for _ in range(100)]
+    simple_texts = [make_ingredients(rnd) for _ in range(100)]
+    yield 'render.process_markdown', lambda: process_markdown(rnd.choice(texts)), {}
+    for renderer in [render_simple, render_full]:
+        yield ('render.simple_dialect[{}]'.format(renderer.__name__),
+               lambda renderer=renderer: renderer(rnd.choice(simple_texts)), {})
+
+
+def view_benchmarks(db_filename, workdir, rnd, n_recipes):
+    """ Yield (name, func, options) for views, through the flask test client,
+    with and without the page cache.
+    """
+    for page_cache in [None, 'memory']:
+        app = create_app({'DATABASE': db_filename,
+                          'ASSETS_DIR': Path(workdir, 'assets'),
+                          'TEMPLATE_CACHE_DIR': Path(workdir, 'jinja_cache'),
+                          'PAGE_CACHE': page_cache,
+                          }, instance_path=str(Path(workdir).resolve()))
+        client = app.test_client()
+
+        def get(url, client=client):
+            response = client.get(url)
+            assert response.status_code == 200, (url, response.status_code)
+            response.get_data()  # streamed responses are only generated as they're read
+
+        suffix = '' if page_cache is None else '[page_cache]'
+        yield 'view.index' + suffix, lambda get=get: get('/'), {}
+        yield ('view.full_recipe' + suffix,
+               lambda get=get: get('/recipes/{}'.format(rnd.randint(1, n_recipes))), {})
+        yield 'view.api_recipes' + suffix, lambda get=get: get('/api/recipes?limit=100'), {}
+
+
+def main():
+    """ Run the benchmarks and write results """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', default='1k', help='Recipes in book, eg 1000, 100k, 1m')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--min-time', type=float, default=1.0,
+                        help='Minimum seconds spent on each benchmark')
+    parser.add_argument('--only', action='append',
+                        help='Only run benchmarks whose name contains this (repeatable)')
+    parser.add_argument('--output', help='Write JSON results here rather than stdout')
+    args = parser.parse_args()
+
+    n_recipes = parse_size(args.size)
+    book = get_book(n_recipes, n_users=args.users, seed=args.seed,
+                    progress=lambda done: print('generating: {}/{}'.format(done, n_recipes),
+                                                file=sys.stderr))
+    rnd = random.Random(args.seed)
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        db_filename = str(Path(workdir, 'book.sqlite'))
+        shutil.copy(book, db_filename)
+        benchmarks = [recipe_db_benchmarks(db_filename, rnd, n_recipes),
+                      user_db_benchmarks(db_filename, rnd, args.users),
+                      render_benchmarks(rnd),
+                      view_benchmarks(db_filename, workdir, rnd, n_recipes)]
+        for group in benchmarks:
+            for name, func, options in group:
+                if args.only and not any(only in name for only in args.only):
+                    continue
+                print('running {}'.format(name), file=sys.stderr)
+                results.append(measure(name, func, min_time=args.min_time, **options))
+    write_results(results, args.output, benchmark='micro', size=n_recipes, users=args.users,
+                  seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
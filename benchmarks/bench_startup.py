@@ -0,0 +1,86 @@
+#    Copyright 2021 Abigail Schubert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Benchmark worker cold start: importing omnom, creating the app and serving
+the first request, each in a fresh interpreter.
+
+    python benchmarks/bench_startup.py --runs 10 [--warmup]
+
+Writes JSON results (seconds) to --output or stdout.
+"""
+import argparse
+import json
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+# pylint:disable=wrong-import-position
+from omnom.db import OmnomDB
+from harness import summarize, write_results
+
+CHILD = '''
+import json, sys, time
+start = time.perf_counter()
+from omnom.app import create_app
+imported = time.perf_counter()
+app = create_app({{'DATABASE': {db!r}, 'ASSETS_DIR': {assets!r},
+                   'TEMPLATE_CACHE_DIR': {cache!r}, 'WARMUP': {warmup!r}}},
+                 instance_path={workdir!r})
+created = time.perf_counter()
+response = app.test_client().get('/')
+assert response.status_code == 200, response.status_code
+served = time.perf_counter()
+json.dump({{'import': imported - start, 'create_app': created - imported,
+            'first_request': served - created, 'total': served - start}}, sys.stdout)
+'''
+
+
+def run_once(workdir, warmup, use_cache):
+    """ Time one cold start in a new interpreter. Returns dict of timings """
+    code = CHILD.format(db=str(Path(workdir, 'omnom.sqlite')),
+                        assets=str(Path(workdir, 'assets')),
+                        cache=str(Path(workdir, 'jinja_cache')) if use_cache else None,
+                        warmup=warmup, workdir=str(Path(workdir).resolve()))
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                            check=True, cwd=REPO_DIR)
+    return json.loads(result.stdout)
+
+
+def main():
+    """ Run the benchmark and print summary """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--warmup', action='store_true', help='Start with WARMUP=True')
+    parser.add_argument('--no-template-cache', action='store_true',
+                        help='Disable the jinja bytecode cache')
+    parser.add_argument('--output', help='Write JSON results here rather than stdout')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        OmnomDB(str(Path(workdir, 'omnom.sqlite')), init_db=True).close()
+        # first run fills the bytecode cache, as a deploy-time `flask warmup` would
+        run_once(workdir, args.warmup, not args.no_template_cache)
+        runs = [run_once(workdir, args.warmup, not args.no_template_cache)
+                for _ in range(args.runs)]
+
+    results = [summarize('startup.' + phase, [run[phase] for run in runs]) for phase in runs[0]]
+    write_results(results, args.output, benchmark='startup', warmup=args.warmup,
+                  template_cache=not args.no_template_cache)
+
+
+if __name__ == '__main__':
+    main()
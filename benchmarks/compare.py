@@ -0,0 +1,51 @@
+#    Copyright 2021 Abigail Schubert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Compare two benchmark result files.
+
+    python benchmarks/compare.py before.json after.json
+
+Prints median time per benchmark and the change, slowest regressions first.
+"""
+import argparse
+import json
+
+
+def main():
+    """ Print comparison table """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('before')
+    parser.add_argument('after')
+    args = parser.parse_args()
+
+    with open(args.before) as fptr:
+        before = {result['name']: result for result in json.load(fptr)['results']}
+    with open(args.after) as fptr:
+        after = {result['name']: result for result in json.load(fptr)['results']}
+
+    rows = []
+    for name in before.keys() & after.keys():
+        old, new = before[name]['median'], after[name]['median']
+        rows.append((new / old if old else float('inf'), name, old, new))
+    rows.sort(reverse=True)
+    print('{:40} {:>12} {:>12} {:>8}'.format('benchmark', 'before (ms)', 'after (ms)', 'change'))
+    for ratio, name, old, new in rows:
+        print('{:40} {:12.3f} {:12.3f} {:+7.1f}%'.format(name, old * 1000, new * 1000,
+                                                         (ratio - 1) * 100))
+    for name in sorted(before.keys() ^ after.keys()):
+        print('{:40} only in {}'.format(name, 'before' if name in before else 'after'))
+
+
+if __name__ == '__main__':
+    main()
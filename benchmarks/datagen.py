@@ -0,0 +1,165 @@
+#    Copyright 2021 Abigail Schubert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Generate synthetic recipe books for benchmarking.
+
+    python benchmarks/datagen.py 100k [--output book.sqlite] [--seed 1]
+
+Recipes have realistic markdown ingredient lists and instructions. Books are
+written through RecipeDB, so stored html is rendered as the app would.
+Generated books are cached under benchmarks/.data by size and seed.
+"""
+import argparse
+import itertools
+from pathlib import Path
+import random
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+# pylint:disable=wrong-import-position
+from werkzeug.security import generate_password_hash
+from omnom.recipe_db import RecipeDB, RecipeEntry
+from omnom.user_db import UserDB
+from harness import parse_size
+
+DATA_DIR = Path(__file__).resolve().parent / '.data'
+BATCH_SIZE = 1000
+USER_PASSWORD = 'bench'
+
+FOOD_TYPES = ['Pasta', 'Grains', 'Salads', 'Baked Goods', 'Soups', 'Breakfast', 'Desserts',
+              'Drinks', 'Sauces', 'Snacks', 'Seafood', 'Vegetables']
+ADJECTIVES = ['Creamy', 'Spicy', 'Smoky', 'Quick', 'Lemony', 'Rustic', 'Crispy', 'Hearty',
+              'Garlicky', 'Sticky', 'Roasted', 'Grandma\'s', 'Weeknight', 'Herbed']
+INGREDIENTS = ['flour', 'sugar', 'butter', 'eggs', 'milk', 'garlic', 'onion', 'olive oil',
+               'salt', 'black pepper', 'rice', 'tomatoes', 'basil', 'parmesan', 'lemon juice',
+               'chicken stock', 'carrots', 'celery', 'cumin', 'paprika', 'honey', 'soy sauce',
+               'ginger', 'spinach', 'mushrooms', 'cream', 'oats', 'blueberries', 'yogurt']
+DISHES = ['pasta', 'risotto', 'salad', 'muffins', 'soup', 'stew', 'pancakes', 'curry',
+          'flatbread', 'stir fry', 'cake', 'smoothie', 'granola', 'tart', 'noodles']
+UNITS = ['cup', 'cups', 'tbsp', 'tsp', 'g', 'ml', 'pinch of', 'cloves of', 'handful of']
+VERBS = ['Whisk', 'Stir', 'Fold', 'Simmer', 'Bake', 'Chop', 'Saute', 'Season', 'Toss',
+         'Roast', 'Blend', 'Knead', 'Rest', 'Serve']
+PHRASES = ['until golden', 'for 10 minutes', 'over medium heat', 'until just combined',
+           'with a wooden spoon', 'until fragrant', 'at 180C', 'and set aside',
+           'until the sauce thickens', 'to taste']
+
+
+def make_ingredients(rnd):
+    """ Markdown bullet list of ingredients """
+    lines = []
+    for ingredient in rnd.sample(INGREDIENTS, rnd.randint(4, 14)):
+        amount = rnd.choice(['1', '2', '3', '1/2', '1 1/2', '200', '250'])
+        lines.append('* {} {} {}'.format(amount, rnd.choice(UNITS), ingredient))
+    return '\n'.join(lines)
+
+
+def make_instructions(rnd):
+    """ Markdown numbered steps, with the odd note or emphasis mixed in """
+    lines = []
+    for step in range(1, rnd.randint(3, 12) + 1):
+        words = [rnd.choice(VERBS), 'the', rnd.choice(INGREDIENTS)]
+        if rnd.random() < 0.5:
+            words += ['and', rnd.choice(INGREDIENTS)]
+        words.append(rnd.choice(PHRASES))
+        line = '{}. {}.'.format(step, ' '.join(words))
+        if rnd.random() < 0.2:
+            line += ' **Don\'t skip this.**'
+        lines.append(line)
+        if rnd.random() < 0.1:
+            lines.append('Tip: _{} works here too._'.format(rnd.choice(INGREDIENTS).capitalize()))
+    return '\n'.join(lines)
+
+
+def make_recipe(rnd, type_ids):
+    """ Return a random RecipeEntry """
+    dish = rnd.choice(DISHES)
+    return RecipeEntry(name='{} {} {}'.format(rnd.choice(ADJECTIVES), rnd.choice(INGREDIENTS),
+                                              dish).capitalize(),
+                       description='A {} {} for {} people'.format(
+                           rnd.choice(ADJECTIVES).lower(), dish, rnd.randint(1, 8)),
+                       type_id=rnd.choice(type_ids),
+                       ingredients=make_ingredients(rnd),
+                       instructions=make_instructions(rnd))
+
+
+def generate_book(db_filename, n_recipes, n_users=100, seed=1, progress=None):
+    """ Create a new book at db_filename with n_recipes random recipes and
+    n_users users named user0.. (all with password USER_PASSWORD).
+    """
+    rnd = random.Random(seed)
+    rdb = RecipeDB(db_filename, init_db=True)
+    type_ids = rdb.add_types(FOOD_TYPES)
+    recipes = (make_recipe(rnd, type_ids) for _ in range(n_recipes))
+    done = 0
+    while True:
+        batch = list(itertools.islice(recipes, BATCH_SIZE))
+        if not batch:
+            break
+        rdb.add_recipes(batch)
+        done += len(batch)
+        if progress:
+            progress(done)
+    rdb.close()
+
+    udb = UserDB(db_filename)
+    # hashing is deliberately slow, so every user shares one hash
+    password = generate_password_hash(USER_PASSWORD)
+    with udb.transaction():
+        for number in range(n_users):
+            udb.add_user('user{}'.format(number), password)
+    udb.close()
+
+
+def get_book(n_recipes, n_users=100, seed=1, progress=None):
+    """ Return path of a generated book of n_recipes, generating it if not cached """
+    path = DATA_DIR / 'book-{}-{}-{}.sqlite'.format(n_recipes, n_users, seed)
+    if not path.exists():
+        DATA_DIR.mkdir(exist_ok=True)
+        tmp_path = path.with_suffix('.tmp')
+        tmp_path.unlink(missing_ok=True)
+        generate_book(str(tmp_path), n_recipes, n_users=n_users, seed=seed, progress=progress)
+        tmp_path.replace(path)
+    return path
+
+
+def main():
+    """ Generate a book from the command line """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('size', help='Number of recipes, eg 1000, 100k, 1m')
+    parser.add_argument('--output', help='Book to write (default: cached under {})'.format(
+        DATA_DIR))
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--users', type=int, default=100)
+    args = parser.parse_args()
+
+    n_recipes = parse_size(args.size)
+    start = time.perf_counter()
+
+    def progress(done):
+        if done % (BATCH_SIZE * 10) == 0 or done == n_recipes:
+            print('{}/{} recipes ({:.0f}s)'.format(done, n_recipes, time.perf_counter() - start),
+                  file=sys.stderr)
+
+    if args.output:
+        generate_book(args.output, n_recipes, n_users=args.users, seed=args.seed,
+                      progress=progress)
+        path = args.output
+    else:
+        path = get_book(n_recipes, n_users=args.users, seed=args.seed, progress=progress)
+    print(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#    Copyright 2021 Abigail Schubert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Shared helpers for the benchmarks: timing loops and JSON result output """
+import json
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+
+def parse_size(size):
+    """ Parse a book size like 1000, 100k or 1m into a number of recipes """
+    size = str(size).strip().lower()
+    multiplier = {'k': 1000, 'm': 1000 * 1000}.get(size[-1:], 1)
+    if multiplier != 1:
+        size = size[:-1]
+    return int(float(size) * multiplier)
+
+
+def measure(name, func, min_time=1.0, min_runs=5, max_runs=100000, **extra):
+    """ Call func repeatedly, at least min_runs times and for at least
+    min_time seconds (but no more than max_runs times).
+    Returns dict of timing stats in seconds per call, plus any extra fields.
+    """
+    times = []
+    deadline = time.perf_counter() + min_time
+    while len(times) < max_runs and (len(times) < min_runs or time.perf_counter() < deadline):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return summarize(name, times, **extra)
+
+
+def summarize(name, times, **extra):
+    """ Return dict of stats for list of per-call times, plus any extra fields """
+    times = sorted(times)
+    result = {
+        'name': name,
+        'runs': len(times),
+        'min': times[0],
+        'median': statistics.median(times),
+        'mean': statistics.fmean(times),
+        'p95': times[min(len(times) - 1, int(len(times) * 0.95))],
+        'max': times[-1],
+        'ops_per_sec': len(times) / sum(times) if sum(times) else None,
+    }
+    result.update(extra)
+    return result
+
+
+def environment():
+    """ Describe where the benchmark ran, so results can be compared fairly """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+
+def write_results(results, output=None, **meta):
+    """ Write benchmark results and environment as JSON to output path, or stdout """
+    document = {'environment': environment()}
+    document.update(meta)
+    document['results'] = results
+    if output is None:
+        json.dump(document, sys.stdout, indent=2)
+        print()
+    else:
+        with open(output, 'w') as fptr:
+            json.dump(document, fptr, indent=2)
+            fptr.write('\n')
@@ -0,0 +1,136 @@
+#    Copyright 2021 Abigail Schubert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" JSON API for recipes, for clients other than browsers.
+
+Every endpoint takes a fields query arg, a comma separated list of the
+RecipeDB.FIELD_COLUMNS to return (RecipeDB.DEFAULT_FIELDS if not given), so
+listings never read ingredients or instructions unless asked to. The id field
+is always returned.
+"""
+import json
+from flask import Blueprint, abort, current_app, jsonify, request, stream_with_context
+from werkzeug.exceptions import BadRequest, HTTPException
+from omnom.common import get_recipe_db
+from omnom.recipe_view import validated_response
+from omnom.render import render_version
+
+bp = Blueprint('api', __name__, url_prefix='/api')  # pylint:disable=invalid-name
+
+# Most recipes fetched by one ids= request, and listed by one page
+MAX_IDS = 100
+MAX_LIMIT = 1000
+
+
+@bp.errorhandler(HTTPException)
+def json_error(error):
+    """ Errors as JSON, not html pages """
+    return jsonify(error=error.description), error.code
+
+
+def _int_list(arg):
+    """ Parse comma separated integers from query arg, or abort 400 """
+    try:
+        return [int(value) for value in request.args[arg].split(',') if value.strip()]
+    except ValueError as error:
+        raise BadRequest('{} must be a comma separated list of integers'.format(arg)) from error
+
+
+def _requested_fields():
+    """ Fields requested by the fields query arg (or the defaults), id first """
+    fields = request.args.get('fields')
+    if fields is None:
+        return get_recipe_db().DEFAULT_FIELDS
+    fields = [field.strip() for field in fields.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in get_recipe_db().FIELD_COLUMNS]
+    if not fields or unknown:
+        abort(400, 'fields must be a comma separated list of: {}'.format(
+            ', '.join(get_recipe_db().FIELD_COLUMNS)))
+    return list(dict.fromkeys(['id'] + fields))
+
+
+def _json_response(response, body):
+    """ Fill in response (from validated_response) with JSON body, which may
+    be an iterable of str chunks to stream
+    """
+    response.mimetype = 'application/json'
+    if isinstance(body, str):
+        response.set_data(body)
+    else:
+        response.response = stream_with_context(chunk.encode('utf-8') for chunk in body)
+        response.headers.pop('Content-Length', None)
+    return response
+
+
+@bp.route('/recipes')
+def recipes():
+    """ List recipes. With ids (comma separated recipe ids), returns those
+    recipes that exist, in that order. Otherwise returns a page of recipes in
+    id order: limit of them (default RECIPES_PER_PAGE), of food type type if
+    given, starting after recipe id after. The page is streamed, and ends with
+    the cursor for the next page (null on the last page).
+    """
+    db = get_recipe_db()
+    fields = _requested_fields()
+    recipe_ids = _int_list('ids') if 'ids' in request.args else None
+    if recipe_ids is not None and len(recipe_ids) > MAX_IDS:
+        abort(400, 'at most {} ids may be fetched at once'.format(MAX_IDS))
+    limit = request.args.get('limit', current_app.config['RECIPES_PER_PAGE'], type=int)
+    if not 0 < limit <= MAX_LIMIT:
+        abort(400, 'limit must be from 1 to {}'.format(MAX_LIMIT))
+    after_id = request.args.get('after', type=int)
+    type_id = request.args.get('type', type=int)
+
+    # ETags only: html fields change with render_version() without the
+    # updated_at timestamps changing, so If-Modified-Since can't be trusted
+    book_version, _ = db.get_book_version()
+    response = validated_response('api-book{}-{}'.format(book_version, render_version()))
+    if response.status_code == 304:
+        return response
+    if recipe_ids is not None:
+        found = db.get_recipe_fields(recipe_ids, fields)
+        return _json_response(response, json.dumps({'recipes': found}))
+    # one more than asked for, to find out if there's a next page
+    rows = db.iter_recipe_fields(fields, after_id=after_id, limit=limit + 1, type_id=type_id)
+
+    def stream():
+        yield '{"recipes": ['
+        last_id = None
+        for count, recipe in enumerate(rows):
+            if count == limit:
+                yield '], "next": {}}}'.format(json.dumps(last_id))
+                return
+            yield (', ' if count else '') + json.dumps(recipe)
+            last_id = recipe['id']
+        yield '], "next": null}'
+    return _json_response(response, stream())
+
+
+@bp.route('/recipes/<int:recipe_id>')
+def recipe(recipe_id):
+    """ One recipe """
+    db = get_recipe_db()
+    fields = _requested_fields()
+    recipe_version = db.get_recipe_version(recipe_id)
+    if recipe_version is None:
+        abort(404, 'no such recipe')
+    version, _ = recipe_version
+    response = validated_response('api-recipe{}-v{}-{}'.format(recipe_id, version,
+                                                               render_version()))
+    if response.status_code == 304:
+        return response
+    found = db.get_recipe_fields([recipe_id], fields)
+    if not found:
+        abort(404, 'no such recipe')
+    return _json_response(response, json.dumps(found[0]))
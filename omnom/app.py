@@ -17,26 +17,88 @@ import logging
 import os
 import pathlib
 import click
-from flask import Flask, current_app, g
+from flask import Flask, current_app
+from jinja2 import FileSystemBytecodeCache
 from flask.cli import with_appcontext
-from werkzeug.security import generate_password_hash
+from omnom.common import (get_recipe_db, get_slow_query_log, get_user_db,
+                          release_db_connection)
+from omnom import migrate
+from omnom.db import ConnectionPool, connect
+from omnom.page_cache import make_page_cache
+from omnom.passwords import make_hash
+from omnom.render import render_version
+from omnom.slow_query_log import make_slow_query_log
+from omnom.static_site import build_static
 from omnom.recipe_db import RecipeDB, RecipeEntry
+from omnom.recipe_io import Progress, RecipeImportError, export_recipes, import_recipes
 from omnom.recipe_view import bp as recipe_bp
-from omnom.user_db import UserDB
-from omnom.auth_view import bp as auth_bp
-from omnom.images import bp as images_bp
+from omnom.auth_view import AppGlobals, bp as auth_bp
+from omnom.images import UploadRequest, bp as images_bp, collect_garbage, migrate_assets
+from omnom.metrics import TimedEnvironment, bp as metrics_bp
+from omnom.api import bp as api_bp
 
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 
-def create_app(test_config=None):
-    """ Return new flask app """
-    app = Flask(__name__, instance_relative_config=True)
+def create_app(test_config=None, instance_path=None):
+    """ Return new flask app, keeping its files under instance_path (an
+    absolute path, by default the instance folder next to the package)
+    """
+    app = Flask(__name__, instance_path=instance_path, instance_relative_config=True)
+    app.app_ctx_globals_class = AppGlobals
+    app.request_class = UploadRequest
+    app.jinja_environment = TimedEnvironment
     app.config.from_mapping(
             SECRET_KEY='dev',
             DATABASE=pathlib.Path(app.instance_path, 'omnom.sqlite'),
             ASSETS_DIR=pathlib.Path(app.instance_path, 'assets'),
+            RECIPES_PER_PAGE=RecipeDB.PAGE_SIZE,
+            DATABASE_POOL_SIZE=8,
+            DATABASE_POOL_TIMEOUT=5.0,
+            PHOTO_WORKERS=2,
+            # Requests with larger bodies are refused outright (413), and uploaded
+            # photos larger than MAX_PHOTO_SIZE are rejected as they're read
+            MAX_CONTENT_LENGTH=16 * 1024 * 1024,
+            MAX_PHOTO_SIZE=10 * 1024 * 1024,
+            # Assets no recipe has used for ASSET_GC_GRACE_PERIOD seconds are deleted by
+            # `flask gc-assets`, and in the background every ASSET_GC_INTERVAL seconds
+            # (None disables), at most ASSET_GC_MAX_BATCHES batches of ASSET_GC_BATCH_SIZE
+            ASSET_GC_GRACE_PERIOD=24 * 60 * 60,
+            ASSET_GC_INTERVAL=60 * 60,
+            ASSET_GC_BATCH_SIZE=100,
+            ASSET_GC_MAX_BATCHES=10,
+            PAGE_CACHE='memory',
+            PAGE_CACHE_MAX_BYTES=32 * 1024 * 1024,
+            PAGE_CACHE_FILE=pathlib.Path(app.instance_path, 'page_cache.sqlite'),
+            # Compiled templates are kept here so new workers don't recompile them.
+            # None disables the cache.
+            TEMPLATE_CACHE_DIR=pathlib.Path(app.instance_path, 'jinja_cache'),
+            # Prime templates, renderer and database before serving the first request
+            WARMUP=False,
+            # Set when running several worker processes, so /metrics covers them all
+            METRICS_DIR=None,
+            METRICS_FLUSH_INTERVAL=1.0,
+            # Statements taking at least this many seconds are logged, with their
+            # query plan, to SLOW_QUERY_LOG. None disables the log.
+            SLOW_QUERY_THRESHOLD=0.1,
+            SLOW_QUERY_LOG=pathlib.Path(app.instance_path, 'slow_queries.sqlite'),
+            # Set while exporting a static site: photos are linked by the path of
+            # their variant files rather than by ?size= query args
+            STATIC_EXPORT=False,
+            # Apply pending schema migrations when the app starts. Otherwise they're
+            # applied by `flask db-upgrade`, and the app warns of any pending.
+            AUTO_MIGRATE=False,
+            # Passwords are hashed with this werkzeug method. Changing it rehashes
+            # each user's password on their next login.
+            PASSWORD_HASH_METHOD='pbkdf2:sha256:260000',
+            # Threads hashing passwords, and how many more hashes may wait for them
+            HASH_WORKERS=2,
+            HASH_QUEUE_DEPTH=8,
+            HASH_TIMEOUT=10.0,
+            # Failed logins allowed per user name and per client address in the window
+            LOGIN_MAX_ATTEMPTS=10,
+            LOGIN_ATTEMPT_WINDOW=300,
             )
 
     if test_config is None:
@@ -48,49 +110,268 @@ def create_app(test_config=None):
 
     logger.info('Loaded app config: %s', app.config)
 
-    for new_dir in [app.instance_path, app.config['ASSETS_DIR']]:
+    new_dirs = [app.instance_path, app.config['ASSETS_DIR']]
+    if app.config['TEMPLATE_CACHE_DIR'] is not None:
+        new_dirs.append(app.config['TEMPLATE_CACHE_DIR'])
+    for new_dir in new_dirs:
         new_dir = pathlib.Path(new_dir)
         new_dir.mkdir(parents=True, exist_ok=True)
 
+    if app.config['TEMPLATE_CACHE_DIR'] is not None:
+        bytecode_cache = FileSystemBytecodeCache(str(app.config['TEMPLATE_CACHE_DIR']))
+        app.jinja_options = dict(app.jinja_options, bytecode_cache=bytecode_cache)
+
+    app.extensions['omnom_page_cache'] = make_page_cache(app.config)
+    if app.config['AUTO_MIGRATE']:
+        upgrade_db(app.config['DATABASE'])
+    elif pathlib.Path(app.config['DATABASE']).exists():
+        warn_pending_migrations(app.config['DATABASE'])
+    app.extensions['omnom_slow_query_log'] = make_slow_query_log(app.config)
+    app.extensions['omnom_pool'] = ConnectionPool(app.config['DATABASE'],
+                                                  max_size=app.config['DATABASE_POOL_SIZE'],
+                                                  timeout=app.config['DATABASE_POOL_TIMEOUT'])
+
     @app.teardown_appcontext
     def close_db(exception):
-        db = getattr(g, '_database', None)
-        if db:
-            db.close()
+        release_db_connection()
 
     app.register_blueprint(recipe_bp)
     app.register_blueprint(auth_bp)
     app.register_blueprint(images_bp)
+    app.register_blueprint(metrics_bp)
+    app.register_blueprint(api_bp)
     app.add_url_rule('/', endpoint='index')
     app.cli.add_command(init_db_command)
+    app.cli.add_command(upgrade_db_command)
+    app.cli.add_command(render_recipes_command)
+    app.cli.add_command(rebuild_search_index_command)
+    app.cli.add_command(export_recipes_command)
+    app.cli.add_command(import_recipes_command)
+    app.cli.add_command(build_static_command)
+    app.cli.add_command(warmup_command)
+    app.cli.add_command(slowlog_command)
+    app.cli.add_command(gc_assets_command)
+    app.cli.add_command(migrate_assets_command)
+    if app.config['WARMUP']:
+        warmup(app)
     logger.info('Created app')
 
     return app
 
 
+def warn_pending_migrations(db_filename):
+    """ Log a warning if db at db_filename has migrations pending """
+    conn = connect(db_filename)
+    try:
+        pending = migrate.pending_migrations(conn)
+    finally:
+        conn.close()
+    if pending:
+        logger.warning('%d schema migrations pending for %s, run `flask db-upgrade`',
+                       len(pending), db_filename)
+
+
+def upgrade_db(db_filename):
+    """ Apply pending migrations to db at db_filename. Returns list of them. """
+    conn = connect(db_filename)
+    try:
+        return migrate.upgrade(conn)
+    finally:
+        conn.close()
+
+
+def warmup(app):
+    """ Do the work a worker would otherwise do on its first requests: compile
+    every template (filling the bytecode cache), load the markdown renderer and
+    open a database connection.
+    Returns number of templates compiled.
+    """
+    templates = app.jinja_env.list_templates()
+    for name in templates:
+        app.jinja_env.get_template(name)
+    render_version()
+    pool = app.extensions['omnom_pool']
+    pool.release(pool.acquire())
+    logger.info('Warmed up %d templates', len(templates))
+    return len(templates)
+
+
 @click.command('init-db')
 @with_appcontext
 def init_db_command():
     """ Clear the existing data and create new tables."""
-    rdb = RecipeDB(current_app.config['DATABASE'])
+    rdb = get_recipe_db()
     rdb.init_db()
     if True:
         # FIXME: this preloads some recipes into the db - should remove at later stage of dev
-        rdb.add_type('Pasta')
-        rdb.add_type('Grains')
-        rdb.add_type('Salads')
-        rdb.add_type('Baked Goods')
-        rdb.add_recipe(RecipeEntry(name='Mac Cheese', description='A tasty dish', type_id=1))
-        rdb.add_recipe(RecipeEntry(name='Blueberry Muffins', description='A breakfast food',
-                                   type_id=4, ingredients='* Blueberries\n* Muffins',
-                                   instructions='1. Mix blueberries and muffins\n1. Serve hot'))
-        rdb.add_recipe(RecipeEntry(name='Caesar Salad', description='Eat all kings', type_id=3))
-        rdb.add_recipe(RecipeEntry(name='Fried Rice', description='A great way to use up leftovers', type_id=2))
-    udb = UserDB(current_app.config['DATABASE'])
-    udb.add_user('admin', generate_password_hash('admin'))
+        with rdb.transaction():
+            rdb.add_types(['Pasta', 'Grains', 'Salads', 'Baked Goods'])
+            rdb.add_recipes([
+                RecipeEntry(name='Mac Cheese', description='A tasty dish', type_id=1),
+                RecipeEntry(name='Blueberry Muffins', description='A breakfast food',
+                            type_id=4, ingredients='* Blueberries\n* Muffins',
+                            instructions='1. Mix blueberries and muffins\n1. Serve hot'),
+                RecipeEntry(name='Caesar Salad', description='Eat all kings', type_id=3),
+                RecipeEntry(name='Fried Rice', description='A great way to use up leftovers',
+                            type_id=2),
+                ])
+    udb = get_user_db()
+    udb.add_user('admin', make_hash('admin'))
     click.echo('Initialized the database.')
 
 
+@click.command('db-upgrade')
+@with_appcontext
+def upgrade_db_command():
+    """ Apply pending schema migrations. """
+    try:
+        applied = upgrade_db(current_app.config['DATABASE'])
+    except migrate.MigrationError as error:
+        raise click.ClickException(str(error))
+    for migration in applied:
+        click.echo('Applied {:04d}_{}'.format(migration.version, migration.name))
+    conn = connect(current_app.config['DATABASE'])
+    try:
+        click.echo('Database is at version {}.'.format(migrate.schema_version(conn)))
+    finally:
+        conn.close()
+
+
+@click.command('render-recipes')
+@click.option('--batch-size', default=500, show_default=True,
+              help='Number of recipes rendered per transaction.')
+@click.option('--force', is_flag=True, help='Re-render all recipes, even up to date ones.')
+@with_appcontext
+def render_recipes_command(batch_size, force):
+    """ Backfill stored recipe html rendered by an older (or no) renderer. """
+    rdb = get_recipe_db()
+    rendered = 0
+    last_id = 0
+    while True:
+        recipe_ids = rdb.render_stale_recipes(after_id=last_id, limit=batch_size, force=force)
+        if not recipe_ids:
+            break
+        last_id = recipe_ids[-1]
+        rendered += len(recipe_ids)
+        click.echo('Rendered {} recipes (up to id {})'.format(rendered, last_id))
+    click.echo('Rendered {} recipes.'.format(rendered))
+
+
+@click.command('rebuild-search-index')
+@with_appcontext
+def rebuild_search_index_command():
+    """ Create (or recreate) the recipe search index from existing recipes. """
+    get_recipe_db().rebuild_search_index()
+    click.echo('Rebuilt the recipe search index.')
+
+
+def _echo_progress(verb):
+    """ Returns Progress reporting to stderr, e.g. 'Exported 1000 recipes (250/s)' """
+    def report(count, rate):
+        click.echo('{} {} recipes ({:.0f}/s)'.format(verb, count, rate), err=True)
+    return Progress(report)
+
+
+@click.command('export-recipes')
+@click.argument('output', type=click.File('w'), default='-')
+@click.option('--with-photos', is_flag=True, help='Embed recipe photos in the export.')
+@with_appcontext
+def export_recipes_command(output, with_photos):
+    """ Export all food types and recipes to OUTPUT (default stdout) as ndjson. """
+    assets_dir = current_app.config['ASSETS_DIR'] if with_photos else None
+    export_recipes(get_recipe_db(), output, assets_dir=assets_dir,
+                   progress=_echo_progress('Exported'))
+
+
+@click.command('import-recipes')
+@click.argument('input_file', metavar='INPUT', type=click.File('r'), default='-')
+@click.option('--batch-size', default=1000, show_default=True,
+              help='Number of recipes added per transaction.')
+@with_appcontext
+def import_recipes_command(input_file, batch_size):
+    """ Import food types and recipes from ndjson INPUT (default stdin). """
+    try:
+        import_recipes(get_recipe_db(), input_file, assets_dir=current_app.config['ASSETS_DIR'],
+                       batch_size=batch_size, progress=_echo_progress('Imported'))
+    except RecipeImportError as error:
+        raise click.ClickException(str(error)) from error
+
+
+@click.command('build-static')
+@click.argument('output_dir', metavar='OUTPUT', type=click.Path(file_okay=False))
+@click.option('--workers', type=int, help='Number of rendering processes (default: one per cpu).')
+@click.option('--full', is_flag=True, help='Re-render every page, even unchanged ones.')
+@with_appcontext
+def build_static_command(output_dir, workers, full):
+    """ Render the book as a static site into OUTPUT, updating a previous build. """
+    counts = build_static(current_app, get_recipe_db(), output_dir, workers=workers, full=full)
+    click.echo('Rendered {rendered} pages ({unchanged} unchanged, {removed} removed), '
+               'updated {assets} files.'.format(**counts))
+
+
+@click.command('warmup')
+@with_appcontext
+def warmup_command():
+    """ Precompile templates into the bytecode cache and check the database. """
+    count = warmup(current_app)
+    click.echo('Compiled {} templates.'.format(count))
+
+
+@click.command('db-slowlog')
+@click.option('--limit', default=20, show_default=True, help='Number of statements shown.')
+@click.option('--reset', is_flag=True, help='Clear the log after showing it.')
+@with_appcontext
+def slowlog_command(limit, reset):
+    """ Show the statements that most often ran over SLOW_QUERY_THRESHOLD. """
+    slow_query_log = get_slow_query_log()
+    if slow_query_log is None:
+        raise click.ClickException('The slow query log is disabled (SLOW_QUERY_THRESHOLD is None)')
+    stats = slow_query_log.stats(limit)
+    if not stats:
+        click.echo('No slow queries recorded.')
+    for stat in stats:
+        click.echo('{count:6d}x  total {total_seconds:8.3f}s  mean {mean:7.3f}s  '
+                   'max {max_seconds:7.3f}s{flag}'.format(
+                       mean=stat['total_seconds'] / stat['count'],
+                       flag='  FULL SCAN' if stat['full_scan'] else '', **stat))
+        click.echo('    ' + stat['statement'])
+        for detail in stat['plan'].splitlines():
+            click.echo('      ' + detail)
+        click.echo('    last params: ' + stat['last_params'])
+    if reset:
+        slow_query_log.reset()
+        click.echo('Cleared the slow query log.')
+
+
+@click.command('gc-assets')
+@click.option('--grace-period', type=int,
+              help='Seconds an asset must have been unused (default: ASSET_GC_GRACE_PERIOD).')
+@click.option('--batch-size', default=100, show_default=True,
+              help='Number of assets looked up per query.')
+@with_appcontext
+def gc_assets_command(grace_period, batch_size):
+    """ Delete asset files no recipe has used for the grace period. """
+    if grace_period is None:
+        grace_period = current_app.config['ASSET_GC_GRACE_PERIOD']
+    removed, reclaimed = collect_garbage(grace_period, batch_size=batch_size)
+    click.echo('Removed {} unused assets, reclaimed {:.1f} MB.'.format(removed,
+                                                                      reclaimed / 1024 / 1024))
+
+
+@click.command('migrate-assets')
+@click.option('--batch-size', default=500, show_default=True,
+              help='Number of assets moved per transaction.')
+@with_appcontext
+def migrate_assets_command(batch_size):
+    """ Move assets stored flat in ASSETS_DIR into hashed subdirectories. Safe
+    to interrupt and rerun, and to run while the app is serving.
+    """
+    def report(count):
+        click.echo('Moved {} assets'.format(count), err=True)
+    moved = migrate_assets(batch_size=batch_size, progress=report)
+    click.echo('Moved {} assets to subdirectories.'.format(moved))
+
+
 if __name__ == '__main__':
     app = create_app()
     app.run()
@@ -0,0 +1,99 @@
+#    Copyright 2021 Abigail Schubert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" This file contains the asset db connections """
+import logging
+import time
+from omnom.db import OmnomDB
+
+
+logger = logging.getLogger(__name__)
+
+
+class AssetDB(OmnomDB):
+    """ Interface to the database tracking files in the assets dir. Reference
+    counts, and since when each unused asset has been unused, are kept up to
+    date by triggers on recipe.photo.
+    """
+
+    def __init__(self, db_filename=None, init_db=False, conn=None, slow_query_log=None):
+        """ Connect to sqlite db located at db_filename (or use existing conn) """
+        super().__init__(db_filename=db_filename, init_db=init_db, conn=conn,
+                         slow_query_log=slow_query_log)
+
+    def add_asset(self, filename, size=None):
+        """ Start tracking asset filename, of size bytes. If it's already
+        tracked but unused, its grace period before collection restarts.
+        """
+        self._db_insert('INSERT INTO asset (filename, size, unreferenced_at) VALUES (?, ?, ?) '
+                        'ON CONFLICT (filename) DO UPDATE SET '
+                        'size = coalesce(excluded.size, size), '
+                        'unreferenced_at = CASE WHEN refcount <= 0 '
+                        'THEN excluded.unreferenced_at END',
+                        (filename, size, int(time.time())))
+
+    def get_refcount(self, filename):
+        """ Number of recipes using asset filename, or None if it isn't tracked """
+        cursor = self._db_query('SELECT refcount from asset WHERE filename=?', (filename,))
+        ret = cursor.fetchone()
+        if ret is None:
+            return None
+        return ret[0]
+
+    def delete_unused(self, filename):
+        """ Stop tracking asset filename, provided no recipe uses it. Returns
+        True if it was deleted.
+        """
+        cursor = self.conn.execute('DELETE FROM asset WHERE filename=? AND refcount <= 0',
+                                   (filename,))
+        self._commit()
+        return cursor.rowcount > 0
+
+    def get_unreferenced(self, unused_since, limit):
+        """ Returns list of up to limit (filename, size) of assets that no
+        recipe has used since unix time unused_since, longest unused first.
+        """
+        cursor = self._db_query('SELECT filename, size FROM asset '
+                                'WHERE unreferenced_at <= ? AND refcount <= 0 '
+                                'ORDER BY unreferenced_at LIMIT ?', (unused_since, limit))
+        return [tuple(row) for row in cursor.fetchall()]
+
+    def delete_unreferenced(self, filename, unused_since):
+        """ Stop tracking asset filename, provided it's still been unused
+        since unix time unused_since. Returns True if it was deleted.
+        """
+        cursor = self.conn.execute('DELETE FROM asset WHERE filename=? AND refcount <= 0 '
+                                   'AND unreferenced_at <= ?', (filename, unused_since))
+        self._commit()
+        return cursor.rowcount > 0
+
+    def get_flat_assets(self, limit):
+        """ Returns list of up to limit asset filenames not yet in a subdirectory """
+        cursor = self._db_query("SELECT filename FROM asset WHERE instr(filename, '/') = 0 "
+                                'LIMIT ?', (limit,))
+        return [row[0] for row in cursor.fetchall()]
+
+    def rename_assets(self, renames):
+        """ Rename assets, and the recipe photos using them, given list of
+        (filename, new_filename), in a single transaction. Reference counts
+        follow the photos (by the recipe triggers) to the new names.
+        """
+        with self.transaction():
+            for filename, new_filename in renames:
+                self.conn.execute('INSERT OR IGNORE INTO asset (filename, size, unreferenced_at) '
+                                  'SELECT ?, size, unreferenced_at FROM asset WHERE filename=?',
+                                  (new_filename, filename))
+                self.conn.execute('UPDATE recipe SET photo=? WHERE photo=?',
+                                  (new_filename, filename))
+                self.conn.execute('DELETE FROM asset WHERE filename=?', (filename,))
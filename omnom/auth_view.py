@@ -13,39 +13,60 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """ auth.py provides endpoints related to login/authorization """
-from flask import Blueprint, flash, g, redirect, render_template, request, session, url_for
-from werkzeug.security import check_password_hash, generate_password_hash
+import logging
+from flask import (Blueprint, flash, g, has_request_context, redirect, render_template, request,
+                   session, url_for)
+from flask.ctx import _AppCtxGlobals
 from omnom.common import get_user_db
+from omnom.passwords import (HashingBusyError, check_password, get_login_throttle, hash_password,
+                             needs_rehash)
+
+
+logger = logging.getLogger(__name__)  # pylint:disable=invalid-name
 
 
 bp = Blueprint('auth', __name__, url_prefix='/auth')
 
 
+BUSY_MESSAGE = 'The server is busy. Please try again in a moment.'
+THROTTLED_MESSAGE = 'Too many attempts. Please try again later.'
+
+
 @bp.route('/register', methods=('GET', 'POST'))
 def register():
     """ GET:  provide registration form
         POST: validate input and create new user
     """
+    status = 200
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
         user_db = get_user_db()
+        throttle = get_login_throttle()
+        client_key = 'ip:{}'.format(request.remote_addr)
         error = None
 
         if not username:
             error = 'Username is required.'
         elif not password:
             error = 'Password is required.'
+        elif throttle.is_blocked(client_key):
+            error, status = THROTTLED_MESSAGE, 429
         elif user_db.get_user_by_name(username) is not None:
             error = 'User {} is already registered.'.format(username)
 
         if error is None:
-            user_db.add_user(username, generate_password_hash(password))
-            return redirect(url_for('auth.login'))
+            # every registration counts, so one client can't keep the hashing pool busy
+            throttle.failed(client_key)
+            try:
+                user_db.add_user(username, hash_password(password))
+                return redirect(url_for('auth.login'))
+            except HashingBusyError:
+                error, status = BUSY_MESSAGE, 503
 
         flash(error)
 
-    return render_template('auth/register.html')
+    return render_template('auth/register.html'), status
 
 
 @bp.route('/login', methods=('GET', 'POST'))
@@ -53,24 +74,51 @@ def login():
     """ GET:  provide user login page
         POST: authenticate user using username/password and begin user session
     """
+    status = 200
     if request.method == 'POST':
         user_db = get_user_db()
-        user_entry = user_db.get_user_by_name(request.form['username'])
+        username = request.form['username']
         given_password = request.form['password']
+        throttle = get_login_throttle()
+        keys = ('user:{}'.format(username), 'ip:{}'.format(request.remote_addr))
 
         error = None
-        if user_entry is None:
-            error = 'Incorrect username.'
-        elif not check_password_hash(user_entry.password, given_password):
-            error = 'Incorrect password.'
+        user_entry = None
+        if throttle.is_blocked(*keys):
+            # don't spend a hash on it
+            error, status = THROTTLED_MESSAGE, 429
+        else:
+            user_entry = user_db.get_user_by_name(username)
+            try:
+                if user_entry is None:
+                    error = 'Incorrect username.'
+                elif not check_password(user_entry.password, given_password):
+                    error = 'Incorrect password.'
+            except HashingBusyError:
+                error, status = BUSY_MESSAGE, 503
+            if error is not None and status == 200:
+                throttle.failed(*keys)
 
         if error is None:
+            throttle.reset(keys[0])
+            if needs_rehash(user_entry.password):
+                _rehash_password(user_db, user_entry, given_password)
             session.clear()
             session['user_id'] = user_entry.id_number
             return redirect(url_for('index'))
 
         flash(error)
-    return render_template('auth/login.html')
+    return render_template('auth/login.html'), status
+
+
+def _rehash_password(user_db, user_entry, password):
+    """ Store a new hash of user's password, made with the current hash method """
+    try:
+        user_db.update_password(user_entry.id_number, hash_password(password))
+    except HashingBusyError:
+        logger.info('Hashing pool busy, not rehashing password of user %d', user_entry.id_number)
+    else:
+        logger.info('Rehashed password of user %d', user_entry.id_number)
 
 
 @bp.route('/logout')
@@ -80,14 +128,32 @@ def logout():
     return redirect(url_for('index'))
 
 
-@bp.before_app_request
 def load_logged_in_user():
-    """ Update application context with current user. g.user will contain
-    UserEntry for the current user, or None if no user is logged in.
-    """
+    """ Returns UserEntry for the current user, or None if no user is logged in. """
+    if not has_request_context():
+        return None
     user_id = session.get('user_id')
-
     if user_id is None:
-        g.user = None
-    else:
-        g.user = get_user_db().get_user(user_id)
+        return None
+    return get_user_db().get_user(user_id)
+
+
+@bp.before_app_request
+def reset_logged_in_user():
+    """ Forget any g.user from an earlier request sharing this app context, so
+    it gets looked up again (lazily, see AppGlobals) for this one.
+    """
+    g.pop('user', None)
+
+
+class AppGlobals(_AppCtxGlobals):
+    """ flask.g with a lazily loaded g.user: the current user is only looked
+    up the first time something reads g.user, so requests that never do
+    (static files, images) don't touch the user table at all.
+    """
+
+    def __getattr__(self, name):
+        if name == 'user':
+            self.user = load_logged_in_user()
+            return self.user
+        raise AttributeError(name)
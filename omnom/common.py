@@ -15,15 +15,49 @@
 """ This file contains helpful common functions """
 import functools
 from flask import g, current_app, redirect, url_for
+from omnom.asset_db import AssetDB
 from omnom.recipe_db import RecipeDB
 from omnom.user_db import UserDB
 
 
+def get_db_connection():
+    """ Get the db connection for this app context, taking one from the app's
+    connection pool on first use. It goes back to the pool on teardown.
+    """
+    conn = getattr(g, '_db_conn', None)
+    if conn is None:
+        conn = g._db_conn = current_app.extensions['omnom_pool'].acquire()
+    return conn
+
+
+def release_db_connection():
+    """ Return this app context's db connection (if any) to the pool """
+    conn = g.pop('_db_conn', None)
+    g.pop('_database', None)
+    g.pop('_userdb', None)
+    g.pop('_assetdb', None)
+    if conn is not None:
+        current_app.extensions['omnom_pool'].release(conn)
+
+
+def get_page_cache():
+    """ Get the app's rendered page cache, or None if disabled """
+    return current_app.extensions.get('omnom_page_cache')
+
+
+def get_slow_query_log():
+    """ Get the app's slow query log, or None if disabled """
+    return current_app.extensions.get('omnom_slow_query_log')
+
+
 def get_recipe_db():
     """ Get reference to RecipeDB """
     db = getattr(g, '_database', None)
     if not db:
-        db = g._database = RecipeDB(current_app.config['DATABASE'])
+        page_cache = get_page_cache()
+        on_change = page_cache.invalidate_tags if page_cache is not None else None
+        db = g._database = RecipeDB(conn=get_db_connection(), on_change=on_change,
+                                    slow_query_log=get_slow_query_log())
     return db
 
 
@@ -31,7 +65,17 @@ def get_user_db():
     """ Get a reference to UserDB """
     db = getattr(g, '_userdb', None)
     if not db:
-        db = g._userdb = UserDB(current_app.config['DATABASE'])
+        db = g._userdb = UserDB(conn=get_db_connection(),
+                                slow_query_log=get_slow_query_log())
+    return db
+
+
+def get_asset_db():
+    """ Get a reference to AssetDB """
+    db = getattr(g, '_assetdb', None)
+    if not db:
+        db = g._assetdb = AssetDB(conn=get_db_connection(),
+                                  slow_query_log=get_slow_query_log())
     return db
 
 
@@ -13,23 +13,166 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """ Common access to omnom database """
+from collections import deque
+import contextlib
 import logging
-from pathlib import Path
 import sqlite3
+import threading
+import time
+from omnom import migrate
+from omnom.metrics import DB_QUERY_SECONDS, statement_label
 
 logger = logging.getLogger(__name__)
 
+# Process wide caches of db contents. Each has an invalidate() method.
+CACHES = []
+
+
+def register_cache(cache):
+    """ Register cache to be invalidated on db reset or rollback. Returns cache. """
+    CACHES.append(cache)
+    return cache
+
+
+class PoolTimeoutError(Exception):
+    """ No pooled connection became available in time """
+
+
+class OmnomConnection(sqlite3.Connection):
+    """ sqlite3 connection used for the omnom db. Unlike the base class, it can
+    carry extra attributes (and be weakly referenced).
+    """
+
+    # nesting depth of OmnomDB.transaction() blocks using this connection
+    transaction_depth = 0
+
+
+def connect(db_filename, check_same_thread=True):
+    """ Open a new connection to sqlite db located at db_filename """
+    conn = sqlite3.connect(db_filename, factory=OmnomConnection,
+                           check_same_thread=check_same_thread)
+    conn.row_factory = sqlite3.Row
+    conn.db_filename = str(db_filename)
+    conn.pending_changes = []  # (on_change, tags) to report once the transaction commits
+    logger.debug('Connected to %s', db_filename)
+    return conn
+
+
+class LocalConnections():
+    """ A connection per thread to a sqlite db at filename, set up with schema
+    (a script) on first use. For side dbs (caches, logs) whose latest writes
+    may be lost in a crash: they use WAL and don't sync.
+    """
+
+    def __init__(self, filename, schema, row_factory=None):
+        self.filename = str(filename)
+        self.row_factory = row_factory
+        self._local = threading.local()
+        with self.get() as conn:
+            conn.executescript(schema)
+
+    def get(self):
+        """ Get this thread's connection """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename, timeout=1.0)
+            conn.row_factory = self.row_factory
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            self._local.conn = conn
+        return conn
+
+
+class ConnectionPool():
+    """ Bounded pool of connections to a single sqlite db, shared by all
+    threads of the app. At most max_size connections are handed out at once,
+    acquire() waits up to timeout seconds for one to be released.
+    """
+
+    def __init__(self, db_filename, max_size=8, timeout=5.0):
+        self.db_filename = db_filename
+        self.max_size = max_size
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._idle = deque()  # used LIFO, so the busiest connections stay warm
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Return a healthy connection, opening a new one if none are idle. """
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolTimeoutError('No connection to {} available after {}s'.format(
+                self.db_filename, self.timeout))
+        try:
+            while True:
+                with self._lock:
+                    conn = self._idle.pop() if self._idle else None
+                if conn is None:
+                    # connections move between threads, but only one uses it at a time
+                    return connect(self.db_filename, check_same_thread=False)
+                if self._is_healthy(conn):
+                    return conn
+                self._discard(conn)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn):
+        """ Return conn to the pool. Uncommitted changes are rolled back. """
+        try:
+            conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+        else:
+            with self._lock:
+                self._idle.append(conn)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """ Close all idle connections """
+        with self._lock:
+            while self._idle:
+                self._idle.pop().close()
+
+    @staticmethod
+    def _is_healthy(conn):
+        """ Returns true if conn can still run queries """
+        try:
+            conn.execute('SELECT 1').fetchone()
+        except sqlite3.Error:
+            return False
+        return True
+
+    def _discard(self, conn):
+        """ Close a broken connection """
+        logger.warning('Discarding broken connection to %s', self.db_filename)
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
 
 class OmnomDB():
     """ Common access to the omnom db, used by RecipeDB and UserDB """
 
-    SCHEMA_FILENAME = Path(__file__).parent / 'schema.sql'
+    # Re-runnable script (re)creating the full text search index
+    SEARCH_SCHEMA_FILENAME = migrate.MIGRATIONS_DIR / '0005_search.sql'
+    # Called with a tuple of tags describing data changed through this
+    # OmnomDB, e.g. to invalidate caches.
+    on_change = None
 
-    def __init__(self, db_filename, init_db=False):
-        """ Connect to sqlite db located at db_filename """
-        self.conn = sqlite3.connect(db_filename)
-        self.conn.row_factory = sqlite3.Row
-        logger.debug('Connected to %s', db_filename)
+    def __init__(self, db_filename=None, init_db=False, conn=None, slow_query_log=None):
+        """ Connect to sqlite db located at db_filename. Alternatively, pass an
+        existing conn (e.g. from a ConnectionPool) to use. It is left open by close().
+        Statements over its threshold are recorded in slow_query_log, if given.
+        """
+        self.slow_query_log = slow_query_log
+        if conn is None:
+            self.conn = connect(db_filename)
+            self._owns_conn = True
+        else:
+            self.conn = conn
+            self._owns_conn = False
         if init_db:
             self.init_db()
 
@@ -39,30 +182,87 @@ class OmnomDB():
     def close(self):
         """ Close connection to db """
         if self.conn:
-            self.conn.close()
+            if self._owns_conn:
+                self.conn.close()
             self.conn = None
 
     def init_db(self, extra_sql=None):
-        """ Reset and initialize database from empty """
-        with open(self.SCHEMA_FILENAME) as fptr:
-            cursor = self.conn.cursor()
-            cursor.executescript(fptr.read())
+        """ Reset and initialize database from empty, then run extra_sql script """
+        migrate.reset(self.conn)
+        migrate.upgrade(self.conn)
         if extra_sql:
             with open(extra_sql) as fptr:
                 cursor = self.conn.cursor()
                 cursor.executescript(fptr.read())
         self.conn.commit()
-        logger.info('Initialized recipe db using %s', self.SCHEMA_FILENAME)
+        self._invalidate_caches()
+        logger.info('Initialized db at schema version %d', migrate.schema_version(self.conn))
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ Context manager grouping writes into a single transaction. Writes
+        inside the block are committed together when it exits, or rolled back
+        if it raises. Nested blocks join the outermost transaction, which is
+        shared by every OmnomDB using the same connection.
+        """
+        conn = self.conn
+        conn.transaction_depth += 1
+        try:
+            yield self
+        except BaseException:
+            conn.transaction_depth -= 1
+            if not conn.transaction_depth:
+                conn.rollback()
+                conn.pending_changes.clear()
+                self._invalidate_caches()
+            raise
+        conn.transaction_depth -= 1
+        if not conn.transaction_depth:
+            conn.commit()
+            pending, conn.pending_changes = conn.pending_changes, []
+            for on_change, tags in pending:
+                on_change(tags)
+
+    @staticmethod
+    def _invalidate_caches():
+        """ Called when data may have changed in ways caches can't detect on
+        their own (db reset, rollback). Invalidates every registered cache.
+        """
+        for cache in CACHES:
+            cache.invalidate()
+
+    def _changed(self, *tags):
+        """ Report a change to on_change, once it has been committed """
+        if self.on_change is None:
+            return
+        if self.conn.transaction_depth:
+            self.conn.pending_changes.append((self.on_change, tags))
+        else:
+            self.on_change(tags)
+
+    def _commit(self):
+        """ Commit, unless inside a transaction() block which will commit later """
+        if not self.conn.transaction_depth:
+            self.conn.commit()
+
+    def _record_query(self, sql, start, args=None):
+        """ Record time taken by statement sql, which began at perf_counter() start """
+        seconds = time.perf_counter() - start
+        DB_QUERY_SECONDS.observe(seconds, statement=statement_label(sql))
+        if self.slow_query_log is not None:
+            self.slow_query_log.record(self.conn, sql, args, seconds)
 
     def _db_query(self, sql, args=None):
         """ Execute a SQL query. Returns a cursor with results. """
         cursor = self.conn.cursor()
+        start = time.perf_counter()
         if args:
             if not isinstance(args, tuple):
                 raise TypeError("args isn't a tuple. Forgot to put a comma, didn't you?")
             cursor.execute(sql, args)
         else:
             cursor.execute(sql)
+        self._record_query(sql, start, args)
         return cursor
 
     def _db_insert(self, sql, args):
@@ -70,6 +270,25 @@ class OmnomDB():
         if not isinstance(args, tuple):
             raise TypeError("args isn't a tuple. Forgot to put a comma, didn't you?")
         cursor = self.conn.cursor()
+        start = time.perf_counter()
         cursor.execute(sql, args)
-        self.conn.commit()
+        self._commit()
+        self._record_query(sql, start, args)
         return cursor.lastrowid
+
+    def _db_insert_many(self, sql, args_iter):
+        """ Execute SQL insert statement once per args tuple in args_iter and
+        commit. Only for tables with an AUTOINCREMENT primary key.
+        Returns list of new row ids.
+        """
+        with self.transaction():
+            cursor = self.conn.cursor()
+            start = time.perf_counter()
+            cursor.executemany(sql, args_iter)
+            self._record_query(sql, start)
+            count = cursor.rowcount
+            if count <= 0:
+                return []
+            # the write lock is held throughout, so the new ids are consecutive
+            last_id = self.conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+        return list(range(last_id - count + 1, last_id + 1))
@@ -13,38 +13,596 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """ This file contains methods for interacting with user-images """
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
+import importlib.util
+import itertools
 import logging
-from pathlib import Path
-from flask import Blueprint, current_app, send_from_directory
-from werkzeug.utils import secure_filename
+import os
+from pathlib import Path, PurePosixPath
+import re
+import tempfile
+import threading
+import time
+from flask import (Blueprint, Request, abort, current_app, request, send_from_directory,
+                   url_for)
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+from werkzeug.security import safe_join
+from werkzeug.utils import cached_property, secure_filename
+from omnom.common import get_asset_db
 
 
 logger = logging.getLogger(__name__)  # pylint:disable=invalid-name
 bp = Blueprint('images', __name__)  # pylint:disable=invalid-name
 
 ALLOWED_EXTENSIONS = {'gif', 'png', 'jpg', 'jpeg'}
+# Leading bytes of each allowed image type -> canonical name of that type
+IMAGE_SIGNATURES = {
+    b'\x89PNG\r\n\x1a\n': 'png',
+    b'\xff\xd8\xff': 'jpeg',
+    b'GIF87a': 'gif',
+    b'GIF89a': 'gif',
+}
+SNIFF_SIZE = max(len(signature) for signature in IMAGE_SIGNATURES)
+# Resized variants generated for each photo: size name -> longest edge in pixels
+PHOTO_SIZES = {'thumb': 240, 'medium': 800, 'full': 1600}
+VARIANT_QUALITY = 85
+CHUNK_SIZE = 64 * 1024
+# Assets named by content hash never change, so browsers may cache them forever.
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+VARIANT_MAX_AGE = 24 * 60 * 60
+_CONTENT_HASH_RE = re.compile(r'_([0-9a-f]{64})$')
+
+_executor_lock = threading.Lock()
+
+
+class InvalidAssetError(Exception):
+    """ Uploaded file isn't an acceptable image """
+
+
+class PhotoTooLargeError(InvalidAssetError):
+    """ Uploaded photo is larger than MAX_PHOTO_SIZE """
+
+
+@functools.lru_cache(maxsize=None)
+def have_pillow():
+    """ True if Pillow is installed. It's optional: without it, originals are
+    served at every size. Pillow itself is only imported once a photo needs
+    resizing, as it's slow to load.
+    """
+    return importlib.util.find_spec('PIL') is not None
+
+
+def variant_filename(filename, size):
+    """ Name of the size variant of asset filename, stored alongside it """
+    path = PurePosixPath(filename)
+    return str(path.with_name('{}.{}.jpg'.format(path.stem, size)))
+
+
+def generate_variants(assets_dir, filename):
+    """ Write a resized, re-encoded jpeg of asset filename for each of
+    PHOTO_SIZES. Each variant appears atomically once complete.
+    Returns list of variant filenames written.
+    """
+    if not have_pillow():
+        return []
+    from PIL import Image, ImageOps  # pylint:disable=import-outside-toplevel
+    written = []
+    with Image.open(Path(assets_dir, filename)) as original:
+        image = ImageOps.exif_transpose(original).convert('RGB')
+    for size, max_edge in PHOTO_SIZES.items():
+        variant = image.copy()
+        variant.thumbnail((max_edge, max_edge))
+        dest = Path(assets_dir, variant_filename(filename, size))
+        fd, tmp_name = tempfile.mkstemp(dir=dest.parent, prefix='.tmp_')
+        try:
+            with os.fdopen(fd, 'wb') as fptr:
+                variant.save(fptr, 'JPEG', quality=VARIANT_QUALITY, optimize=True,
+                             progressive=True)
+            os.replace(tmp_name, dest)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+        written.append(dest.name)
+    logger.info('Generated %d variants of %s', len(written), filename)
+    return written
+
+
+def _get_executor():
+    """ Get the app's bounded pool of photo resizing threads """
+    with _executor_lock:
+        executor = current_app.extensions.get('omnom_photo_workers')
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=current_app.config['PHOTO_WORKERS'],
+                                          thread_name_prefix='omnom-photos')
+            current_app.extensions['omnom_photo_workers'] = executor
+    return executor
+
+
+def _generate_variants_logged(assets_dir, filename):
+    """ generate_variants, logging rather than raising errors (runs unattended) """
+    try:
+        return generate_variants(assets_dir, filename)
+    except Exception:  # pylint:disable=broad-except
+        logger.exception('Failed to generate variants of %s', filename)
+        return []
+
+
+def schedule_variants(filename):
+    """ Generate size variants of asset filename in the background.
+    Returns a Future, or None if variants aren't supported (no Pillow).
+    """
+    if not have_pillow():
+        return None
+    return _get_executor().submit(_generate_variants_logged,
+                                  current_app.config['ASSETS_DIR'], filename)
+
+
+def photo_path(assets_dir, filename, size):
+    """ Returns path (relative to assets_dir) of the size variant of asset
+    filename, or of the original if the variant isn't there, or None if
+    neither is.
+    """
+    stored_name = resolve_asset(assets_dir, filename)
+    if stored_name is None:
+        return None
+    variant = variant_filename(stored_name, size)
+    return variant if Path(assets_dir, variant).is_file() else stored_name
+
+
+def photo_url(filename, size):
+    """ URL of the size variant of asset filename. When exporting a static
+    site (STATIC_EXPORT), that's the path of the variant file (or of the
+    original while there's no variant), as static hosts ignore query args.
+    """
+    if current_app.config['STATIC_EXPORT']:
+        filename = photo_path(current_app.config['ASSETS_DIR'], filename, size) or filename
+        return url_for('images.uploaded_file', filename=filename)
+    return url_for('images.uploaded_file', filename=filename, size=size)
+
+
+def photo_srcset(filename):
+    """ srcset attribute value listing every size variant of asset filename """
+    return ', '.join('{} {}w'.format(photo_url(filename, size), max_edge)
+                     for size, max_edge in PHOTO_SIZES.items())
+
+
+@bp.app_context_processor
+def inject_photo_helpers():
+    """ Make photo_url and photo_srcset available to templates """
+    return {'photo_url': photo_url, 'photo_srcset': photo_srcset}
+
+
+def content_hash(filename):
+    """ Returns the sha256 hex digest in asset filename, or None if it has
+    none (assets saved before names were content addressed).
+    """
+    match = _CONTENT_HASH_RE.search(PurePosixPath(filename).stem)
+    return match.group(1) if match else None
+
+
+def fanout_path(filename):
+    """ Where asset filename is stored, relative to the assets dir: two levels
+    of subdirectories named after its content hash (or, for older assets,
+    the hash of its name), eg. 'ab/cd/recipe_abcd...png'. This keeps
+    directories small however many assets there are.
+    """
+    name = PurePosixPath(filename).name
+    digest = content_hash(name) or hashlib.sha256(name.encode('utf-8')).hexdigest()
+    return '{}/{}/{}'.format(digest[:2], digest[2:4], name)
+
+
+def resolve_asset(assets_dir, filename):
+    """ Returns path of asset filename relative to assets_dir, in whichever
+    layout (flat or fanned out) it's currently stored, or None if it isn't.
+    Until `flask migrate-assets` has run, assets may be in either.
+    """
+    flat_name = PurePosixPath(filename).name
+    for candidate in (filename, fanout_path(filename), flat_name):
+        path = safe_join(str(assets_dir), candidate)
+        if path is not None and os.path.isfile(path):
+            return candidate
+    return None
+
+
+def sniff_image_type(header):
+    """ Type of image (a value of IMAGE_SIGNATURES) whose file starts with
+    bytes header, or None if it isn't an allowed image type.
+    """
+    for signature, image_type in IMAGE_SIGNATURES.items():
+        if header.startswith(signature):
+            return image_type
+    return None
+
+
+def _photo_extension(filename):
+    """ Lower case extension of uploaded filename, without the dot. Raises
+    InvalidAssetError unless it's one of ALLOWED_EXTENSIONS.
+    """
+    extension = Path(secure_filename(filename or '')).suffix.lower()[1:]
+    if extension not in ALLOWED_EXTENSIONS:
+        raise InvalidAssetError('Photos must be one of: {}.'.format(
+            ', '.join(sorted(ALLOWED_EXTENSIONS))))
+    return extension
+
+
+class AssetUpload():
+    """ Temporary file in the assets dir, written an uploaded photo at a time
+    as it arrives. The photo is checked as it's written: its first bytes must
+    be an image of the type its extension names, and it mustn't grow past
+    max_size bytes. Otherwise write raises InvalidAssetError, after removing
+    the file, so no more of it is read. It's hashed along the way, and kept
+    only if claimed by save_to_assets before it's closed.
+    """
+
+    def __init__(self, assets_dir, filename, max_size=None):
+        self.extension = _photo_extension(filename)
+        self.max_size = max_size
+        self.size = 0
+        self.rejected = False
+        self._header = b''
+        self._digest = hashlib.sha256()
+        fd, self.name = tempfile.mkstemp(dir=assets_dir, prefix='.tmp_')
+        self._file = os.fdopen(fd, 'w+b')
+
+    def __getattr__(self, name):
+        """ Otherwise behaves as the underlying file (seek, read, ...) """
+        return getattr(self._file, name)
+
+    def _check_header(self):
+        """ Raise InvalidAssetError if the image type doesn't match the extension """
+        if sniff_image_type(self._header) != {'jpg': 'jpeg'}.get(self.extension, self.extension):
+            raise InvalidAssetError('Photo is not a valid {} image.'.format(self.extension))
+
+    def write(self, data):
+        """ Check and append bytes data. Returns number of bytes written. """
+        try:
+            self.size += len(data)
+            if self.max_size is not None and self.size > self.max_size:
+                raise PhotoTooLargeError('Photo is too large, the limit is {} MB.'.format(
+                    self.max_size // (1024 * 1024)))
+            if len(self._header) < SNIFF_SIZE:
+                self._header += data[:SNIFF_SIZE - len(self._header)]
+                if len(self._header) == SNIFF_SIZE:
+                    self._check_header()
+            self._digest.update(data)
+            return self._file.write(data)
+        except InvalidAssetError:
+            self.rejected = True
+            self.close()
+            raise
+
+    def finish(self):
+        """ Finish checking the photo (it may be shorter than SNIFF_SIZE) and
+        flush it to disk. Returns sha256 hex digest of its content.
+        """
+        if len(self._header) < SNIFF_SIZE:
+            self._check_header()
+        self._file.flush()
+        return self._digest.hexdigest()
+
+    def close(self):
+        """ Close the file, removing it unless it's been renamed into place """
+        self._file.close()
+        Path(self.name).unlink(missing_ok=True)
+
+
+def streams_photos(view):
+    """ Mark a view whose request body may hold recipe photos, to be streamed
+    into the assets dir by UploadRequest. Files sent to other views are
+    handled as werkzeug does by default.
+    """
+    view.streams_photos = True
+    return view
+
+
+class _UploadBody():
+    """ Request body, which reads as ended once a photo in it has been
+    rejected. Werkzeug reads a body to the end after parsing it, even to
+    discard it: this leaves the rest of the body unread.
+    """
+
+    def __init__(self, stream, uploads):
+        self._stream = stream
+        self._uploads = uploads
+        self.rejected = False  # set if a photo was rejected before its upload began
+
+    def _rejected(self):
+        return self.rejected or any(upload.rejected for upload in self._uploads)
+
+    def read(self, *args):
+        return b'' if self._rejected() else self._stream.read(*args)
+
+    def readline(self, *args):
+        return b'' if self._rejected() else self._stream.readline(*args)
+
+    def exhaust(self):
+        """ Read (and discard) the rest of the body, unless a photo was rejected """
+        while self.read(CHUNK_SIZE):
+            pass
+
+
+class UploadRequest(Request):
+    """ Request streaming each file uploaded to a view marked streams_photos
+    straight into an AssetUpload as the body is parsed, rather than spooling
+    it elsewhere for save_to_assets to copy. An unacceptable photo stops the
+    parse (InvalidAssetError, raised by request.form and request.files) as
+    soon as that's known.
+    """
+
+    @cached_property
+    def stream(self):
+        """ The body, as parsed and read by werkzeug """
+        return _UploadBody(super().stream, self._asset_uploads)
+
+    @cached_property
+    def _asset_uploads(self):
+        return []
+
+    def _streams_photos(self):
+        view = current_app.view_functions.get(self.endpoint)
+        return getattr(view, 'streams_photos', False)
+
+    def make_form_data_parser(self):
+        parser = super().make_form_data_parser()
+        if self._streams_photos():
+            default_stream_factory = parser.stream_factory
+
+            def stream_factory(total_content_length, content_type, filename=None,
+                               content_length=None):
+                """ Where werkzeug writes each uploaded file part """
+                if not filename:
+                    # file input left empty
+                    return default_stream_factory(total_content_length, content_type,
+                                                  filename, content_length)
+                try:
+                    upload = AssetUpload(current_app.config['ASSETS_DIR'], filename,
+                                         current_app.config['MAX_PHOTO_SIZE'])
+                except InvalidAssetError:
+                    self.stream.rejected = True
+                    raise
+                self._asset_uploads.append(upload)
+                return upload
+
+            parser.stream_factory = stream_factory
+        return parser
+
+    def close(self):
+        """ Also remove uploads the request didn't keep, even if parsing them failed """
+        super().close()
+        for upload in self.__dict__.pop('_asset_uploads', []):
+            upload.close()
+
+
+@bp.app_errorhandler(InvalidAssetError)
+def rejected_photo(error):
+    """ Photos rejected while a form is parsed, outside of views reporting
+    them to the user
+    """
+    if isinstance(error, PhotoTooLargeError):
+        return RequestEntityTooLarge(str(error)).get_response()
+    return BadRequest(str(error)).get_response()
 
 
 def save_to_assets(file_obj, prefix):
-    """ Given file_obj, save to user assets directory and return filename """
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
-    old_filename = secure_filename(file_obj.filename)
-    file_ext = Path(old_filename).suffix
-    new_filename = '{}_{}{}'.format(prefix, timestamp, file_ext)
-    file_obj.save(current_app.config['ASSETS_DIR'] / new_filename)
-    logger.info('Saved new asset %s', new_filename)
+    """ Given file_obj, save to user assets directory and return filename.
+    Files are named after the sha256 of their content, hashed while they are
+    written, so the same file uploaded twice is only stored once.
+    Uploads in a request have already been written to the assets dir, and
+    checked, by UploadRequest, and are renamed into place. Any other file_obj
+    is copied in chunks to an AssetUpload first. Raises InvalidAssetError,
+    having read no more than needed to tell, if it isn't an allowed image
+    type, or its contents don't match its extension, or it's larger than
+    MAX_PHOTO_SIZE.
+    """
+    assets_dir = Path(current_app.config['ASSETS_DIR'])
+    upload = file_obj.stream
+    if not isinstance(upload, AssetUpload):
+        upload = AssetUpload(assets_dir, file_obj.filename, current_app.config['MAX_PHOTO_SIZE'])
+        # a short first read, so files that aren't images are rejected unread
+        chunks = itertools.chain([file_obj.stream.read(SNIFF_SIZE)],
+                                 iter(functools.partial(file_obj.stream.read, CHUNK_SIZE), b''))
+        for chunk in chunks:
+            upload.write(chunk)
+    try:
+        digest = upload.finish()
+        new_filename = fanout_path('{}_{}.{}'.format(prefix, digest, upload.extension))
+        # tracked (restarting any grace period) before checking for an existing
+        # copy, in one transaction, so the garbage collector or remove_asset
+        # can't remove that copy from under us
+        asset_db = get_asset_db()
+        with asset_db.transaction():
+            asset_db.add_asset(new_filename, upload.size)
+            is_new = not (assets_dir / new_filename).exists()
+            if is_new:
+                (assets_dir / new_filename).parent.mkdir(parents=True, exist_ok=True)
+                os.replace(upload.name, assets_dir / new_filename)
+    finally:
+        upload.close()
+    if is_new:
+        logger.info('Saved new asset %s (%d bytes)', new_filename, upload.size)
+        schedule_variants(new_filename)
+    else:
+        logger.info('Asset %s already stored', new_filename)
+    return new_filename
+
+
+def write_photo(assets_dir, filename, data, prefix, max_size=None):
+    """ Write photo bytes data, that was named filename, to assets_dir outside
+    of a request (eg. an import). It's checked, and named after its content,
+    as save_to_assets does, but it's left to the recipe using it to track it.
+    Returns its asset filename. Raises InvalidAssetError.
+    """
+    upload = AssetUpload(assets_dir, filename, max_size)
+    try:
+        upload.write(data)
+        new_filename = fanout_path('{}_{}.{}'.format(prefix, upload.finish(), upload.extension))
+        dest = Path(assets_dir, new_filename)
+        if not dest.exists():
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(upload.name, dest)
+    finally:
+        upload.close()
     return new_filename
 
 
+def _unlink_asset_files(assets_dir, filename):
+    """ Remove asset filename and its size variants from assets_dir.
+    Returns number of bytes freed.
+    """
+    freed = 0
+    for name in [filename] + [variant_filename(filename, size) for size in PHOTO_SIZES]:
+        path = Path(assets_dir, name)
+        try:
+            freed += path.stat().st_size
+            path.unlink()
+        except FileNotFoundError:
+            pass
+    return freed
+
+
 def remove_asset(filename):
-    """ Given filename, remove from user assets directory. """
-    full_path = current_app.config['ASSETS_DIR'] / filename
-    logger.info('Removing asset file %s', full_path)
-    full_path.unlink(missing_ok=True)
+    """ Given filename, remove it and its size variants from user assets
+    directory, unless a recipe still uses it. Returns True if removed.
+    It's untracked and its files removed in one transaction, so an upload of
+    the same content (which may then share the file) waits for it.
+    """
+    asset_db = get_asset_db()
+    with asset_db.transaction():
+        if not asset_db.delete_unused(filename):
+            refcount = asset_db.get_refcount(filename)
+            if refcount is not None:
+                logger.info('Keeping asset %s, still used by %d recipes', filename, refcount)
+                return False
+            # not tracked at all (saved before assets were)
+        logger.info('Removing asset file %s', filename)
+        _unlink_asset_files(current_app.config['ASSETS_DIR'], filename)
+    return True
+
+
+def collect_garbage(grace_period, batch_size=100, max_batches=None):
+    """ Remove assets (and their size variants) that no recipe has used for
+    at least grace_period seconds, batch_size at a time, stopping after
+    max_batches if given. Each asset is untracked and its files removed in
+    one transaction, so an upload of the same content either waits for it
+    or restarts its grace period first.
+    Returns (number of assets removed, bytes reclaimed).
+    """
+    asset_db = get_asset_db()
+    assets_dir = current_app.config['ASSETS_DIR']
+    unused_since = int(time.time() - grace_period)
+    removed = reclaimed = batches = 0
+    while max_batches is None or batches < max_batches:
+        candidates = asset_db.get_unreferenced(unused_since, batch_size)
+        if not candidates:
+            break
+        for filename, _ in candidates:
+            with asset_db.transaction():
+                if asset_db.delete_unreferenced(filename, unused_since):
+                    reclaimed += _unlink_asset_files(assets_dir, filename)
+                    removed += 1
+        batches += 1
+    if removed:
+        logger.info('Collected %d unused assets, reclaimed %d bytes', removed, reclaimed)
+    return removed, reclaimed
+
+
+def _collect_garbage_logged(app):
+    """ collect_garbage for app with its configured limits, logging rather
+    than raising errors (runs unattended)
+    """
+    with app.app_context():
+        try:
+            return collect_garbage(app.config['ASSET_GC_GRACE_PERIOD'],
+                                   batch_size=app.config['ASSET_GC_BATCH_SIZE'],
+                                   max_batches=app.config['ASSET_GC_MAX_BATCHES'])
+        except Exception:  # pylint:disable=broad-except
+            logger.exception('Failed to collect unused assets')
+            return 0, 0
+
+
+@bp.after_app_request
+def schedule_garbage_collection(response):
+    """ Every ASSET_GC_INTERVAL seconds, collect unused assets in the background """
+    interval = current_app.config['ASSET_GC_INTERVAL']
+    if interval is None:
+        return response
+    now = time.monotonic()
+    with _executor_lock:
+        next_run = current_app.extensions.setdefault('omnom_asset_gc_due', now + interval)
+        due = now >= next_run
+        if due:
+            current_app.extensions['omnom_asset_gc_due'] = now + interval
+    if due:
+        _get_executor().submit(_collect_garbage_logged, current_app._get_current_object())
+    return response
+
+
+def _move_asset_files(assets_dir, filename, new_filename):
+    """ Move asset filename and its size variants to new_filename, skipping
+    any that have already been moved
+    """
+    names = [(filename, new_filename)] + [(variant_filename(filename, size),
+                                           variant_filename(new_filename, size))
+                                          for size in PHOTO_SIZES]
+    Path(assets_dir, new_filename).parent.mkdir(parents=True, exist_ok=True)
+    for old_name, new_name in names:
+        try:
+            os.replace(Path(assets_dir, old_name), Path(assets_dir, new_name))
+        except FileNotFoundError:
+            pass
+
+
+def migrate_assets(batch_size=500, progress=None):
+    """ Move assets stored flat in the assets dir to their fanout_path, and
+    rename them in the asset table and recipe photos, batch_size at a time.
+    Files are moved before being renamed, and uploaded_file finds them in
+    either place, so this can run (or be interrupted and rerun) while the
+    app serves requests. Calls progress(count) after each batch, if given.
+    Returns number of assets moved.
+    """
+    asset_db = get_asset_db()
+    assets_dir = current_app.config['ASSETS_DIR']
+    moved = 0
+    while True:
+        filenames = asset_db.get_flat_assets(batch_size)
+        if not filenames:
+            break
+        renames = [(filename, fanout_path(filename)) for filename in filenames]
+        for filename, new_filename in renames:
+            _move_asset_files(assets_dir, filename, new_filename)
+        asset_db.rename_assets(renames)
+        moved += len(renames)
+        if progress is not None:
+            progress(moved)
+    logger.info('Moved %d assets to the fanned out layout', moved)
+    return moved
 
 
-@bp.route('/assets/<filename>')
+@bp.route('/assets/<path:filename>')
 def uploaded_file(filename):
-    """ Returns file from user assets directory """
-    return send_from_directory(current_app.config['ASSETS_DIR'], filename)
+    """ Returns file from user assets directory. With a size query arg (one
+    of PHOTO_SIZES), returns that variant instead, or the original if the
+    variant isn't ready yet. Content addressed files are sent with their
+    hash as ETag and may be cached forever. Assets are found in either the
+    flat or fanned out layout.
+    """
+    assets_dir = current_app.config['ASSETS_DIR']
+    stored_name = resolve_asset(assets_dir, filename)
+    if stored_name is None:
+        abort(404)
+    size = request.args.get('size')
+    if size in PHOTO_SIZES:
+        variant = variant_filename(stored_name, size)
+        if Path(assets_dir, variant).is_file():
+            return send_from_directory(assets_dir, variant, max_age=VARIANT_MAX_AGE)
+        # the original stands in until the variant is ready, don't let it be cached
+        return send_from_directory(assets_dir, stored_name, max_age=0)
+    digest = content_hash(stored_name)
+    if digest is None:
+        return send_from_directory(assets_dir, stored_name)
+    response = send_from_directory(assets_dir, stored_name, etag=digest,
+                                   max_age=IMMUTABLE_MAX_AGE)
+    response.cache_control.immutable = True
+    return response
@@ -0,0 +1,433 @@
+#    Copyright 2021 Abigail Schubert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Prometheus style metrics.
+
+Counters and histograms are kept per process in REGISTRY. When METRICS_DIR is
+set, each process also writes its samples to a file there, and /metrics adds
+up the files of every process so any worker can answer a scrape for all of
+them. As a process exits, its file is folded into metrics-retired.json, so
+files don't pile up as workers come and go.
+"""
+import abc
+import atexit
+from bisect import bisect_left
+from contextlib import contextmanager
+import fcntl
+import json
+import logging
+import os
+from pathlib import Path
+import re
+import tempfile
+import threading
+import time
+import uuid
+from flask import Blueprint, Response, g, request
+from flask.templating import Environment
+from jinja2 import Template
+
+logger = logging.getLogger(__name__)  # pylint:disable=invalid-name
+bp = Blueprint('metrics', __name__)  # pylint:disable=invalid-name
+
+# Upper bounds (seconds) of latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+# Upper bounds (bytes) of response size histogram buckets
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+# Samples of exited processes are added up in RETIRED_FILENAME, each live
+# process has its own metrics-<pid>-<token>.json
+RETIRED_FILENAME = 'metrics-retired.json'
+LOCK_FILENAME = '.metrics.lock'
+_PROCESS_FILE_RE = re.compile(r'metrics-(\d+)-[0-9a-f]+\.json$')
+
+
+def _pid_alive(pid):
+    """ True if process pid exists """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _escape(value):
+    """ Escape a label value for the prometheus text format """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+def _format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(abc.ABC):
+    """ Base metric: a named family of samples, one per set of label values """
+    TYPE = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._samples = {}  # label values tuple -> sample
+        self._lock = threading.Lock()
+
+    def _key(self, label_values):
+        if set(label_values) != set(self.labels):
+            raise ValueError('{} needs labels {}, got {}'.format(
+                self.name, self.labels, sorted(label_values)))
+        return tuple(str(label_values[label]) for label in self.labels)
+
+    def reset(self):
+        """ Forget all samples """
+        with self._lock:
+            self._samples = {}
+
+    def dump(self):
+        """ Returns samples as a json-able list of [label values, sample] """
+        with self._lock:
+            return [[list(key), self._copy(sample)] for key, sample in self._samples.items()]
+
+    @staticmethod
+    def _copy(sample):
+        return sample
+
+    @abc.abstractmethod
+    def merge(self, totals, dumped):
+        """ Add dumped samples into totals dict (label values tuple -> sample) """
+
+    def expose(self, totals):
+        """ Yield prometheus text format lines for totals """
+        yield '# HELP {} {}'.format(self.name, self.description)
+        yield '# TYPE {} {}'.format(self.name, self.TYPE)
+
+
+class Counter(Metric):
+    """ Monotonically increasing count """
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **label_values):
+        """ Increase count for label_values by amount """
+        key = self._key(label_values)
+        with self._lock:
+            self._samples[key] = self._samples.get(key, 0) + amount
+
+    def merge(self, totals, dumped):
+        for key, value in dumped:
+            key = tuple(key)
+            totals[key] = totals.get(key, 0) + value
+
+    def expose(self, totals):
+        yield from super().expose(totals)
+        for key in sorted(totals):
+            yield '{}{} {}'.format(self.name, _format_labels(zip(self.labels, key)),
+                                   _format_number(totals[key]))
+
+
+class Histogram(Metric):
+    """ Distribution of observed values, counted into cumulative buckets """
+    TYPE = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **label_values):
+        """ Record value for label_values """
+        key = self._key(label_values)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            sample = self._samples.get(key)
+            if sample is None:
+                # per bucket counts (the last is +Inf), then sum
+                sample = self._samples[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            sample[index] += 1
+            sample[-1] += value
+
+    @staticmethod
+    def _copy(sample):
+        return list(sample)
+
+    def merge(self, totals, dumped):
+        for key, sample in dumped:
+            key = tuple(key)
+            if len(sample) != len(self.buckets) + 2:
+                continue  # written with different buckets
+            total = totals.setdefault(key, [0] * (len(self.buckets) + 1) + [0.0])
+            for index, value in enumerate(sample):
+                total[index] += value
+
+    def expose(self, totals):
+        yield from super().expose(totals)
+        for key in sorted(totals):
+            sample = totals[key]
+            labels = list(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), sample):
+                cumulative += count
+                yield '{}_bucket{} {}'.format(self.name,
+                                              _format_labels(labels, [('le', _format_number(
+                                                  float(bound)))]),
+                                              cumulative)
+            yield '{}_sum{} {}'.format(self.name, _format_labels(labels),
+                                       _format_number(sample[-1]))
+            yield '{}_count{} {}'.format(self.name, _format_labels(labels), cumulative)
+
+
+class Registry():
+    """ The metrics of this process, optionally shared with other processes
+    through files in directory.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.directory = None
+        self.flush_interval = 1.0
+        self._last_flush = 0.0
+        self._flush_lock = threading.Lock()
+        self._token = uuid.uuid4().hex
+
+    def counter(self, name, description, labels=()):
+        """ Register and return a new Counter """
+        return self._register(Counter(name, description, labels))
+
+    def histogram(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        """ Register and return a new Histogram """
+        return self._register(Histogram(name, description, labels, buckets))
+
+    def _register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError('Metric {} already registered'.format(metric.name))
+        self.metrics[metric.name] = metric
+        return metric
+
+    def reset(self):
+        """ Forget all samples. A forked child starts afresh this way, as its
+        inherited samples belong to (and are reported by) the parent.
+        """
+        for metric in self.metrics.values():
+            metric.reset()
+        self._token = uuid.uuid4().hex
+        self._last_flush = 0.0
+
+    def dump(self):
+        """ Returns json-able dict of every metric's samples """
+        return {name: metric.dump() for name, metric in self.metrics.items()}
+
+    def _filename(self):
+        return Path(self.directory, 'metrics-{}-{}.json'.format(os.getpid(), self._token))
+
+    @contextmanager
+    def _directory_lock(self):
+        """ Exclusive lock on directory, among processes sharing it """
+        with open(Path(self.directory, LOCK_FILENAME), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _write(self, filename, dumped):
+        """ Atomically write dumped samples to filename """
+        fd, tmp_name = tempfile.mkstemp(dir=self.directory, prefix='.tmp_')
+        try:
+            with os.fdopen(fd, 'w') as fptr:
+                json.dump(dumped, fptr)
+            os.replace(tmp_name, filename)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+
+    @staticmethod
+    def _read(filename):
+        """ Returns samples dumped to filename, or None if unreadable """
+        try:
+            with open(filename) as fptr:
+                return json.load(fptr)
+        except (OSError, ValueError):
+            logger.warning('Skipping unreadable metrics file %s', filename)
+            return None
+
+    def _merge(self, dumps):
+        """ Returns dict of metric name -> samples merged from dumps """
+        totals = {name: {} for name in self.metrics}
+        for dumped in dumps:
+            for name, samples in dumped.items():
+                if name in self.metrics:
+                    self.metrics[name].merge(totals[name], samples)
+        return totals
+
+    def _retire(self, dumps_by_filename):
+        """ Fold samples of processes that have gone (filename -> dumped
+        samples) into the retired file, and remove their files. Call with
+        the directory locked.
+        """
+        retired_filename = Path(self.directory, RETIRED_FILENAME)
+        dumps = list(dumps_by_filename.values())
+        if retired_filename.exists():
+            dumps.append(self._read(retired_filename) or {})
+        totals = self._merge(dumps)
+        self._write(retired_filename, {name: [[list(key), sample] for key, sample in
+                                              samples.items()]
+                                       for name, samples in totals.items()})
+        for filename in dumps_by_filename:
+            Path(filename).unlink(missing_ok=True)
+
+    def flush(self, force=False):
+        """ Write this process's samples to its file in directory, at most
+        once per flush_interval unless forced.
+        """
+        if self.directory is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_flush < self.flush_interval:
+            return
+        with self._flush_lock:
+            self._last_flush = now
+            self._write(self._filename(), self.dump())
+
+    def retire(self):
+        """ Fold this process's samples into the retired file, and remove its
+        own file, as it exits. Otherwise files would pile up in directory as
+        worker processes come and go, and every scrape would read them all.
+        """
+        if self.directory is None:
+            return
+        with self._flush_lock, self._directory_lock():
+            self._retire({self._filename(): self.dump()})
+
+    def collect(self):
+        """ Returns dict of metric name -> merged samples, over every process
+        sharing directory (or just this one). Files left by processes that
+        died without retiring are retired on their behalf. Processes sharing
+        directory must share a pid namespace (i.e. run on one host) for that.
+        """
+        if self.directory is None:
+            return self._merge([self.dump()])
+        self.flush(force=True)
+        with self._directory_lock():
+            dumps = []
+            dead = {}
+            for filename in Path(self.directory).glob('metrics-*.json'):
+                match = _PROCESS_FILE_RE.match(filename.name)
+                if not match:
+                    continue
+                dumped = self._read(filename)
+                if not _pid_alive(int(match.group(1))):
+                    dead[filename] = dumped or {}
+                elif dumped is not None:
+                    dumps.append(dumped)
+            if dead:
+                logger.info('Retiring metrics of %d exited processes', len(dead))
+                self._retire(dead)
+            retired_filename = Path(self.directory, RETIRED_FILENAME)
+            if retired_filename.exists():
+                dumps.append(self._read(retired_filename) or {})
+        return self._merge(dumps)
+
+    def expose(self):
+        """ Returns all metrics in prometheus text format """
+        totals = self.collect()
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.extend(metric.expose(totals[name]))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+os.register_at_fork(after_in_child=REGISTRY.reset)
+atexit.register(REGISTRY.retire)
+
+DB_QUERY_SECONDS = REGISTRY.histogram('omnom_db_query_seconds',
+                                      'Time executing SQL statements', ['statement'])
+REQUEST_SECONDS = REGISTRY.histogram('omnom_request_seconds', 'Time handling requests',
+                                     ['endpoint', 'method'])
+REQUESTS = REGISTRY.counter('omnom_requests_total', 'Requests handled, by response status',
+                            ['endpoint', 'method', 'status'])
+RESPONSE_BYTES = REGISTRY.histogram('omnom_response_bytes', 'Size of response bodies',
+                                    ['endpoint'], buckets=SIZE_BUCKETS)
+PAGE_CACHE_REQUESTS = REGISTRY.counter('omnom_page_cache_requests_total',
+                                       'Cacheable page requests, by cache result', ['result'])
+MARKDOWN_SECONDS = REGISTRY.histogram('omnom_markdown_seconds',
+                                      'Time rendering markdown to html')
+TEMPLATE_SECONDS = REGISTRY.histogram('omnom_template_seconds', 'Time rendering templates',
+                                      ['template'])
+
+
+def statement_label(sql):
+    """ Label for a SQL statement: the statement with whitespace collapsed """
+    return ' '.join(sql.split())
+
+
+class TimedTemplate(Template):
+    """ Jinja template recording its render time """
+
+    def render(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            TEMPLATE_SECONDS.observe(time.perf_counter() - start, template=self.name)
+
+
+class TimedEnvironment(Environment):
+    """ Flask jinja environment whose templates record their render time """
+    template_class = TimedTemplate
+
+
+@bp.record_once
+def setup_registry(state):
+    """ Share metrics through METRICS_DIR, if configured """
+    directory = state.app.config.get('METRICS_DIR')
+    if directory is not None:
+        Path(directory).mkdir(parents=True, exist_ok=True)
+    REGISTRY.directory = directory
+    REGISTRY.flush_interval = state.app.config.get('METRICS_FLUSH_INTERVAL', 1.0)
+
+
+@bp.before_app_request
+def start_timer():
+    """ Note when request handling started """
+    g.metrics_start = time.perf_counter()
+
+
+@bp.after_app_request
+def record_request(response):
+    """ Record latency, status and size of the response """
+    start = g.pop('metrics_start', None)
+    if start is not None:
+        endpoint = request.endpoint or 'none'
+        REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint,
+                                method=request.method)
+        REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+        if response.content_length is not None:
+            RESPONSE_BYTES.observe(response.content_length, endpoint=endpoint)
+        cache_result = response.headers.get('X-Cache')
+        if cache_result is not None:
+            PAGE_CACHE_REQUESTS.inc(result=cache_result.lower())
+        REGISTRY.flush()
+    return response
+
+
+@bp.route('/metrics')
+def metrics():
+    """ All metrics, in prometheus text format """
+    return Response(REGISTRY.expose(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,175 @@
+#    Copyright 2021 Abigail Schubert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Versioned schema migrations.
+
+The schema version of a database is its PRAGMA user_version: the number of
+the last migration applied. Migrations live in omnom/migrations and are
+applied in order, each in its own transaction together with the version bump,
+so a failed migration leaves the database at the previous version.
+
+SQLite can't build an index without holding the write lock for the whole
+build. To keep that short, add each new index in a migration of its own:
+databases are switched to WAL mode so readers carry on meanwhile, and writers
+wait (up to busy_timeout) for just that one index.
+"""
+import importlib
+import logging
+from pathlib import Path
+import re
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = Path(__file__).parent / 'migrations'
+_MIGRATION_RE = re.compile(r'^(\d{4})_(\w+)\.(sql|py)$')
+
+
+class MigrationError(Exception):
+    """ Migrations are missing, duplicated or failed """
+
+
+class Migration():
+    """ One numbered migration script """
+
+    def __init__(self, version, name, path):
+        self.version = version
+        self.name = name
+        self.path = Path(path)
+
+    def __repr__(self):
+        return 'Migration({:04d}_{})'.format(self.version, self.name)
+
+    def apply(self, conn):
+        """ Run the migration on conn. Doesn't commit. """
+        if self.path.suffix == '.sql':
+            for statement in split_statements(self.path.read_text()):
+                conn.execute(statement)
+        else:
+            module = importlib.import_module('omnom.migrations.' + self.path.stem)
+            module.upgrade(conn)
+
+
+def split_statements(script):
+    """ Yield each complete statement of sql script. Unlike executescript,
+    this lets statements run inside an open transaction.
+    """
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            if statement.strip():
+                yield statement.strip()
+            statement = ''
+    leftover = [line for line in statement.splitlines() if not line.strip().startswith('--')]
+    if ''.join(leftover).strip():
+        raise MigrationError('Incomplete statement: {}'.format(statement.strip()))
+
+
+def find_migrations(directory=MIGRATIONS_DIR):
+    """ Returns list of the Migrations in directory, in order """
+    migrations = []
+    for path in Path(directory).iterdir():
+        match = _MIGRATION_RE.match(path.name)
+        if match:
+            migrations.append(Migration(int(match.group(1)), match.group(2), path))
+    migrations.sort(key=lambda migration: migration.version)
+    for expected, migration in enumerate(migrations, 1):
+        if migration.version != expected:
+            raise MigrationError('Expected migration {:04d}, found {}'.format(expected,
+                                                                               migration))
+    return migrations
+
+
+def schema_version(conn):
+    """ Returns the schema version of the database """
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def pending_migrations(conn, migrations=None):
+    """ Returns list of migrations not yet applied to the database """
+    if migrations is None:
+        migrations = find_migrations()
+    version = schema_version(conn)
+    return [migration for migration in migrations if migration.version > version]
+
+
+def upgrade(conn, migrations=None, busy_timeout=60.0):
+    """ Apply pending migrations to the database, waiting up to busy_timeout
+    seconds for other connections to release it. Safe to run from several
+    processes at once.
+    Returns list of migrations applied.
+    """
+    if migrations is None:
+        migrations = find_migrations()
+    if migrations and migrations[-1].version < schema_version(conn):
+        raise MigrationError('Database is at version {}, newer than this code ({})'.format(
+            schema_version(conn), migrations[-1].version))
+    if conn.in_transaction:
+        conn.commit()
+    applied = []
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None  # transactions are begun and committed explicitly below
+    try:
+        conn.execute('PRAGMA busy_timeout = {:d}'.format(int(busy_timeout * 1000)))
+        conn.execute('PRAGMA journal_mode = WAL')
+        for migration in pending_migrations(conn, migrations):
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                # another process may have got here first while we waited for the lock
+                if schema_version(conn) >= migration.version:
+                    conn.execute('ROLLBACK')
+                    continue
+                migration.apply(conn)
+                conn.execute('PRAGMA user_version = {:d}'.format(migration.version))
+                conn.execute('COMMIT')
+            except Exception as error:
+                conn.execute('ROLLBACK')
+                raise MigrationError('{} failed: {}'.format(migration, error)) from error
+            logger.info('Applied %s', migration)
+            applied.append(migration)
+        if applied:
+            conn.execute('PRAGMA optimize')
+    finally:
+        conn.isolation_level = isolation_level
+    return applied
+
+
+def reset(conn):
+    """ Drop everything in the database and set it back to version 0 """
+    if conn.in_transaction:
+        conn.commit()
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for kind in ['trigger', 'view']:
+                for (name,) in conn.execute('SELECT name FROM sqlite_master WHERE type=?',
+                                            (kind,)).fetchall():
+                    conn.execute('DROP {} IF EXISTS "{}"'.format(kind.upper(), name))
+            # virtual tables first, they drop their own shadow tables
+            for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type='table' "
+                                        "AND sql LIKE 'CREATE VIRTUAL TABLE%'").fetchall():
+                conn.execute('DROP TABLE IF EXISTS "{}"'.format(name))
+            for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type='table' "
+                                        "AND name NOT LIKE 'sqlite_%'").fetchall():
+                conn.execute('DROP TABLE IF EXISTS "{}"'.format(name))
+            conn.execute('PRAGMA user_version = 0')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    finally:
+        conn.isolation_level = isolation_level
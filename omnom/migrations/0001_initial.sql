@@ -1,16 +1,11 @@
-DROP TABLE IF EXISTS food_type;
-DROP TABLE IF EXISTS recipe;
-DROP TABLE IF EXISTS user;
-
-PRAGMA foreign_keys=ON;
-
-CREATE TABLE food_type (
+-- The original tables. IF NOT EXISTS, so that databases created before
+-- migrations existed are adopted as they are.
+CREATE TABLE IF NOT EXISTS food_type (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     food_type TEXT NOT NULL UNIQUE
 );
 
-
-CREATE TABLE recipe (
+CREATE TABLE IF NOT EXISTS recipe (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     name TEXT NOT NULL,
     description TEXT,
@@ -21,7 +16,7 @@ CREATE TABLE recipe (
     FOREIGN KEY (type_id) REFERENCES food_type (id)
 );
 
-CREATE TABLE user (
+CREATE TABLE IF NOT EXISTS user (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     name TEXT NOT NULL UNIQUE,
     password TEXT NOT NULL
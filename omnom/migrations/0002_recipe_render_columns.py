@@ -0,0 +1,57 @@
+#    Copyright 2021 Abigail Schubert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Add rendered html and version columns to recipe.
+
+updated_at defaults to the current time, which ALTER TABLE ADD COLUMN can't
+do, so the table is rebuilt with the new columns instead.
+"""
+
+RECIPE_TABLE = '''
+CREATE TABLE recipe_new (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    description TEXT,
+    type_id INTEGER,
+    photo TEXT,
+    ingredients TEXT,
+    instructions TEXT,
+    ingredients_html TEXT,
+    instructions_html TEXT,
+    render_version TEXT,
+    version INTEGER NOT NULL DEFAULT 1,
+    updated_at INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+    FOREIGN KEY (type_id) REFERENCES food_type (id)
+)
+'''
+NEW_COLUMNS = {'ingredients_html', 'instructions_html', 'render_version', 'version',
+               'updated_at'}
+
+
+def upgrade(conn):
+    """ Rebuild recipe with the new columns, unless it already has them """
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(recipe)')]
+    if NEW_COLUMNS.issubset(columns):
+        return
+    sequence = conn.execute("SELECT seq FROM sqlite_sequence WHERE name='recipe'").fetchone()
+    conn.execute(RECIPE_TABLE)
+    new_columns = {row[1] for row in conn.execute('PRAGMA table_info(recipe_new)')}
+    copied = ', '.join(column for column in columns if column in new_columns)
+    conn.execute('INSERT INTO recipe_new ({0}) SELECT {0} FROM recipe'.format(copied))
+    conn.execute('DROP TABLE recipe')
+    conn.execute('ALTER TABLE recipe_new RENAME TO recipe')
+    if sequence is not None:
+        # keep ids of deleted recipes from being reused
+        conn.execute("UPDATE sqlite_sequence SET seq=max(seq, ?) WHERE name='recipe'",
+                     (sequence[0],))
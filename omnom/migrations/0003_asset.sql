@@ -0,0 +1,26 @@
+-- Files in the assets dir, with the number of recipes using each one.
+CREATE TABLE IF NOT EXISTS asset (
+    filename TEXT PRIMARY KEY,
+    refcount INTEGER NOT NULL DEFAULT 0
+);
+
+-- photos already in use by recipes
+INSERT OR IGNORE INTO asset (filename, refcount)
+SELECT photo, count(*) FROM recipe WHERE photo IS NOT NULL GROUP BY photo;
+
+DROP TRIGGER IF EXISTS asset_ref_insert;
+CREATE TRIGGER asset_ref_insert AFTER INSERT ON recipe WHEN new.photo IS NOT NULL BEGIN
+    UPDATE asset SET refcount = refcount + 1 WHERE filename = new.photo;
+END;
+
+DROP TRIGGER IF EXISTS asset_ref_delete;
+CREATE TRIGGER asset_ref_delete AFTER DELETE ON recipe WHEN old.photo IS NOT NULL BEGIN
+    UPDATE asset SET refcount = refcount - 1 WHERE filename = old.photo;
+END;
+
+DROP TRIGGER IF EXISTS asset_ref_update;
+CREATE TRIGGER asset_ref_update AFTER UPDATE OF photo ON recipe
+WHEN old.photo IS NOT new.photo BEGIN
+    UPDATE asset SET refcount = refcount - 1 WHERE filename = old.photo;
+    UPDATE asset SET refcount = refcount + 1 WHERE filename = new.photo;
+END;
@@ -0,0 +1,26 @@
+-- Single row, bumped by any change to the recipe table.
+CREATE TABLE IF NOT EXISTS book_version (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER NOT NULL DEFAULT 1,
+    updated_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+);
+
+INSERT OR IGNORE INTO book_version (id) VALUES (1);
+
+DROP TRIGGER IF EXISTS book_version_insert;
+CREATE TRIGGER book_version_insert AFTER INSERT ON recipe BEGIN
+    UPDATE book_version SET version = version + 1,
+                            updated_at = CAST(strftime('%s', 'now') AS INTEGER);
+END;
+
+DROP TRIGGER IF EXISTS book_version_update;
+CREATE TRIGGER book_version_update AFTER UPDATE ON recipe BEGIN
+    UPDATE book_version SET version = version + 1,
+                            updated_at = CAST(strftime('%s', 'now') AS INTEGER);
+END;
+
+DROP TRIGGER IF EXISTS book_version_delete;
+CREATE TRIGGER book_version_delete AFTER DELETE ON recipe BEGIN
+    UPDATE book_version SET version = version + 1,
+                            updated_at = CAST(strftime('%s', 'now') AS INTEGER);
+END;
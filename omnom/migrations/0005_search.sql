@@ -0,0 +1,36 @@
+-- Full text search index over recipes. Safe to re-run on an existing db:
+-- it drops and rebuilds the index from the recipe table.
+DROP TRIGGER IF EXISTS recipe_fts_insert;
+DROP TRIGGER IF EXISTS recipe_fts_delete;
+DROP TRIGGER IF EXISTS recipe_fts_update;
+DROP TABLE IF EXISTS recipe_fts;
+
+CREATE VIRTUAL TABLE recipe_fts USING fts5(
+    name,
+    description,
+    ingredients,
+    instructions,
+    content='recipe',
+    content_rowid='id',
+    tokenize='porter unicode61'
+);
+
+CREATE TRIGGER recipe_fts_insert AFTER INSERT ON recipe BEGIN
+    INSERT INTO recipe_fts (rowid, name, description, ingredients, instructions)
+    VALUES (new.id, new.name, new.description, new.ingredients, new.instructions);
+END;
+
+CREATE TRIGGER recipe_fts_delete AFTER DELETE ON recipe BEGIN
+    INSERT INTO recipe_fts (recipe_fts, rowid, name, description, ingredients, instructions)
+    VALUES ('delete', old.id, old.name, old.description, old.ingredients, old.instructions);
+END;
+
+CREATE TRIGGER recipe_fts_update AFTER UPDATE OF name, description, ingredients, instructions
+ON recipe BEGIN
+    INSERT INTO recipe_fts (recipe_fts, rowid, name, description, ingredients, instructions)
+    VALUES ('delete', old.id, old.name, old.description, old.ingredients, old.instructions);
+    INSERT INTO recipe_fts (rowid, name, description, ingredients, instructions)
+    VALUES (new.id, new.name, new.description, new.ingredients, new.instructions);
+END;
+
+INSERT INTO recipe_fts (recipe_fts) VALUES ('rebuild');
@@ -0,0 +1,3 @@
+-- Recipes by category. Index entries end with the rowid (id), so this also
+-- serves category pages in id order and per category counts.
+CREATE INDEX IF NOT EXISTS recipe_type_id ON recipe (type_id);
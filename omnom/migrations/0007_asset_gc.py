@@ -0,0 +1,74 @@
+#    Copyright 2021 Abigail Schubert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Track asset sizes, and since when each asset has been unused, so unused
+files can be collected once they've been unused for a grace period.
+
+ALTER TABLE ADD COLUMN fails if the column exists, so columns are only added
+to databases that lack them.
+"""
+from omnom.migrate import split_statements
+
+
+NEW_COLUMNS = {'size': 'INTEGER', 'unreferenced_at': 'INTEGER'}
+
+# Reference counting as before, also tracking photos that weren't uploaded
+# through the app (e.g. imported), and stamping assets as they become unused.
+TRIGGERS = '''
+-- Only unused assets are indexed, so finding garbage doesn't scan the rest
+CREATE INDEX IF NOT EXISTS asset_unreferenced ON asset (unreferenced_at)
+WHERE unreferenced_at IS NOT NULL;
+
+DROP TRIGGER IF EXISTS asset_ref_insert;
+CREATE TRIGGER asset_ref_insert AFTER INSERT ON recipe WHEN new.photo IS NOT NULL BEGIN
+    INSERT OR IGNORE INTO asset (filename) VALUES (new.photo);
+    UPDATE asset SET refcount = refcount + 1, unreferenced_at = NULL
+    WHERE filename = new.photo;
+END;
+
+DROP TRIGGER IF EXISTS asset_ref_delete;
+CREATE TRIGGER asset_ref_delete AFTER DELETE ON recipe WHEN old.photo IS NOT NULL BEGIN
+    UPDATE asset SET refcount = refcount - 1,
+                     unreferenced_at = CASE WHEN refcount <= 1
+                                            THEN CAST(strftime('%s', 'now') AS INTEGER) END
+    WHERE filename = old.photo;
+END;
+
+DROP TRIGGER IF EXISTS asset_ref_update;
+CREATE TRIGGER asset_ref_update AFTER UPDATE OF photo ON recipe
+WHEN old.photo IS NOT new.photo BEGIN
+    UPDATE asset SET refcount = refcount - 1,
+                     unreferenced_at = CASE WHEN refcount <= 1
+                                            THEN CAST(strftime('%s', 'now') AS INTEGER) END
+    WHERE filename = old.photo;
+    INSERT OR IGNORE INTO asset (filename) SELECT new.photo WHERE new.photo IS NOT NULL;
+    UPDATE asset SET refcount = refcount + 1, unreferenced_at = NULL
+    WHERE filename = new.photo;
+END;
+'''
+
+
+def upgrade(conn):
+    """ Add the new asset columns, unless it already has them, and replace
+    the reference counting triggers
+    """
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(asset)')}
+    if not set(NEW_COLUMNS).issubset(columns):
+        for column, column_type in NEW_COLUMNS.items():
+            if column not in columns:
+                conn.execute('ALTER TABLE asset ADD COLUMN {} {}'.format(column, column_type))
+        conn.execute("UPDATE asset SET unreferenced_at = CAST(strftime('%s', 'now') AS INTEGER) "
+                     'WHERE refcount <= 0')
+    for statement in split_statements(TRIGGERS):
+        conn.execute(statement)
@@ -0,0 +1,2 @@
+-- Recipes by photo, so assets can be renamed without scanning every recipe
+CREATE INDEX IF NOT EXISTS recipe_photo ON recipe (photo) WHERE photo IS NOT NULL;
@@ -0,0 +1,32 @@
+-- Number of recipes of each food type, kept up to date by triggers, so the
+-- category sidebar doesn't count the whole recipe table on every page.
+CREATE TABLE IF NOT EXISTS food_type_count (
+    type_id INTEGER PRIMARY KEY,
+    recipe_count INTEGER NOT NULL DEFAULT 0
+);
+
+DELETE FROM food_type_count;
+INSERT INTO food_type_count (type_id, recipe_count)
+SELECT type_id, count(*) FROM recipe WHERE type_id IS NOT NULL GROUP BY type_id;
+
+DROP TRIGGER IF EXISTS food_type_count_insert;
+CREATE TRIGGER food_type_count_insert AFTER INSERT ON recipe
+WHEN new.type_id IS NOT NULL BEGIN
+    INSERT OR IGNORE INTO food_type_count (type_id) VALUES (new.type_id);
+    UPDATE food_type_count SET recipe_count = recipe_count + 1 WHERE type_id = new.type_id;
+END;
+
+DROP TRIGGER IF EXISTS food_type_count_delete;
+CREATE TRIGGER food_type_count_delete AFTER DELETE ON recipe
+WHEN old.type_id IS NOT NULL BEGIN
+    UPDATE food_type_count SET recipe_count = recipe_count - 1 WHERE type_id = old.type_id;
+END;
+
+DROP TRIGGER IF EXISTS food_type_count_update;
+CREATE TRIGGER food_type_count_update AFTER UPDATE OF type_id ON recipe
+WHEN old.type_id IS NOT new.type_id BEGIN
+    UPDATE food_type_count SET recipe_count = recipe_count - 1 WHERE type_id = old.type_id;
+    INSERT OR IGNORE INTO food_type_count (type_id)
+    SELECT new.type_id WHERE new.type_id IS NOT NULL;
+    UPDATE food_type_count SET recipe_count = recipe_count + 1 WHERE type_id = new.type_id;
+END;
@@ -0,0 +1,20 @@
+#    Copyright 2021 Abigail Schubert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Database migrations, applied in order by omnom.migrate.
+
+Each is a NNNN_name.sql script or a NNNN_name.py module with an upgrade(conn)
+function. Migrations must also work on databases created before they existed
+(user_version 0), so create things IF NOT EXISTS or check first.
+"""
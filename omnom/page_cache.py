@@ -0,0 +1,206 @@
+#    Copyright 2021 Abigail Schubert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Cache of rendered pages.
+
+Entries are page bodies stored under a key, with a set of tags naming the
+data the page was rendered from (e.g. 'recipe:3'). Invalidating a tag drops
+every page rendered from it.
+"""
+import abc
+from collections import OrderedDict, defaultdict
+import logging
+import sqlite3
+import threading
+import time
+from omnom.db import LocalConnections
+
+logger = logging.getLogger(__name__)
+
+
+class PageCache(abc.ABC):
+    """ Base page cache. Subclasses do the storing. Hits and misses are
+    counted by the metrics of the requests served.
+    """
+
+    def get(self, key):
+        """ Returns cached body (bytes) for key, or None """
+        return self._get(key)
+
+    def set(self, key, body, tags):
+        """ Cache body (bytes) under key, tagged with tags """
+        self._set(key, body, frozenset(tags))
+
+    @abc.abstractmethod
+    def invalidate_tags(self, tags):
+        """ Drop every page tagged with any of tags """
+
+    @abc.abstractmethod
+    def clear(self):
+        """ Drop every page """
+
+    @abc.abstractmethod
+    def _get(self, key):
+        """ Returns cached body for key, or None """
+
+    @abc.abstractmethod
+    def _set(self, key, body, tags):
+        """ Store body under key, tags is a frozenset """
+
+
+class MemoryPageCache(PageCache):
+    """ In process LRU page cache holding at most max_bytes of page bodies """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (body, tags)
+        self._keys_by_tag = defaultdict(set)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def _set(self, key, body, tags):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (body, tags)
+            self._size += len(body)
+            for tag in tags:
+                self._keys_by_tag[tag].add(key)
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        """ Drop key, caller must hold lock """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        body, tags = entry
+        self._size -= len(body)
+        for tag in tags:
+            keys = self._keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_tag[tag]
+
+    def invalidate_tags(self, tags):
+        with self._lock:
+            for tag in tags:
+                for key in list(self._keys_by_tag.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_tag.clear()
+            self._size = 0
+
+
+class DiskPageCache(PageCache):
+    """ Page cache in a sqlite file, which several worker processes can share.
+    Holds at most about max_bytes of page bodies, evicting the oldest first.
+    Hit/miss counters are per process.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS page (
+            key TEXT PRIMARY KEY,
+            body BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            stored REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS page_stored ON page (stored);
+        CREATE TABLE IF NOT EXISTS page_tag (
+            tag TEXT NOT NULL,
+            key TEXT NOT NULL,
+            PRIMARY KEY (tag, key)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS page_tag_key ON page_tag (key);
+        CREATE TRIGGER IF NOT EXISTS page_delete AFTER DELETE ON page BEGIN
+            DELETE FROM page_tag WHERE key = old.key;
+        END;
+    '''
+
+    def __init__(self, filename, max_bytes):
+        self.filename = str(filename)
+        self.max_bytes = max_bytes
+        self._connections = LocalConnections(self.filename, self.SCHEMA)
+
+    def _connect(self):
+        """ Get this thread's connection to the cache db """
+        return self._connections.get()
+
+    def _get(self, key):
+        try:
+            ret = self._connect().execute('SELECT body FROM page WHERE key=?', (key,)).fetchone()
+        except sqlite3.Error:
+            logger.exception('Page cache read failed')
+            return None
+        return None if ret is None else ret[0]
+
+    def _set(self, key, body, tags):
+        if len(body) > self.max_bytes:
+            return
+        try:
+            with self._connect() as conn:
+                conn.execute('DELETE FROM page WHERE key=?', (key,))
+                conn.execute('INSERT INTO page (key, body, size, stored) VALUES (?, ?, ?, ?)',
+                             (key, body, len(body), time.time()))
+                conn.executemany('INSERT OR IGNORE INTO page_tag (tag, key) VALUES (?, ?)',
+                                 ((tag, key) for tag in tags))
+                conn.execute('DELETE FROM page WHERE key IN ('
+                             '  SELECT key FROM ('
+                             '    SELECT key, SUM(size) OVER (ORDER BY stored DESC) AS total'
+                             '    FROM page)'
+                             '  WHERE total > ?)', (self.max_bytes,))
+        except sqlite3.Error:
+            logger.exception('Page cache write failed')
+
+    def invalidate_tags(self, tags):
+        tags = list(tags)
+        if not tags:
+            return
+        try:
+            with self._connect() as conn:
+                conn.execute('DELETE FROM page WHERE key IN (SELECT key FROM page_tag '
+                             'WHERE tag IN ({}))'.format(','.join('?' * len(tags))), tags)
+        except sqlite3.Error:
+            logger.exception('Page cache invalidation failed')
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM page')
+
+
+def make_page_cache(config):
+    """ Create the page cache configured by PAGE_CACHE ('memory', 'disk' or
+    None to disable), PAGE_CACHE_MAX_BYTES and (for 'disk') PAGE_CACHE_FILE.
+    """
+    backend = config.get('PAGE_CACHE')
+    if not backend:
+        return None
+    if backend == 'memory':
+        return MemoryPageCache(config['PAGE_CACHE_MAX_BYTES'])
+    if backend == 'disk':
+        return DiskPageCache(config['PAGE_CACHE_FILE'], config['PAGE_CACHE_MAX_BYTES'])
+    raise ValueError('Unknown PAGE_CACHE backend {!r}'.format(backend))
@@ -0,0 +1,195 @@
+#    Copyright 2021 Abigail Schubert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Password hashing and login throttling.
+
+Password hashes are deliberately slow to compute, so they run on a small
+pool of threads of their own: however many logins arrive at once, only
+HASH_WORKERS hashes use the cpu, and once HASH_QUEUE_DEPTH more are waiting
+new ones are turned away (HashingBusyError) rather than queued.
+"""
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import logging
+import threading
+import time
+from flask import current_app
+from werkzeug.security import (DEFAULT_PBKDF2_ITERATIONS, check_password_hash,
+                               generate_password_hash)
+
+logger = logging.getLogger(__name__)  # pylint:disable=invalid-name
+
+_setup_lock = threading.Lock()
+
+
+class HashingBusyError(Exception):
+    """ Too many password hashes are running or waiting already """
+
+
+class HashExecutor():
+    """ Thread pool running at most max_workers hashes, with at most
+    max_queue more waiting.
+    """
+
+    def __init__(self, max_workers, max_queue):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='omnom-hash')
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+
+    def run(self, func, *args, timeout=None):
+        """ Run func(*args) on the pool and return its result. Raises
+        HashingBusyError straight away if the pool is full, or if the
+        result takes longer than timeout seconds.
+        """
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusyError('Password hashing queue is full')
+        try:
+            future = self._executor.submit(func, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError as error:
+            raise HashingBusyError('Password hashing timed out') from error
+
+    def shutdown(self):
+        """ Stop the worker threads once queued hashes finish """
+        self._executor.shutdown()
+
+
+def _get_executor():
+    """ Get the app's bounded pool of password hashing threads """
+    with _setup_lock:
+        executor = current_app.extensions.get('omnom_hash_workers')
+        if executor is None:
+            executor = HashExecutor(current_app.config['HASH_WORKERS'],
+                                    current_app.config['HASH_QUEUE_DEPTH'])
+            current_app.extensions['omnom_hash_workers'] = executor
+    return executor
+
+
+def make_hash(password, method=None):
+    """ Hash password with method (default: the app's PASSWORD_HASH_METHOD),
+    on the calling thread.
+    """
+    if method is None:
+        method = current_app.config['PASSWORD_HASH_METHOD']
+    return generate_password_hash(password, method=method)
+
+
+def hash_password(password):
+    """ Hash password on the hashing pool. Raises HashingBusyError if it's full. """
+    return _get_executor().run(generate_password_hash, password,
+                               current_app.config['PASSWORD_HASH_METHOD'],
+                               timeout=current_app.config['HASH_TIMEOUT'])
+
+
+def check_password(pwhash, password):
+    """ Check password against pwhash on the hashing pool. Raises
+    HashingBusyError if it's full.
+    """
+    return _get_executor().run(check_password_hash, pwhash, password,
+                               timeout=current_app.config['HASH_TIMEOUT'])
+
+
+def _parse_method(method):
+    """ Returns (algorithm, iterations) of werkzeug hash method, filling in
+    werkzeug's defaults for pbkdf2: 'pbkdf2:sha256' and the hash's stored
+    'pbkdf2:sha256:260000' are the same. Iterations are None for other methods.
+    """
+    parts = method.split(':')
+    if parts[0] != 'pbkdf2':
+        return method, None
+    if len(parts) > 3:
+        raise ValueError('Bad password hash method {!r}'.format(method))
+    algorithm = parts[1] if len(parts) > 1 and parts[1] else 'sha256'
+    iterations = int(parts[2]) if len(parts) > 2 else DEFAULT_PBKDF2_ITERATIONS
+    return 'pbkdf2:' + algorithm, iterations
+
+
+def needs_rehash(pwhash):
+    """ True if pwhash wasn't made with the app's current PASSWORD_HASH_METHOD """
+    try:
+        stored = _parse_method(pwhash.split('$', 1)[0])
+    except ValueError:
+        return True
+    return stored != _parse_method(current_app.config['PASSWORD_HASH_METHOD'])
+
+
+class AttemptThrottle():
+    """ Counts recent failed attempts per key (e.g. user name or client
+    address) in a sliding window of window seconds. Keys with max_attempts
+    failures in the window are blocked. Remembers at most max_keys keys.
+    Counts are per process.
+    """
+
+    def __init__(self, max_attempts, window, max_keys=10000):
+        self.max_attempts = max_attempts
+        self.window = window
+        self.max_keys = max_keys
+        self._failures = OrderedDict()  # key -> deque of failure times
+        self._lock = threading.Lock()
+
+    def _recent(self, key, now):
+        failures = self._failures.get(key)
+        if failures is None:
+            return None
+        while failures and failures[0] <= now - self.window:
+            failures.popleft()
+        if not failures:
+            del self._failures[key]
+            return None
+        return failures
+
+    def is_blocked(self, *keys):
+        """ True if any of keys has too many recent failures """
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                failures = self._recent(key, now)
+                if failures is not None and len(failures) >= self.max_attempts:
+                    return True
+        return False
+
+    def failed(self, *keys):
+        """ Record a failed attempt for each of keys """
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                failures = self._recent(key, now)
+                if failures is None:
+                    failures = self._failures[key] = deque(maxlen=self.max_attempts)
+                failures.append(now)
+                self._failures.move_to_end(key)
+            while len(self._failures) > self.max_keys:
+                self._failures.popitem(last=False)
+
+    def reset(self, *keys):
+        """ Forget failures of keys, e.g. after a successful login """
+        with self._lock:
+            for key in keys:
+                self._failures.pop(key, None)
+
+
+def get_login_throttle():
+    """ Get the app's AttemptThrottle for logins and registrations """
+    with _setup_lock:
+        throttle = current_app.extensions.get('omnom_login_throttle')
+        if throttle is None:
+            throttle = AttemptThrottle(current_app.config['LOGIN_MAX_ATTEMPTS'],
+                                       current_app.config['LOGIN_ATTEMPT_WINDOW'])
+            current_app.extensions['omnom_login_throttle'] = throttle
+    return throttle
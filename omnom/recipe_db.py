@@ -13,10 +13,13 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """ This file contains the recipe db connections """
+import html
 import json
 import logging
+import threading
 import attr
-from omnom.db import OmnomDB
+from omnom.db import OmnomDB, register_cache
+from omnom.render import process_markdown, render_version
 
 logger = logging.getLogger(__name__)
 
@@ -33,6 +36,12 @@ class RecipeEntry():
     photo = attr.ib(default=None)
     ingredients = attr.ib(default='')
     instructions = attr.ib(default='')
+    ingredients_html = attr.ib(default=None)
+    instructions_html = attr.ib(default=None)
+    render_version = attr.ib(default=None)
+    version = attr.ib(default=None)
+    updated_at = attr.ib(default=None)
+    food_type = attr.ib(default=None)  # name of type_id, when queried along with the recipe
 
     @classmethod
     def from_dict(cls, recipe_dict):
@@ -46,56 +55,188 @@ class RecipeEntry():
             new_recipe.ingredients = recipe_dict['ingredients']
         if 'instructions' in recipe_dict.keys():
             new_recipe.instructions = recipe_dict['instructions']
+        for optional_field in ('ingredients_html', 'instructions_html', 'render_version',
+                               'version', 'updated_at', 'food_type'):
+            if optional_field in recipe_dict.keys():
+                setattr(new_recipe, optional_field, recipe_dict[optional_field])
         return new_recipe
 
+    def render(self):
+        """ Render ingredients and instructions into sanitized html. """
+        self.ingredients_html = process_markdown(self.ingredients)
+        self.instructions_html = process_markdown(self.instructions)
+        self.render_version = render_version()
+
+
+@attr.s(kw_only=True)
+class RecipePage():
+    """ One page of recipes, with cursors for the neighbouring pages.
+    next_cursor/prev_cursor are None when there is no such page.
+    """
+    # pylint: disable=too-few-public-methods
+
+    recipes = attr.ib(factory=list)
+    next_cursor = attr.ib(default=None)
+    prev_cursor = attr.ib(default=None)
+
+
+class FoodTypeCache():
+    """ Process wide cache of the food_type table, which rarely changes.
+
+    PRAGMA data_version only tells a connection whether *other* connections
+    have committed since it last asked, so each (long lived, pooled)
+    connection keeps its own snapshot and revalidates it with that pragma on
+    every read. Changes made through the connection itself don't show up
+    there, so writers call invalidate(), which drops every snapshot in the
+    process.
+    """
+
+    def __init__(self):
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        """ Force every connection to reload food types on next use """
+        with self._lock:
+            self._generation += 1
+
+    def get(self, conn):
+        """ Returns (types by id, ids by type name) for conn """
+        generation = self._generation
+        data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+        snapshot = getattr(conn, 'food_type_snapshot', None)
+        if snapshot is None or snapshot[:2] != (data_version, generation):
+            types = {row['id']: row['food_type']
+                     for row in conn.execute('SELECT id, food_type from food_type')}
+            ids = {food_type: type_id for type_id, food_type in types.items()}
+            snapshot = conn.food_type_snapshot = (data_version, generation, types, ids)
+        return snapshot[2:]
+
+
+@attr.s(kw_only=True)
+class Category():
+    """ A food type with the number of recipes in it """
+    # pylint: disable=too-few-public-methods
+
+    id = attr.ib()  # pylint: disable=invalid-name
+    name = attr.ib()
+    recipe_count = attr.ib(default=0)
+
+
+@attr.s(kw_only=True)
+class SearchResult():
+    """ A recipe matching a search, with an html snippet highlighting the match """
+    # pylint: disable=too-few-public-methods
+
+    recipe = attr.ib()
+    snippet = attr.ib(default='')
+
 
 class RecipeDB(OmnomDB):
     """ Interface to the database for storing recipes """
 
     NONE_FOOD_TYPE = 'None'
+    PAGE_SIZE = 20
+    # relative bm25 weights of the name, description, ingredients and instructions columns
+    SEARCH_WEIGHTS = (10.0, 5.0, 2.0, 1.0)
+    # snippet() marks matches with these, we swap them for <mark> after escaping
+    _MATCH_START = '\x02'
+    _MATCH_END = '\x03'
+    _food_types = register_cache(FoodTypeCache())
+    # Recipe fields that can be projected (see get_recipe_fields), and their columns
+    FIELD_COLUMNS = {
+        'id': 'recipe.id',
+        'name': 'recipe.name',
+        'description': 'recipe.description',
+        'type_id': 'recipe.type_id',
+        'food_type': 'food_type.food_type',
+        'photo': 'recipe.photo',
+        'ingredients': 'recipe.ingredients',
+        'instructions': 'recipe.instructions',
+        'ingredients_html': 'recipe.ingredients_html',
+        'instructions_html': 'recipe.instructions_html',
+        'version': 'recipe.version',
+        'updated_at': 'recipe.updated_at',
+    }
+    # Projected by default: everything but the (large) ingredients and instructions
+    DEFAULT_FIELDS = ('id', 'name', 'description', 'type_id', 'food_type', 'photo', 'version',
+                      'updated_at')
+    _HTML_FIELDS = {'ingredients_html': 'ingredients', 'instructions_html': 'instructions'}
 
-    def __init__(self, db_filename, init_db=False):
-        """ Connect to sqlite db located at db_filename """
-        super().__init__(db_filename=db_filename, init_db=init_db)
+    def __init__(self, db_filename=None, init_db=False, conn=None, on_change=None,
+                 slow_query_log=None):
+        """ Connect to sqlite db located at db_filename (or use existing conn).
+        on_change is called with tags naming what changed after each write:
+        'recipes' (the list of recipes), 'recipe:<id#>' or 'food_types'.
+        """
+        super().__init__(db_filename=db_filename, init_db=init_db, conn=conn,
+                         slow_query_log=slow_query_log)
+        self.on_change = on_change
 
     def add_type(self, food_type):
-        """ Add a food type to the database. """
-        self._db_insert('INSERT INTO food_type (food_type) VALUES (?)', (food_type,))
+        """ Add a food type to the database. Returns its id# """
+        type_id = self._db_insert('INSERT INTO food_type (food_type) VALUES (?)', (food_type,))
+        self._food_types.invalidate()
+        self._changed('food_types')
         logging.debug('Added %s into food_type table', food_type)
+        return type_id
+
+    def add_types(self, food_types):
+        """ Add many food types to the database in one transaction.
+        Returns list of their new id#s.
+        """
+        type_ids = self._db_insert_many('INSERT INTO food_type (food_type) VALUES (?)',
+                                        ((food_type,) for food_type in food_types))
+        self._food_types.invalidate()
+        self._changed('food_types')
+        return type_ids
 
     def get_type_id(self, food_type):
         """ Get food type given name. """
-        cursor = self._db_query('SELECT id from food_type WHERE food_type=?', (food_type,))
-        ret = cursor.fetchone()
-        if ret is None:
-            return ret
-        return ret[0]
+        _, type_ids = self._food_types.get(self.conn)
+        return type_ids.get(food_type)
 
     def get_food_type(self, type_id):
         """ Get food type given id# """
-        cursor = self._db_query('SELECT food_type from food_type WHERE id=?', (type_id,))
-        ret = cursor.fetchone()
-        if ret is None:
+        types, _ = self._food_types.get(self.conn)
+        try:
+            return types.get(int(type_id), self.NONE_FOOD_TYPE)
+        except (TypeError, ValueError):
             return self.NONE_FOOD_TYPE
-        return ret[0]
 
     def get_all_types(self):
         """ Return dict of food types """
-        cursor = self._db_query('SELECT * from food_type')
-        ret = cursor.fetchall()
-        food_types = {}
-        for row in ret:
-            food_types[row['id']] = row['food_type']
-        return food_types
+        types, _ = self._food_types.get(self.conn)
+        return dict(types)
+
+    _INSERT_RECIPE_SQL = ('INSERT INTO recipe (name, description, type_id, ingredients, '
+                          'instructions, photo, ingredients_html, instructions_html, '
+                          'render_version) VALUES (?,?,?,?,?,?,?,?,?)')
+
+    @staticmethod
+    def _recipe_insert_args(recipe):
+        """ Render recipe and return the args tuple for _INSERT_RECIPE_SQL """
+        recipe.render()
+        return (recipe.name, recipe.description, recipe.type_id,
+                recipe.ingredients, recipe.instructions, recipe.photo,
+                recipe.ingredients_html, recipe.instructions_html, recipe.render_version)
 
     def add_recipe(self, recipe):
         """ Add a recipe to the database """
-        sql = ('INSERT INTO recipe (name, description, type_id, ingredients, instructions, photo) '
-               'VALUES (?,?,?,?,?,?)')
-        recipe_id = self._db_insert(sql, (recipe.name, recipe.description, recipe.type_id,
-                                          recipe.ingredients, recipe.instructions, recipe.photo))
+        recipe_id = self._db_insert(self._INSERT_RECIPE_SQL, self._recipe_insert_args(recipe))
+        self._changed('recipes')
         return recipe_id
 
+    def add_recipes(self, recipes):
+        """ Add many recipes to the database in one transaction. recipes can be
+        any iterable of RecipeEntry, it is consumed lazily.
+        Returns list of their new id#s.
+        """
+        recipe_ids = self._db_insert_many(self._INSERT_RECIPE_SQL,
+                                          map(self._recipe_insert_args, recipes))
+        self._changed('recipes')
+        return recipe_ids
+
     def get_recipe(self, recipe_id):
         """ Get full recipe given recipe_id# """
         cursor = self._db_query('SELECT * from recipe WHERE id=?', (recipe_id,))
@@ -106,16 +247,42 @@ class RecipeDB(OmnomDB):
 
     def update_recipe(self, recipe):
         """ Update recipe in db """
+        recipe.render()
         sql = ('UPDATE recipe SET name=?, description=?, type_id=?, ingredients=?, '
-               'instructions=?, photo=? WHERE id=?')
+               'instructions=?, photo=?, ingredients_html=?, instructions_html=?, '
+               'render_version=?, version=version + 1, '
+               "updated_at=CAST(strftime('%s', 'now') AS INTEGER) WHERE id=?")
         self._db_insert(sql, (recipe.name, recipe.description, recipe.type_id,
-                              recipe.ingredients, recipe.instructions,
-                              recipe.photo, recipe.id))
+                              recipe.ingredients, recipe.instructions, recipe.photo,
+                              recipe.ingredients_html, recipe.instructions_html,
+                              recipe.render_version, recipe.id))
+        self._changed('recipes', 'recipe:{}'.format(recipe.id))
+
+    def get_recipe_version(self, recipe_id):
+        """ Get (version, updated_at) of recipe_id#, or None if it doesn't
+        exist. version goes up on every change, updated_at is a unix time.
+        """
+        cursor = self._db_query('SELECT version, updated_at from recipe WHERE id=?', (recipe_id,))
+        ret = cursor.fetchone()
+        if ret is None:
+            return None
+        return tuple(ret)
+
+    def get_book_version(self):
+        """ Get (version, updated_at) of the recipe table as a whole, which
+        change whenever any recipe is added, changed or deleted.
+        """
+        cursor = self._db_query('SELECT version, updated_at from book_version WHERE id=1')
+        ret = cursor.fetchone()
+        if ret is None:
+            return (0, None)
+        return tuple(ret)
 
     def delete_recipe(self, recipe_id):
         """ Delete recipe from database """
         self.conn.execute('DELETE FROM recipe WHERE id = ?', (recipe_id,))
-        self.conn.commit()
+        self._commit()
+        self._changed('recipes', 'recipe:{}'.format(recipe_id))
 
     def get_all_recipes(self):
         """ Get all recipes from the db """
@@ -125,3 +292,204 @@ class RecipeDB(OmnomDB):
             recipe = RecipeEntry.from_dict(recipe_row)
             recipes.append(recipe)
         return recipes
+
+    def render_stale_recipes(self, after_id=0, limit=100, force=False):
+        """ Re-render stored html for up to limit recipes with id > after_id
+        whose html is missing or was produced by an older renderer (or all of
+        them if force). Returns list of re-rendered ids, empty when done.
+        """
+        sql = 'SELECT id, ingredients, instructions FROM recipe WHERE id > ? '
+        args = (after_id,)
+        if not force:
+            sql += 'AND (render_version IS NULL OR render_version != ?) '
+            args += (render_version(),)
+        sql += 'ORDER BY id LIMIT ?'
+        rows = self._db_query(sql, args + (limit,)).fetchall()
+        updates = [(process_markdown(row['ingredients']), process_markdown(row['instructions']),
+                    render_version(), row['id']) for row in rows]
+        self.conn.executemany('UPDATE recipe SET ingredients_html=?, instructions_html=?, '
+                              'render_version=?, version=version + 1, '
+                              "updated_at=CAST(strftime('%s', 'now') AS INTEGER) WHERE id=?",
+                              updates)
+        self._commit()
+        self._changed(*('recipe:{}'.format(row['id']) for row in rows))
+        logger.debug('Rendered html for %d recipes', len(updates))
+        return [row['id'] for row in rows]
+
+    def iter_recipes(self):
+        """ Iterate over every recipe (including ingredients/instructions) in
+        id order. Rows are fetched as the iterator advances, rather than all
+        loaded up front.
+        """
+        cursor = self._db_query('SELECT id, name, description, type_id, photo, ingredients, '
+                                'instructions from recipe ORDER BY id')
+        for recipe_row in cursor:
+            yield RecipeEntry.from_dict(recipe_row)
+
+    def get_recipes_page(self, after_id=None, before_id=None, limit=PAGE_SIZE, order='asc',
+                         type_id=None):
+        """ Get one page of recipes (without ingredients/instructions) ordered
+        by id, along with their food type names. Pass after_id to get the page
+        following that id, or before_id to get the page preceding it, and
+        type_id to only list recipes of that type. Uses keyset pagination on
+        the primary key (or the type_id index), so every page costs the same
+        no matter how deep it is.
+        Returns RecipePage.
+        """
+        if order not in ('asc', 'desc'):
+            raise ValueError('order must be asc or desc, not {}'.format(order))
+        backwards = before_id is not None
+        # walk the id index in the direction we're paging
+        if backwards == (order == 'asc'):
+            comparison, direction = '<', 'DESC'
+        else:
+            comparison, direction = '>', 'ASC'
+        cursor_id = before_id if backwards else after_id
+
+        sql = ('SELECT recipe.id, name, description, type_id, photo, food_type.food_type '
+               'FROM recipe LEFT JOIN food_type ON food_type.id = recipe.type_id')
+        conditions = []
+        args = ()
+        if type_id is not None:
+            conditions.append('recipe.type_id = ?')
+            args += (type_id,)
+        if cursor_id is not None:
+            conditions.append('recipe.id {} ?'.format(comparison))
+            args += (cursor_id,)
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY recipe.id {} LIMIT ?'.format(direction)
+        rows = self._db_query(sql, args + (limit + 1,)).fetchall()
+
+        has_more = len(rows) > limit
+        recipes = [RecipeEntry.from_dict(row) for row in rows[:limit]]
+        if backwards:
+            recipes.reverse()
+            has_prev, has_next = has_more, True
+        else:
+            has_prev, has_next = cursor_id is not None, has_more
+
+        page = RecipePage(recipes=recipes)
+        if recipes:
+            if has_next:
+                page.next_cursor = recipes[-1].id
+            if has_prev:
+                page.prev_cursor = recipes[0].id
+        return page
+
+    def _projection_sql(self, fields):
+        """ Returns SELECT ... FROM clause reading fields (and whatever is
+        needed to fill them in) from recipe. The DEFAULT_FIELDS are always
+        read, and columns are in FIELD_COLUMNS order, so the statement only
+        varies with which large columns are wanted, not with how fields are
+        asked for. Raises ValueError on unknown fields.
+        """
+        unknown = [field for field in fields if field not in self.FIELD_COLUMNS]
+        if unknown:
+            raise ValueError('unknown fields: {}'.format(', '.join(unknown)))
+        wanted = set(self.DEFAULT_FIELDS).union(fields)
+        # stale html is rendered again from its markdown, see _project
+        wanted.update(self._HTML_FIELDS[field] for field in fields if field in self._HTML_FIELDS)
+        columns = ['{} AS {}'.format(column, name) for name, column in self.FIELD_COLUMNS.items()
+                   if name in wanted]
+        if not wanted.isdisjoint(self._HTML_FIELDS):
+            columns.append('recipe.render_version AS render_version')
+        return ('SELECT {} FROM recipe '
+                'LEFT JOIN food_type ON food_type.id = recipe.type_id'.format(', '.join(columns)))
+
+    def _project(self, row, fields):
+        """ dict of fields from a row selected by _projection_sql(fields) """
+        projected = {field: row[field] for field in fields}
+        if 'render_version' in row.keys() and row['render_version'] != render_version():
+            for field, source in self._HTML_FIELDS.items():
+                if field in projected:
+                    projected[field] = process_markdown(row[source] or '')
+        return projected
+
+    def get_recipe_fields(self, recipe_ids, fields=DEFAULT_FIELDS):
+        """ Get fields of each recipe in recipe_ids, with a single query.
+        Returns list of dicts of field values, in the order of recipe_ids,
+        skipping recipes that don't exist. Raises ValueError on unknown fields.
+        """
+        recipe_ids = list(dict.fromkeys(recipe_ids))
+        if not recipe_ids:
+            return []
+        # ids are bound as one json array, so the statement is the same however many there are
+        sql = (self._projection_sql(fields) +
+               ' WHERE recipe.id IN (SELECT value FROM json_each(?))')
+        rows = {row['id']: row for row in self._db_query(sql, (json.dumps(recipe_ids),))}
+        return [self._project(rows[recipe_id], fields) for recipe_id in recipe_ids
+                if recipe_id in rows]
+
+    def iter_recipe_fields(self, fields=DEFAULT_FIELDS, after_id=None, limit=None, type_id=None):
+        """ Iterate over fields of recipes (optionally only of type_id) in id
+        order, as dicts of field values, starting after after_id and stopping
+        after limit recipes. Like get_recipes_page, pages are keyset paginated
+        by id, and rows are fetched as the iterator advances.
+        Raises ValueError on unknown fields.
+        """
+        sql = self._projection_sql(fields)
+        conditions = []
+        args = ()
+        if type_id is not None:
+            conditions.append('recipe.type_id = ?')
+            args += (type_id,)
+        if after_id is not None:
+            conditions.append('recipe.id > ?')
+            args += (after_id,)
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY recipe.id'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            args += (limit,)
+        cursor = self._db_query(sql, args)
+        return (self._project(row, fields) for row in cursor)
+
+    def get_categories(self):
+        """ Get every food type that has recipes, with its recipe count,
+        ordered by name. Counts are kept by triggers, so this costs the same
+        however many recipes there are. Returns list of Category.
+        """
+        cursor = self._db_query('SELECT food_type.id, food_type.food_type, '
+                                'food_type_count.recipe_count AS recipes FROM food_type '
+                                'JOIN food_type_count ON food_type_count.type_id = food_type.id '
+                                'WHERE food_type_count.recipe_count > 0 '
+                                'ORDER BY food_type.food_type')
+        return [Category(id=row['id'], name=row['food_type'], recipe_count=row['recipes'])
+                for row in cursor]
+
+    def search(self, query, limit=PAGE_SIZE, offset=0):
+        """ Full text search of recipe name, description, ingredients and
+        instructions. Every word in query must match (the last one as a
+        prefix). Returns list of SearchResult, best matches first.
+        """
+        terms = query.split()
+        if not terms:
+            return []
+        # quote each term so user input can't inject fts5 query syntax
+        fts_query = ' '.join('"{}"'.format(term.replace('"', '""')) for term in terms) + '*'
+        sql = ('SELECT recipe.id, recipe.name, recipe.description, recipe.type_id, recipe.photo, '
+               "snippet(recipe_fts, -1, ?, ?, '...', 16) AS snippet "
+               'FROM recipe_fts JOIN recipe ON recipe.id = recipe_fts.rowid '
+               'WHERE recipe_fts MATCH ? '
+               'ORDER BY bm25(recipe_fts, {}) LIMIT ? OFFSET ?'.format(
+                   ', '.join(str(weight) for weight in self.SEARCH_WEIGHTS)))
+        cursor = self._db_query(sql, (self._MATCH_START, self._MATCH_END, fts_query,
+                                      limit, offset))
+        results = []
+        for row in cursor:
+            snippet = (html.escape(row['snippet'] or '')
+                       .replace(self._MATCH_START, '<mark>')
+                       .replace(self._MATCH_END, '</mark>'))
+            results.append(SearchResult(recipe=RecipeEntry.from_dict(row), snippet=snippet))
+        return results
+
+    def rebuild_search_index(self):
+        """ (Re)create the full text search index and triggers, then
+        repopulate it from the recipe table.
+        """
+        with open(self.SEARCH_SCHEMA_FILENAME) as fptr:
+            self.conn.executescript(fptr.read())
+        self.conn.commit()
+        logger.info('Rebuilt recipe search index')
@@ -0,0 +1,150 @@
+#    Copyright 2021 Abigail Schubert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Import and export of the recipe book as newline delimited json.
+
+Each line is one json object with a "kind" key. All "food_type" records
+({"kind": "food_type", "name": ...}) come first, followed by one "recipe"
+record per recipe, which refers to its food type by name. Recipe records
+may carry their photo base64 encoded in "photo_data".
+"""
+import base64
+import json
+import logging
+import time
+from pathlib import Path
+from werkzeug.utils import secure_filename
+from omnom.images import InvalidAssetError, fanout_path, resolve_asset, write_photo
+from omnom.recipe_db import RecipeEntry
+
+logger = logging.getLogger(__name__)
+
+
+class RecipeImportError(Exception):
+    """ Malformed record in a recipe import """
+
+
+class Progress():
+    """ Calls report(count, rate) every `every` items, and once at the end """
+
+    def __init__(self, report, every=1000):
+        self.report = report
+        self.every = every
+        self.count = 0
+        self.start = time.monotonic()
+
+    def step(self):
+        """ Count one item """
+        self.count += 1
+        if self.count % self.every == 0:
+            self._report()
+
+    def finish(self):
+        """ Report final count """
+        self._report()
+        return self.count
+
+    def _report(self):
+        elapsed = time.monotonic() - self.start
+        self.report(self.count, self.count / elapsed if elapsed else 0.0)
+
+
+def export_recipes(rdb, out, assets_dir=None, progress=None):
+    """ Write every food type and recipe in rdb to out as ndjson. If
+    assets_dir is given, recipe photos are read from it and embedded.
+    Returns number of recipes written.
+    """
+    progress = progress or Progress(lambda count, rate: None)
+    food_types = rdb.get_all_types()
+    for name in food_types.values():
+        out.write(json.dumps({'kind': 'food_type', 'name': name}) + '\n')
+
+    for recipe in rdb.iter_recipes():
+        record = {'kind': 'recipe',
+                  'name': recipe.name,
+                  'description': recipe.description,
+                  'food_type': food_types.get(recipe.type_id),
+                  'ingredients': recipe.ingredients,
+                  'instructions': recipe.instructions,
+                  'photo': recipe.photo}
+        if assets_dir and recipe.photo:
+            stored_name = resolve_asset(assets_dir, recipe.photo)
+            photo_path = Path(assets_dir, stored_name or recipe.photo)
+            if stored_name is not None:
+                record['photo_data'] = base64.b64encode(photo_path.read_bytes()).decode('ascii')
+            else:
+                logger.warning('Photo %s for recipe %s is missing', photo_path, recipe.id)
+        out.write(json.dumps(record) + '\n')
+        progress.step()
+    return progress.finish()
+
+
+def import_recipes(rdb, lines, assets_dir=None, batch_size=1000, progress=None):
+    """ Add food types and recipes from ndjson lines (any iterable of str) to
+    rdb. Food types are matched by name and created if missing. Recipes are
+    added batch_size at a time, one transaction per batch. Embedded photos are
+    checked and written to assets_dir, if given, named after their content.
+    Returns number of recipes imported.
+    """
+    progress = progress or Progress(lambda count, rate: None)
+    type_ids = {name: type_id for type_id, name in rdb.get_all_types().items()}
+
+    def get_type_id(name):
+        """ Get id# of food type name, adding it if needed """
+        if name is None:
+            return -1  # RecipeEntry's default for no food type
+        if name not in type_ids:
+            type_ids[name] = rdb.add_type(name)
+        return type_ids[name]
+
+    batch = []
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            kind = record['kind']
+            if kind == 'food_type':
+                get_type_id(record['name'])
+                continue
+            if kind != 'recipe':
+                raise RecipeImportError('unknown kind {!r}'.format(kind))
+            recipe = RecipeEntry(name=record['name'],
+                                 description=record.get('description'),
+                                 type_id=get_type_id(record.get('food_type')),
+                                 ingredients=record.get('ingredients') or '',
+                                 instructions=record.get('instructions') or '',
+                                 photo=record.get('photo'))
+            photo_data = None
+            if recipe.photo and assets_dir and record.get('photo_data'):
+                photo_data = base64.b64decode(record['photo_data'], validate=True)
+        except (ValueError, KeyError, TypeError) as error:
+            raise RecipeImportError('line {}: {}'.format(line_number, error)) from error
+
+        if photo_data is not None:
+            # checked, and named after its content, like an uploaded photo
+            try:
+                recipe.photo = write_photo(assets_dir, recipe.photo, photo_data, 'recipe')
+            except InvalidAssetError as error:
+                raise RecipeImportError('line {}: {}'.format(line_number, error)) from error
+        elif recipe.photo:
+            recipe.photo = fanout_path(secure_filename(Path(recipe.photo).name))
+        batch.append(recipe)
+        if len(batch) >= batch_size:
+            rdb.add_recipes(batch)
+            batch = []
+        progress.step()
+    if batch:
+        rdb.add_recipes(batch)
+    return progress.finish()
@@ -13,11 +13,13 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """ Recipe views such as index and full recipe page """
-import bleach
-from markdown import markdown
-from flask import Blueprint, render_template, request, redirect, url_for, flash
-from omnom.common import get_recipe_db, login_required
+from flask import (Blueprint, abort, current_app, render_template, request, redirect, session,
+                   url_for, flash)
+from omnom.common import get_page_cache, get_recipe_db, login_required
+from omnom.images import InvalidAssetError, save_to_assets, streams_photos
 from omnom.recipe_db import RecipeEntry
+from omnom.render import clean_input, process_markdown, render_version
+from omnom.static_site import listing_page_url
 
 
 bp = Blueprint('recipes', __name__)
@@ -27,57 +29,161 @@ class UserInputError(Exception):
     """ Exception related to bad user input """
 
 
-def process_markdown(text):
-    """ Process markdown text into html.
-    Supports less strict markdown for mixing lists and paragraphs (no blank
-    line required). Applies bleach to sanitize.
-    Returns html string
+def validated_response(tag, last_modified=None):
+    """ Returns an empty response carrying validators (ETag from tag, and
+    Last-Modified from unix time last_modified) for the current page. Its
+    status is 304 if the client's copy is current, in which case the view
+    should return it as is, otherwise the view should fill in its body.
+    Logged in users and anonymous visitors get different validators, since
+    the page differs for them.
     """
-    ALLOWED_HTML = bleach.ALLOWED_TAGS + ['p', 'br']
-    def is_list_entry(x):
-        """ Returns true if x is a list entry (starts with number or *) """
-        return x and (x[0].isdigit() or x[0] == '*')
-
-    new_text = []
-    prev_line = ''
-
-    if text is None:
-        return ''
-
-    for line in text.split('\n'):
-        if line and prev_line:
-            if is_list_entry(prev_line):
-                if not is_list_entry(line):         # covers li followed by p
-                    new_text[-1] = prev_line + '\n'
-                else:                               # don't add \n to li followed by li
-                    pass
-            else:                                   # covers p followed by li or p
-                new_text[-1] = prev_line + '\n'
-        else:                                       # if either line is blank, no need for newline.
-            pass
-        prev_line = line
-        new_text.append(line)
-    new_text = markdown('\n'.join(new_text))
-    return bleach.clean(new_text, tags=ALLOWED_HTML)
+    response = current_app.response_class()
+    if '_flashes' in session:
+        return response  # page shows one-off messages, never "not modified"
+    response.set_etag('{}-{}'.format(tag, _viewer()), weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    if session.get('user_id') is not None:
+        response.cache_control.private = True
+    return response.make_conditional(request)
+
+
+def render_cached(response, version_tag, tags, render):
+    """ Fill in response's body from the page cache, or by calling render()
+    (which returns the page as str) and caching the result. Pages are cached
+    per endpoint, args, viewer and version_tag, and dropped from the cache
+    when any of tags (see RecipeDB) is invalidated. Returns response.
+    """
+    page_cache = get_page_cache()
+    if page_cache is None or '_flashes' in session:
+        response.set_data(render())
+        return response
+    key = '|'.join((request.endpoint, repr(sorted(request.view_args.items())),
+                    repr(sorted(request.args.items(multi=True))), _viewer(), version_tag))
+    body = page_cache.get(key)
+    if body is None:
+        body = render().encode('utf-8')
+        page_cache.set(key, body, tags)
+        response.headers['X-Cache'] = 'MISS'
+    else:
+        response.headers['X-Cache'] = 'HIT'
+    response.set_data(body)
+    return response
+
+
+def _viewer():
+    """ Who the current page is for: 'anon' or 'u<user id#>' """
+    user_id = session.get('user_id')
+    return 'anon' if user_id is None else 'u{}'.format(user_id)
 
 
 @bp.route('/')
 def index():
-    """ Index page showing list of recipes """
+    """ Index page showing one page of recipes. Accepts after/before cursors
+    and order (asc or desc) as query args.
+    """
+    return recipe_listing()
+
+
+@bp.route('/category/<int:type_id>')
+def category(type_id):
+    """ Page listing the recipes of one food type, paginated as the index """
+    if type_id not in get_recipe_db().get_all_types():
+        abort(404)
+    return recipe_listing(type_id)
+
+
+def _page_link(cursor, direction, order, step):
+    """ URL of the listing page before or after (direction) cursor, or None
+    if there's no such page. A static export links the page's file instead,
+    numbered step from the current page (page query arg).
+    """
+    if cursor is None:
+        return None
+    if current_app.config['STATIC_EXPORT']:
+        number = request.args.get('page', 1, type=int) + step
+        return listing_page_url(url_for(request.endpoint, **request.view_args), number)
+    return url_for(request.endpoint, order=order if order != 'asc' else None,
+                   **{direction: cursor}, **request.view_args)
+
+
+def recipe_listing(type_id=None):
+    """ Response listing one page of all recipes, or those of food type
+    type_id, with the category sidebar.
+    """
     db = get_recipe_db()
-    recipes = db.get_all_recipes()
-    return render_template('recipes/index.html', recipes=recipes)
+    order = request.args.get('order', 'asc')
+    if order not in ('asc', 'desc'):
+        abort(400)
+    # the sidebar only lists food types with recipes, so it can't change
+    # without the book version changing too
+    book_version, updated_at = db.get_book_version()
+    version_tag = 'book{}'.format(book_version)
+    response = validated_response(version_tag, updated_at)
+    if response.status_code == 304:
+        return response
+
+    def render():
+        page = db.get_recipes_page(after_id=request.args.get('after', type=int),
+                                   before_id=request.args.get('before', type=int),
+                                   limit=current_app.config['RECIPES_PER_PAGE'],
+                                   order=order, type_id=type_id)
+        categories = db.get_categories()
+        current = None
+        if type_id is not None:
+            current = db.get_all_types()[type_id]
+        return render_template('recipes/index.html', recipes=page.recipes,
+                               prev_url=_page_link(page.prev_cursor, 'before', order, -1),
+                               next_url=_page_link(page.next_cursor, 'after', order, 1),
+                               categories=categories, type_id=type_id, category=current)
+    return render_cached(response, version_tag, ['recipes', 'food_types'], render)
+
+
+@bp.route('/search')
+def search():
+    """ Search results page. Accepts q (search text) and offset as query args. """
+    query = request.args.get('q', '').strip()
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = current_app.config['RECIPES_PER_PAGE']
+    results = []
+    if query:
+        # fetch one extra result to find out if there is a next page
+        results = get_recipe_db().search(query, limit=limit + 1, offset=offset)
+    next_offset = offset + limit if len(results) > limit else None
+    prev_offset = max(offset - limit, 0) if offset else None
+    return render_template('recipes/search.html', query=query, results=results[:limit],
+                           next_offset=next_offset, prev_offset=prev_offset)
 
 
 @bp.route('/recipes/<int:recipe_id>')
 def full_recipe(recipe_id):
     """ Page showing full recipe info """
     db = get_recipe_db()
-    recipe = db.get_recipe(recipe_id)
-    html_ingredients = process_markdown(recipe.ingredients)
-    html_instructions = process_markdown(recipe.instructions)
-    return render_template('recipes/full_recipe.html', recipe=recipe,
-                           ingredients=html_ingredients, instructions=html_instructions)
+    recipe_version = db.get_recipe_version(recipe_id)
+    if recipe_version is None:
+        abort(404)
+    version, _ = recipe_version
+    version_tag = 'recipe{}-v{}-{}'.format(recipe_id, version, render_version())
+    # No Last-Modified: a new renderer changes the page (and ETag) before the
+    # backfill touches updated_at, so If-Modified-Since would wrongly match.
+    response = validated_response(version_tag)
+    if response.status_code == 304:
+        return response
+
+    def render():
+        recipe = db.get_recipe(recipe_id)
+        if recipe is None:
+            abort(404)
+        if recipe.render_version != render_version():
+            # Row predates the current renderer and hasn't been backfilled yet
+            # (see `flask render-recipes`), so render it on the fly.
+            recipe.ingredients_html = process_markdown(recipe.ingredients)
+            recipe.instructions_html = process_markdown(recipe.instructions)
+        return render_template('recipes/full_recipe.html', recipe=recipe,
+                               ingredients=recipe.ingredients_html,
+                               instructions=recipe.instructions_html)
+    return render_cached(response, version_tag, ['recipe:{}'.format(recipe_id)], render)
 
 
 def render_recipe_editor(recipe_id=None):
@@ -97,18 +203,33 @@ def render_recipe_editor(recipe_id=None):
 def validate_and_post_changes(recipe_id=None):
     """ Post changes to recipe, returns recipe_id """
     db = get_recipe_db()
+    try:
+        # parsing the form streams the photo to disk, checking it on the way
+        request.files.get('recipe_img_file')
+    except InvalidAssetError as error:
+        raise UserInputError(str(error)) from error
     recipe = RecipeEntry(id=recipe_id,
                          name=request.form['name'],
                          description=request.form['description'],
                          type_id=request.form['food_type'])
-    recipe.ingredients = bleach.clean(request.form['ingredients'])
-    recipe.instructions = bleach.clean(request.form['instructions'])
+    recipe.ingredients = clean_input(request.form['ingredients'])
+    recipe.instructions = clean_input(request.form['instructions'])
 
     if not recipe.name:
         raise UserInputError('Recipe name is required.')
     if not db.get_food_type(recipe.type_id):
         raise UserInputError('Unknown food category.')
 
+    photo_file = request.files.get('recipe_img_file')
+    if photo_file and photo_file.filename:
+        try:
+            recipe.photo = save_to_assets(photo_file, 'recipe')
+        except InvalidAssetError as error:
+            raise UserInputError(str(error)) from error
+    elif recipe_id is not None:
+        old_recipe = db.get_recipe(recipe_id)
+        recipe.photo = old_recipe.photo if old_recipe else None
+
     if recipe_id is None:
         recipe_id = db.add_recipe(recipe)
     else:
@@ -118,6 +239,7 @@ def validate_and_post_changes(recipe_id=None):
 
 @bp.route('/recipes/create', methods=('GET', 'POST'))
 @login_required
+@streams_photos
 def create():
     """ Page showing new recipe editor """
     if request.method == 'POST':
@@ -132,6 +254,7 @@ def create():
 
 @bp.route('/recipes/<int:recipe_id>/edit', methods=('GET', 'POST'))
 @login_required
+@streams_photos
 def edit(recipe_id):
     """ Page showing recipe editor """
     if request.method == 'POST':
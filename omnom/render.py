@@ -0,0 +1,183 @@
+#    Copyright 2021 Abigail Schubert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Markdown rendering for recipe text """
+import functools
+import hashlib
+import re
+import threading
+import time
+from omnom.metrics import MARKDOWN_SECONDS
+
+# markdown and bleach are slow to import, so they're only loaded on first use
+# to keep worker startup fast.
+
+# Bump this whenever process_markdown changes its output, so stored html gets re-rendered.
+RENDER_VERSION = 1
+EXTRA_ALLOWED_HTML = ['p', 'br']
+
+# Building Markdown and bleach Cleaner instances is expensive and they aren't
+# thread safe, so each thread keeps its own.
+_local = threading.local()
+
+
+@functools.lru_cache(maxsize=None)
+def allowed_html():
+    """ Return list of html tags that survive sanitize """
+    import bleach  # pylint:disable=import-outside-toplevel
+    return list(bleach.ALLOWED_TAGS) + EXTRA_ALLOWED_HTML
+
+
+def markdown(text):
+    """ Convert markdown text to html, reusing this thread's Markdown instance """
+    converter = getattr(_local, 'markdown', None)
+    if converter is None:
+        from markdown import Markdown  # pylint:disable=import-outside-toplevel
+        converter = _local.markdown = Markdown()
+    return converter.reset().convert(text)
+
+
+def sanitize(html):
+    """ Strip html down to allowed_html(), reusing this thread's bleach Cleaner """
+    cleaner = getattr(_local, 'cleaner', None)
+    if cleaner is None:
+        from bleach.sanitizer import Cleaner  # pylint:disable=import-outside-toplevel
+        cleaner = _local.cleaner = Cleaner(tags=allowed_html())
+    return cleaner.clean(html)
+
+
+def clean_input(text):
+    """ Escape any html in user supplied text, as bleach.clean does """
+    import bleach  # pylint:disable=import-outside-toplevel
+    return bleach.clean(text)
+
+
+@functools.lru_cache(maxsize=None)
+def render_version():
+    """ Return tag identifying the current renderer. Changes whenever
+    RENDER_VERSION, the allowed tag list or the markdown/bleach versions change.
+    """
+    import bleach  # pylint:disable=import-outside-toplevel
+    import markdown as markdown_pkg  # pylint:disable=import-outside-toplevel
+    fingerprint = '|'.join(sorted(allowed_html()) +
+                           [markdown_pkg.__version__, bleach.__version__])
+    digest = hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()[:8]
+    return '{}-{}'.format(RENDER_VERSION, digest)
+
+
+def process_markdown(text):
+    """ Process markdown text into html.
+    Supports less strict markdown for mixing lists and paragraphs (no blank
+    line required). Output is sanitized: simple text is escaped as it's
+    rendered, anything else goes through markdown and bleach.
+    Returns html string
+    """
+    if not text:
+        return ''
+    start = time.perf_counter()
+    html = render_simple(text)
+    if html is None:
+        html = render_full(text)
+    MARKDOWN_SECONDS.observe(time.perf_counter() - start)
+    return html
+
+
+# A line of the simple dialect: an optional list marker, then text which
+# starts with a letter or digit and can't contain markdown or html syntax.
+_SIMPLE_LINE_RE = re.compile(r'(\* |[0-9]+\. )?([^\W_](?:[^\W_]|[ ,.;:?!\'"()/%+=&<>-])*)')
+_ENTITY_RE = re.compile(r'&#?[0-9A-Za-z]+;')
+_ORDERED_MARKER_RE = re.compile(r'[0-9]+\.')
+
+
+def _escape(text):
+    if '&' in text or '<' in text or '>' in text:
+        return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    return text
+
+
+def render_simple(text):
+    """ Render the simple markdown most recipes are written in: lines that
+    are "* " or "1. " list items, or paragraphs of plain text, in one pass.
+    Returns the same html as render_full, or None if text uses anything
+    else (which render_full must handle).
+    """
+    text = text.replace('\r\n', '\n')
+    if '\r' in text:
+        return None
+    html = []
+    open_list = None  # 'ul' or 'ol' while in a list
+    blank_in_list = False
+    for line in text.split('\n'):
+        if not line:
+            blank_in_list = open_list is not None
+            continue
+        match = _SIMPLE_LINE_RE.fullmatch(line)
+        if match is None:
+            return None
+        marker, content = match.groups()
+        if content[-1] == ' ':
+            return None  # trailing spaces are a line break
+        if '&' in content and _ENTITY_RE.search(content):
+            return None
+        if '<' in content and content.count('<') != content.count('< '):
+            return None  # could start a tag
+        if marker is None:
+            if content[0].isdigit():
+                return None  # loosely a list entry, may join the next line
+            if open_list:
+                html.append('</{}>'.format(open_list))
+                open_list = None
+            html.append('<p>{}</p>'.format(_escape(content)))
+            continue
+        if _ORDERED_MARKER_RE.match(content):
+            return None  # nested list
+        kind = 'ul' if marker == '* ' else 'ol'
+        if open_list is None:
+            html.append('<{}>'.format(kind))
+            open_list = kind
+        elif blank_in_list or kind != open_list:
+            return None  # loose list or mixed list types
+        html.append('<li>{}</li>'.format(_escape(content)))
+        blank_in_list = False
+    if open_list:
+        html.append('</{}>'.format(open_list))
+    return '\n'.join(html)
+
+
+def render_full(text):
+    """ Render any markdown text through python-markdown and bleach, first
+    separating paragraphs and lists not already separated by a blank line.
+    """
+    def is_list_entry(x):
+        """ Returns true if x is a list entry (starts with number or *) """
+        return x and (x[0].isdigit() or x[0] == '*')
+
+    new_text = []
+    prev_line = ''
+
+    for line in text.split('\n'):
+        if line and prev_line:
+            if is_list_entry(prev_line):
+                if not is_list_entry(line):         # covers li followed by p
+                    new_text[-1] = prev_line + '\n'
+                else:                               # don't add \n to li followed by li
+                    pass
+            else:                                   # covers p followed by li or p
+                new_text[-1] = prev_line + '\n'
+        else:                                       # if either line is blank, no need for newline.
+            pass
+        prev_line = line
+        new_text.append(line)
+    new_text = markdown('\n'.join(new_text))
+    return sanitize(new_text)
@@ -0,0 +1,144 @@
+#    Copyright 2021 Abigail Schubert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Log of slow SQL statements.
+
+Statements that take longer than a threshold are logged along with their
+(redacted) parameters and query plan, and counted in a small sqlite file that
+every worker process shares. `flask db-slowlog` reports the totals.
+"""
+import logging
+import re
+import sqlite3
+import time
+from omnom.db import LocalConnections
+
+logger = logging.getLogger(__name__)
+
+# Parameters of statements touching these columns are never logged
+SENSITIVE_COLUMNS = re.compile(r'\bpassword\b', re.IGNORECASE)
+MAX_PARAM_LENGTH = 80
+
+
+def redact_params(sql, args):
+    """ Returns printable copy of args for statement sql. Long values are
+    shortened and every value is hidden if sql touches a sensitive column.
+    """
+    if not args:
+        return ()
+    if SENSITIVE_COLUMNS.search(sql):
+        return tuple('<redacted>' for _ in args)
+    redacted = []
+    for arg in args:
+        if isinstance(arg, bytes):
+            arg = '<{} bytes>'.format(len(arg))
+        elif isinstance(arg, str) and len(arg) > MAX_PARAM_LENGTH:
+            arg = arg[:MAX_PARAM_LENGTH] + '...'
+        redacted.append(arg)
+    return tuple(redacted)
+
+
+def is_full_scan(plan):
+    """ True if any step of query plan (list of EXPLAIN QUERY PLAN details)
+    reads a whole table without an index.
+    """
+    for detail in plan:
+        if detail.startswith('SCAN ') and 'USING' not in detail and 'VIRTUAL TABLE' not in detail:
+            return True
+    return False
+
+
+def explain(conn, sql, args):
+    """ Returns EXPLAIN QUERY PLAN detail lines of sql on conn """
+    try:
+        rows = conn.execute('EXPLAIN QUERY PLAN ' + sql, args or ()).fetchall()
+    except sqlite3.Error as error:
+        return ['(no plan: {})'.format(error)]
+    return [row[3] for row in rows]
+
+
+class SlowQueryLog():
+    """ Records statements taking at least threshold seconds in sqlite file
+    filename.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS slow_query (
+            statement TEXT PRIMARY KEY,
+            count INTEGER NOT NULL,
+            total_seconds REAL NOT NULL,
+            max_seconds REAL NOT NULL,
+            full_scan INTEGER NOT NULL,
+            plan TEXT NOT NULL,
+            last_params TEXT,
+            last_seen REAL NOT NULL
+        );
+    '''
+
+    def __init__(self, filename, threshold):
+        self.filename = str(filename)
+        self.threshold = threshold
+        self._connections = LocalConnections(self.filename, self.SCHEMA,
+                                             row_factory=sqlite3.Row)
+
+    def _connect(self):
+        """ Get this thread's connection to the log db """
+        return self._connections.get()
+
+    def record(self, conn, sql, args, seconds):
+        """ Log statement sql, run with args on conn, if seconds is over threshold """
+        if seconds < self.threshold:
+            return
+        statement = ' '.join(sql.split())
+        plan = explain(conn, sql, args)
+        full_scan = is_full_scan(plan)
+        params = redact_params(sql, args)
+        logger.warning('Slow query (%.3fs)%s: %s %r\n  %s', seconds,
+                       ' [FULL SCAN]' if full_scan else '', statement, params,
+                       '\n  '.join(plan))
+        try:
+            with self._connect() as log_conn:
+                log_conn.execute(
+                    'INSERT INTO slow_query (statement, count, total_seconds, max_seconds, '
+                    'full_scan, plan, last_params, last_seen) VALUES (?, 1, ?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (statement) DO UPDATE SET count=count+1, '
+                    'total_seconds=total_seconds+excluded.total_seconds, '
+                    'max_seconds=max(max_seconds, excluded.max_seconds), '
+                    'full_scan=excluded.full_scan, plan=excluded.plan, '
+                    'last_params=excluded.last_params, last_seen=excluded.last_seen',
+                    (statement, seconds, seconds, full_scan, '\n'.join(plan), repr(params),
+                     time.time()))
+        except sqlite3.Error:
+            logger.exception('Failed to record slow query')
+
+    def stats(self, limit=None):
+        """ Returns list of per statement totals (dicts), most total time first """
+        sql = 'SELECT * FROM slow_query ORDER BY total_seconds DESC'
+        args = ()
+        if limit is not None:
+            sql += ' LIMIT ?'
+            args = (limit,)
+        return [dict(row) for row in self._connect().execute(sql, args)]
+
+    def reset(self):
+        """ Forget every recorded statement """
+        with self._connect() as conn:
+            conn.execute('DELETE FROM slow_query')
+
+
+def make_slow_query_log(config):
+    """ Returns SlowQueryLog per config, or None if SLOW_QUERY_THRESHOLD is None """
+    if config['SLOW_QUERY_THRESHOLD'] is None:
+        return None
+    return SlowQueryLog(config['SLOW_QUERY_LOG'], config['SLOW_QUERY_THRESHOLD'])
@@ -0,0 +1,265 @@
+#    Copyright 2021 Abigail Schubert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Export the recipe book as a static site.
+
+Every page is rendered by the app itself (through its test client), as an
+anonymous visitor would see it, and written to OUTPUT/<url path>/index.html.
+Listings are paginated as in the app, page n (after the first) of a listing
+at <url> being written to <url>/page/<n>/. Links that need the app (search,
+logging in) are left out. Rendering is spread over a pool of processes.
+
+A manifest in the output directory records a hash of what each page was
+rendered from, so rebuilds only render pages whose recipes (or the
+templates and renderer) changed. Assets and static files are hard linked
+into the output where possible, otherwise copied by the OS. Photos link to
+the files of their size variants, falling back to the original until a
+variant has been generated.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+from pathlib import Path
+import pickle
+import shutil
+import tempfile
+from omnom.images import PHOTO_SIZES, photo_path
+from omnom.render import render_version
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = '.omnom-build.json'
+# Pages each worker task renders
+CHUNK_SIZE = 50
+
+_worker_client = None  # flask test client of each pool process
+
+
+def page_filename(url):
+    """ Path (relative to the output dir) a page at url is written to """
+    return Path(url.strip('/'), 'index.html')
+
+
+def _hash(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(json.dumps(part, sort_keys=True, default=str).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _tree_fingerprint(*dirs):
+    """ Hash of the names and contents of every file under dirs """
+    digest = hashlib.sha256()
+    for directory in dirs:
+        for path in sorted(Path(directory).rglob('*')):
+            if path.is_file():
+                digest.update(str(path.relative_to(directory)).encode('utf-8'))
+                digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def _photo_files(assets_dir, photo):
+    """ Files each size of photo is exported as, which change as variants
+    are generated
+    """
+    if not photo:
+        return None
+    return {size: photo_path(assets_dir, photo, size) for size in PHOTO_SIZES}
+
+
+def listing_page_url(url, number):
+    """ URL of page number (from 1) of the listing at url, in the export """
+    if number == 1:
+        return url
+    return '{}/page/{}'.format(url.rstrip('/'), number)
+
+
+def collect_pages(rdb, fingerprint, assets_dir, per_page):
+    """ Returns dict of url -> (url to render the page from, hash of the
+    data it's rendered from). Listings are split into pages of per_page
+    recipes, rendered by following the listing's cursors.
+    """
+    categories = [(cat.id, cat.name, cat.recipe_count) for cat in rdb.get_categories()]
+    food_types = rdb.get_all_types()
+    # listing url -> [(recipe id#, hash of its entry)], in listing (id) order
+    listings = {'/': []}
+    listings.update(('/category/{}'.format(type_id), []) for type_id, _, _ in categories)
+    pages = {}
+    for recipe in rdb.iter_recipes():
+        photo_files = _photo_files(assets_dir, recipe.photo)
+        entry = (recipe.id, _hash(recipe.id, recipe.name, recipe.description, recipe.type_id,
+                                  photo_files))
+        listings['/'].append(entry)
+        category_url = '/category/{}'.format(recipe.type_id)
+        if category_url in listings:
+            listings[category_url].append(entry)
+        url = '/recipes/{}'.format(recipe.id)
+        pages[url] = (url, _hash(fingerprint, recipe.id, recipe.name, recipe.description,
+                                 photo_files, recipe.ingredients, recipe.instructions,
+                                 food_types.get(recipe.type_id)))
+    for listing_url, entries in listings.items():
+        for start in range(0, max(len(entries), 1), per_page):
+            number = start // per_page + 1
+            source = listing_url
+            if number > 1:
+                source += '?after={}&page={}'.format(entries[start - 1][0], number)
+            pages[listing_page_url(listing_url, number)] = (source, _hash(
+                fingerprint, categories, number, start + per_page < len(entries),
+                [digest for _, digest in entries[start:start + per_page]]))
+    return pages
+
+
+def _write_atomic(filename, data):
+    filename.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=filename.parent, prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'wb') as fptr:
+            fptr.write(data)
+        os.replace(tmp_name, filename)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+def _init_worker(config, instance_path):
+    """ Create this pool process's app """
+    global _worker_client  # pylint:disable=global-statement
+    from omnom.app import create_app  # pylint:disable=import-outside-toplevel
+    _worker_client = create_app(config, instance_path=instance_path).test_client()
+
+
+def _render_pages(output_dir, pages):
+    """ Render pages, a list of (url, url to render it from), in a pool
+    process, and write them under output_dir
+    """
+    for url, source in pages:
+        response = _worker_client.get(source)
+        if response.status_code != 200:
+            raise RuntimeError('GET {} returned {}'.format(source, response.status_code))
+        _write_atomic(Path(output_dir, page_filename(url)), response.get_data())
+    return len(pages)
+
+
+def sync_tree(source_dir, dest_dir, skip_prefix='.tmp_'):
+    """ Make dest_dir hold the same files as source_dir. Files are hard linked,
+    or copied if that isn't possible, and only if missing or changed.
+    Returns number of files linked or copied.
+    """
+    source_dir, dest_dir = Path(source_dir), Path(dest_dir)
+    updated = 0
+    wanted = set()
+    for source in source_dir.rglob('*'):
+        if not source.is_file() or source.name.startswith(skip_prefix):
+            continue
+        relative = source.relative_to(source_dir)
+        wanted.add(relative)
+        dest = dest_dir / relative
+        source_stat = source.stat()
+        try:
+            dest_stat = dest.stat()
+            if (dest_stat.st_ino == source_stat.st_ino and dest_stat.st_dev == source_stat.st_dev
+                    or (dest_stat.st_size, dest_stat.st_mtime_ns) ==
+                    (source_stat.st_size, source_stat.st_mtime_ns)):
+                continue
+        except FileNotFoundError:
+            pass
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp_name = dest.with_name(skip_prefix + dest.name)
+        try:
+            os.link(source, tmp_name)
+        except FileExistsError:
+            os.unlink(tmp_name)
+            os.link(source, tmp_name)
+        except OSError:
+            # eg. another filesystem: copy, in kernel where supported
+            shutil.copy2(source, tmp_name)
+        os.replace(tmp_name, dest)
+        updated += 1
+    if dest_dir.exists():
+        for dest in dest_dir.rglob('*'):
+            if dest.is_file() and dest.relative_to(dest_dir) not in wanted:
+                dest.unlink()
+    return updated
+
+
+def _worker_config(config):
+    """ Picklable copy of app config for the pool processes """
+    worker_config = {}
+    for key, value in config.items():
+        try:
+            pickle.dumps(value)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            continue
+        worker_config[key] = value
+    worker_config.update(PAGE_CACHE=None, AUTO_MIGRATE=False, WARMUP=False, METRICS_DIR=None,
+                         SLOW_QUERY_THRESHOLD=None, STATIC_EXPORT=True)
+    return worker_config
+
+
+def build_static(app, rdb, output_dir, workers=None, full=False):
+    """ Render the book of app (with RecipeDB rdb) into output_dir, only
+    re-rendering changed pages unless full. workers is the number of
+    processes (default: one per cpu).
+    Returns dict of counts: rendered, unchanged, removed pages and assets copied.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    manifest_file = output_dir / MANIFEST_NAME
+    try:
+        old_pages = json.loads(manifest_file.read_text())['pages']
+    except (FileNotFoundError, ValueError, KeyError):
+        old_pages = {}
+    if full:
+        old_pages = {}
+
+    fingerprint = _hash(render_version(), _tree_fingerprint(
+        Path(app.root_path, app.template_folder), app.static_folder))
+    pages = collect_pages(rdb, fingerprint, app.config['ASSETS_DIR'],
+                          app.config['RECIPES_PER_PAGE'])
+    stale = [(url, source) for url, (source, digest) in pages.items()
+             if old_pages.get(url) != digest or not (output_dir / page_filename(url)).exists()]
+
+    if stale:
+        workers = min(workers or os.cpu_count() or 1, max(1, len(stale) // CHUNK_SIZE + 1))
+        chunks = [stale[start:start + CHUNK_SIZE] for start in range(0, len(stale), CHUNK_SIZE)]
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker,
+                                 initargs=(_worker_config(app.config),
+                                           app.instance_path)) as executor:
+            results = executor.map(_render_pages, [str(output_dir)] * len(chunks), chunks)
+            for chunk, done in zip(chunks, results):
+                logger.info('Rendered %d pages, up to %s', done, chunk[-1][0])
+
+    removed = 0
+    for url in old_pages.keys() - pages.keys():
+        filename = output_dir / page_filename(url)
+        try:
+            filename.unlink()
+            filename.parent.rmdir()
+        except FileNotFoundError:
+            continue
+        except OSError:
+            pass  # directory not empty
+        removed += 1
+
+    assets = sync_tree(app.config['ASSETS_DIR'], output_dir / 'assets')
+    assets += sync_tree(app.static_folder, output_dir / 'static')
+    manifest = {'pages': {url: digest for url, (_, digest) in pages.items()}}
+    _write_atomic(manifest_file, json.dumps(manifest, indent=1).encode('utf-8'))
+    return {'rendered': len(stale), 'unchanged': len(pages) - len(stale), 'removed': removed,
+            'assets': assets}
@@ -13,8 +13,11 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """ This file contains the user db connections """
+from collections import OrderedDict
 import logging
-from omnom.db import OmnomDB
+import threading
+import time
+from omnom.db import OmnomDB, register_cache
 
 
 logger = logging.getLogger(__name__)
@@ -28,19 +31,68 @@ class UserEntry():
         self.password = password
 
 
+class UserCache():
+    """ Small process wide LRU cache of UserEntry, keyed by (db filename, id#).
+    Entries expire after ttl seconds, so changes made by other processes are
+    picked up eventually.
+    """
+
+    def __init__(self, ttl=30.0, max_size=256):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # key -> (expiry time, UserEntry)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ Returns cached UserEntry, or None if missing or expired """
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is None:
+                return None
+            if cached[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return cached[1]
+
+    def put(self, key, user):
+        """ Cache user under key """
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, user)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """ Drop cached user under key, or every user if None """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
 class UserDB(OmnomDB):
 
-    def __init__(self, db_filename, init_db=False):
-        """ Connect to sqlite db located at db_filename """
-        super().__init__(db_filename=db_filename, init_db=init_db)
+    _users = register_cache(UserCache())
+
+    def __init__(self, db_filename=None, init_db=False, conn=None, slow_query_log=None):
+        """ Connect to sqlite db located at db_filename (or use existing conn) """
+        super().__init__(db_filename=db_filename, init_db=init_db, conn=conn,
+                         slow_query_log=slow_query_log)
 
     def get_user(self, id_number):
-        """ Get UserEntry given id_number """
+        """ Get UserEntry given id_number. Served from cache when possible. """
+        user = self._users.get((self.conn.db_filename, id_number))
+        if user is not None:
+            return user
         cursor = self._db_query('SELECT * from user WHERE id=?', (id_number,))
         ret = cursor.fetchone()
         if ret is None:
             return None
-        return UserEntry(ret['id'], ret['name'], ret['password'])
+        user = UserEntry(ret['id'], ret['name'], ret['password'])
+        self._users.put((self.conn.db_filename, id_number), user)
+        return user
 
     def get_user_by_name(self, name):
         """ Get UserEntry given name """
@@ -54,5 +106,11 @@ class UserDB(OmnomDB):
         """ Add new user to db """
         if self.get_user_by_name(name):
             raise Exception("User already exists")
-        self._db_insert('INSERT INTO user (name, password) VALUES (?, ?)',
-                        (name, password))
+        id_number = self._db_insert('INSERT INTO user (name, password) VALUES (?, ?)',
+                                    (name, password))
+        self._users.invalidate((self.conn.db_filename, id_number))
+
+    def update_password(self, id_number, password):
+        """ Replace password (hash) of user id_number """
+        self._db_insert('UPDATE user SET password=? WHERE id=?', (password, id_number))
+        self._users.invalidate((self.conn.db_filename, id_number))
@@ -14,10 +14,8 @@
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """ Test config and fixtures """
 
-import os
 from pathlib import Path
 import shutil
-import tempfile
 import pytest
 from omnom.db import OmnomDB
 from omnom.app import create_app
@@ -27,25 +25,23 @@ TEST_SQL_FILE = RESOURCES_DIR / 'data.sql'
 
 
 @pytest.fixture
-def app():
-    db_fd, db_path = tempfile.mkstemp()
+def app(tmp_path_factory):
+    """ App keeping all its files (db, assets, caches, logs) in a temporary
+    instance folder, rather than the repo's
+    """
+    instance_path = tmp_path_factory.mktemp('instance')
+    db_path = instance_path / 'omnom.sqlite'
     omnom_db = OmnomDB(db_path)
     omnom_db.init_db(extra_sql=TEST_SQL_FILE)
 
     app = create_app({'TESTING': True,
                       'DATABASE': db_path,
-                      })
+                      }, instance_path=str(instance_path))
 
-    source_image = RESOURCES_DIR / 'test.png'
-    test_image = app.config['ASSETS_DIR'] / 'test.png'
-    shutil.copy(source_image, test_image)
+    shutil.copy(RESOURCES_DIR / 'test.png', app.config['ASSETS_DIR'] / 'test.png')
 
     yield app
 
-    os.close(db_fd)
-    os.unlink(db_path)
-    test_image.unlink(missing_ok=True)
-
 
 class AuthActions():
     def __init__(self, client):
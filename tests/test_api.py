@@ -0,0 +1,126 @@
+#    Copyright 2021 Abigail Schubert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Unit tests for api.py """
+import json
+from omnom.common import get_recipe_db
+from omnom.recipe_db import RecipeEntry
+
+
+def test_list_recipes(client):
+    """ Listing returns the default fields of a page of recipes """
+    response = client.get('/api/recipes')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/json'
+    data = response.get_json()
+    assert [recipe['id'] for recipe in data['recipes']] == [1, 2, 3, 4]
+    assert data['next'] is None
+    assert data['recipes'][0]['name'] == 'Mac cheese'
+    assert data['recipes'][0]['food_type'] == 'Pasta'
+    assert set(data['recipes'][0]) == set(get_recipe_db().DEFAULT_FIELDS)
+    assert 'ingredients' not in data['recipes'][0]
+
+
+def test_list_recipes_pages(client):
+    """ Listing is keyset paginated, following the next cursor """
+    data = client.get('/api/recipes?limit=3&fields=name').get_json()
+    assert data == {'recipes': [{'id': 1, 'name': 'Mac cheese'},
+                                {'id': 2, 'name': 'Fried Rice'},
+                                {'id': 3, 'name': 'Wild rice and greens'}],
+                    'next': 3}
+    data = client.get('/api/recipes?limit=3&fields=name&after=3').get_json()
+    assert data == {'recipes': [{'id': 4, 'name': 'Caesar Salad'}], 'next': None}
+    data = client.get('/api/recipes?type=2&fields=id').get_json()
+    assert data == {'recipes': [{'id': 2}, {'id': 3}], 'next': None}
+
+
+def test_list_recipes_streamed(client):
+    """ Listing is streamed rather than built in memory """
+    response = client.get('/api/recipes?limit=2', buffered=False)
+    assert response.is_streamed
+    assert json.loads(response.get_data())['next'] == 2
+
+
+def test_recipes_by_ids(client, app):
+    """ ids fetches several recipes, in the order asked for, with one query """
+    with app.app_context():
+        db = get_recipe_db()
+        db.update_recipe(RecipeEntry(id=3, name='Greens', description='', type_id=2,
+                                     ingredients='* Kale'))
+    response = client.get('/api/recipes?ids=3,1,99,3&fields=name,ingredients,ingredients_html')
+    assert response.get_json() == {'recipes': [
+        {'id': 3, 'name': 'Greens', 'ingredients': '* Kale',
+         'ingredients_html': '<ul>\n<li>Kale</li>\n</ul>'},
+        {'id': 1, 'name': 'Mac cheese', 'ingredients': None, 'ingredients_html': ''},
+    ]}
+
+
+def test_get_recipe_fields_single_query(app):
+    """ RecipeDB.get_recipe_fields reads only the columns it needs in one query """
+    with app.app_context():
+        db = get_recipe_db()
+        statements = []
+        db.conn.set_trace_callback(statements.append)
+        assert [recipe['id'] for recipe in db.get_recipe_fields([4, 2], ['id', 'name'])] == [4, 2]
+        db.conn.set_trace_callback(None)
+    assert len(statements) == 1
+    assert ' IN (' in statements[0]
+    assert 'ingredients' not in statements[0]
+
+
+def test_statements_independent_of_request(app):
+    """ Field order and number of ids don't change the statement, so clients
+    can't add metric series or slow query log entries at will
+    """
+    with app.app_context():
+        db = get_recipe_db()
+        statements = []
+        db.conn.set_trace_callback(statements.append)
+        db.get_recipe_fields([1], ['name', 'photo'])
+        db.get_recipe_fields([4, 3, 2, 1], ['photo', 'name', 'id'])
+        db.conn.set_trace_callback(None)
+    assert len(set(statement.split('json_each')[0] for statement in statements)) == 1
+
+
+def test_recipe(client):
+    """ A single recipe, 404 if there isn't one """
+    data = client.get('/api/recipes/2?fields=name,food_type').get_json()
+    assert data == {'id': 2, 'name': 'Fried Rice', 'food_type': 'Grains'}
+    response = client.get('/api/recipes/99')
+    assert response.status_code == 404
+    assert response.get_json() == {'error': 'no such recipe'}
+
+
+def test_bad_requests(client):
+    """ Bad query args get a JSON error """
+    for url in ['/api/recipes?fields=name,password', '/api/recipes?fields=',
+                '/api/recipes?ids=1,a', '/api/recipes?ids=' + ','.join(['1'] * 101),
+                '/api/recipes?limit=0', '/api/recipes?limit=100000']:
+        response = client.get(url)
+        assert response.status_code == 400, url
+        assert 'error' in response.get_json()
+
+
+def test_recipes_not_modified(client, auth, app):
+    """ Responses carry an ETag, answered with 304 until a recipe changes """
+    for url in ['/api/recipes', '/api/recipes?ids=1,2', '/api/recipes/1']:
+        etag = client.get(url).headers['ETag']
+        assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+    etags = {url: client.get(url).headers['ETag'] for url in ['/api/recipes', '/api/recipes/1']}
+    with app.app_context():
+        get_recipe_db().update_recipe(RecipeEntry(id=1, name='Mac', description='', type_id=1))
+    for url, etag in etags.items():
+        response = client.get(url, headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.get_json()['recipes' if url == '/api/recipes' else 'name']
@@ -13,11 +13,85 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """ Tests for the main app """
+from pathlib import Path
+import subprocess
+import sys
+from omnom import migrate
 from omnom.app import create_app
+from omnom.db import connect
+from omnom.common import get_asset_db, get_recipe_db, get_user_db
 
 
-def test_index():
-    app = create_app()
+def test_index(tmp_path):
+    """ A fresh instance serves the index once migrated """
+    app = create_app({'AUTO_MIGRATE': True}, instance_path=str(tmp_path))
     tester = app.test_client()
     response = tester.get('/', content_type='html/text')
     assert response.status_code == 200
+
+
+def test_pending_migrations_warning(tmp_path, caplog):
+    """ Without AUTO_MIGRATE, the app leaves the db alone and warns it's behind """
+    db_path = tmp_path / 'omnom.sqlite'
+    connect(db_path).close()
+    create_app(instance_path=str(tmp_path))
+    assert 'run `flask db-upgrade`' in caplog.text
+    conn = connect(db_path)
+    assert migrate.schema_version(conn) == 0
+    conn.close()
+
+
+def test_init_db_command(app):
+    """ init-db resets the db and preloads the sample recipes """
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['init-db'])
+    assert 'Initialized the database.' in result.output
+    with app.app_context():
+        rdb = get_recipe_db()
+        assert len(rdb.get_all_types()) == 4
+        assert rdb.get_recipe(2).name == 'Blueberry Muffins'
+        assert get_user_db().get_user_by_name('admin') is not None
+
+
+def test_create_app_defers_heavy_imports(tmp_path):
+    """ markdown, bleach and Pillow aren't loaded until first used """
+    code = ('import sys\n'
+            'from omnom.app import create_app\n'
+            'create_app(instance_path={!r})\n'
+            'print(",".join(m for m in ("markdown", "bleach", "PIL") if m in sys.modules))\n'
+            ).format(str(tmp_path))
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                            check=True, cwd=Path(__file__).parent.parent)
+    assert result.stdout.strip() == ''
+
+
+def test_gc_assets_command(app):
+    """ gc-assets removes unused assets and reports the space reclaimed """
+    with app.app_context():
+        get_asset_db().add_asset('test.png', 1024 * 1024)
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['gc-assets'])
+    assert 'Removed 0 unused assets, reclaimed 0.0 MB.' in result.output
+    result = runner.invoke(args=['gc-assets', '--grace-period', '-1'])
+    assert 'Removed 1 unused assets' in result.output
+    assert not (app.config['ASSETS_DIR'] / 'test.png').exists()
+
+
+def test_migrate_assets_command(app):
+    """ migrate-assets reports how many assets it moved """
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['migrate-assets'])
+    assert result.exit_code == 0
+    assert 'Moved 0 assets to subdirectories.' in result.output
+
+
+def test_warmup_command(app, tmp_path):
+    """ warmup fills the template bytecode cache """
+    app = create_app({'TESTING': True, 'DATABASE': app.config['DATABASE'],
+                      'TEMPLATE_CACHE_DIR': tmp_path}, instance_path=app.instance_path)
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['warmup'])
+    assert result.exit_code == 0
+    count = len(app.jinja_env.list_templates())
+    assert 'Compiled {} templates.'.format(count) in result.output
+    assert len(list(tmp_path.glob('__jinja2_*.cache'))) == count
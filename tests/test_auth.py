@@ -12,9 +12,12 @@
 #
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import threading
 import pytest
 from flask import g, session
 from omnom.common import get_user_db
+from omnom.passwords import AttemptThrottle, HashExecutor, HashingBusyError, needs_rehash
+from omnom.user_db import UserDB
 
 
 def test_register(client, app):
@@ -67,3 +70,103 @@ def test_logout(auth):
     auth.login()
     auth.logout()
     assert 'user_id' not in session
+
+
+def test_user_loaded_lazily(client, auth, monkeypatch):
+    """ requests that never read g.user don't look up the user """
+    auth.login()
+    lookups = []
+    monkeypatch.setattr(UserDB, 'get_user', lambda self, id_number: lookups.append(id_number))
+    assert client.get('/assets/test.png').status_code == 200
+    assert client.get('/static/style.css').status_code == 200
+    assert lookups == []
+    client.get('/')
+    assert lookups == [1]
+
+
+def test_login_throttled(app, auth, monkeypatch):
+    """ after too many failures, logins are refused without hashing """
+    app.config['LOGIN_MAX_ATTEMPTS'] = 2
+    for _ in range(2):
+        assert b'Incorrect password.' in auth.login('test', 'wrong').data
+    checks = []
+    monkeypatch.setattr('omnom.auth_view.check_password', lambda *args: checks.append(args))
+    response = auth.login('test', 'test')
+    assert response.status_code == 429
+    assert b'Too many attempts' in response.data
+    assert checks == []
+
+
+def test_login_busy(auth, monkeypatch):
+    """ logins are turned away when the hashing pool is full """
+    def busy(*args):
+        raise HashingBusyError()
+    monkeypatch.setattr('omnom.auth_view.check_password', busy)
+    response = auth.login()
+    assert response.status_code == 503
+    assert 'user_id' not in session
+
+
+def test_login_rehashes_password(app, auth):
+    """ a password hashed with old settings is rehashed on login """
+    with app.app_context():
+        assert get_user_db().get_user_by_name('test').password.startswith('pbkdf2:sha256:50000$')
+    auth.login()
+    with app.app_context():
+        new_hash = get_user_db().get_user_by_name('test').password
+        assert new_hash.startswith(app.config['PASSWORD_HASH_METHOD'] + '$')
+    auth.logout()
+    assert auth.login().status_code == 302
+
+
+@pytest.mark.parametrize('method, pwhash, expected', [
+    ('pbkdf2:sha256', 'pbkdf2:sha256:260000$salt$hash', False),
+    ('pbkdf2:sha256:260000', 'pbkdf2:sha256:260000$salt$hash', False),
+    ('pbkdf2:sha256:260000', 'pbkdf2:sha256$salt$hash', False),
+    ('pbkdf2:sha256', 'pbkdf2:sha256:50000$salt$hash', True),
+    ('pbkdf2:sha512:260000', 'pbkdf2:sha256:260000$salt$hash', True),
+    ('pbkdf2:sha256', 'sha256$salt$hash', True),
+])
+def test_needs_rehash(app, method, pwhash, expected):
+    """ methods are compared with werkzeug's default iterations filled in """
+    app.config['PASSWORD_HASH_METHOD'] = method
+    with app.app_context():
+        assert needs_rehash(pwhash) == expected
+
+
+def test_hash_executor_rejects_when_full():
+    executor = HashExecutor(max_workers=1, max_queue=0)
+    started, release = threading.Event(), threading.Event()
+
+    def slow_hash():
+        started.set()
+        release.wait()
+        return 'done'
+
+    results = []
+    thread = threading.Thread(target=lambda: results.append(executor.run(slow_hash)))
+    thread.start()
+    started.wait()
+    with pytest.raises(HashingBusyError):
+        executor.run(lambda: 'other')
+    release.set()
+    thread.join()
+    assert results == ['done']
+    assert executor.run(lambda: 'other') == 'other'
+    executor.shutdown()
+
+
+def test_attempt_throttle_window(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('omnom.passwords.time.monotonic', lambda: now[0])
+    throttle = AttemptThrottle(max_attempts=2, window=10)
+    throttle.failed('a', 'b')
+    throttle.failed('a')
+    assert throttle.is_blocked('a')
+    assert throttle.is_blocked('b', 'a')
+    assert not throttle.is_blocked('b')
+    now[0] += 11
+    assert not throttle.is_blocked('a')
+    throttle.failed('b')
+    throttle.reset('b')
+    assert not throttle.is_blocked('b')
@@ -0,0 +1,90 @@
+#    Copyright 2021 Abigail Schubert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Unit tests for db.py """
+from pathlib import Path
+import threading
+import pytest
+from flask import g
+from omnom.common import get_recipe_db, get_user_db
+from omnom.db import ConnectionPool, PoolTimeoutError
+
+
+@pytest.fixture
+def pool(tmp_path):
+    """ A small connection pool to an empty db """
+    pool = ConnectionPool(Path(tmp_path) / 'foo.db', max_size=2, timeout=0.1)
+    yield pool
+    pool.close()
+
+
+def test_pool_reuses_connections(pool):
+    """ Released connections are handed out again instead of reconnecting """
+    conn = pool.acquire()
+    pool.release(conn)
+    assert pool.acquire() is conn
+
+
+def test_pool_is_bounded(pool):
+    """ acquire times out once max_size connections are in use """
+    first = pool.acquire()
+    pool.acquire()
+    with pytest.raises(PoolTimeoutError):
+        pool.acquire()
+    pool.release(first)
+    assert pool.acquire() is first
+
+
+def test_pool_discards_broken_connections(pool):
+    """ Connections that fail the health check are replaced """
+    conn = pool.acquire()
+    pool.release(conn)
+    conn.close()
+    new_conn = pool.acquire()
+    assert new_conn is not conn
+    assert new_conn.execute('SELECT 1').fetchone()[0] == 1
+
+
+def test_pool_rolls_back_on_release(pool):
+    """ Uncommitted changes don't leak to the next user of a connection """
+    conn = pool.acquire()
+    conn.execute('CREATE TABLE foo (bar INTEGER)')
+    conn.commit()
+    conn.execute('INSERT INTO foo VALUES (1)')
+    pool.release(conn)
+    assert pool.acquire().execute('SELECT COUNT(*) FROM foo').fetchone()[0] == 0
+
+
+def test_pool_connections_shared_between_threads(pool):
+    """ A connection released by one thread can be used by another """
+    conn = pool.acquire()
+    pool.release(conn)
+    result = []
+    def worker():
+        worker_conn = pool.acquire()
+        result.append(worker_conn.execute('SELECT 1').fetchone()[0])
+        pool.release(worker_conn)
+    thread = threading.Thread(target=worker)
+    thread.start()
+    thread.join()
+    assert result == [1]
+
+
+def test_request_shares_one_connection(app):
+    """ RecipeDB and UserDB share a pooled connection, returned on teardown """
+    with app.app_context():
+        assert get_recipe_db().conn is get_user_db().conn
+        conn = g._db_conn
+    with app.app_context():
+        assert get_user_db().conn is conn
@@ -13,9 +13,34 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """ Unit tests for images.py """
+import hashlib
+import io
+import os
+from pathlib import Path
 import shutil
+import threading
+import pytest
 from conftest import RESOURCES_DIR
-from omnom.images import save_to_assets, remove_asset
+from omnom import images
+from omnom.common import get_asset_db, get_recipe_db
+from omnom.images import (PHOTO_SIZES, InvalidAssetError, PhotoTooLargeError, collect_garbage,
+                          content_hash, fanout_path, generate_variants, migrate_assets,
+                          remove_asset, resolve_asset, save_to_assets, schedule_variants,
+                          sniff_image_type, variant_filename)
+from omnom.recipe_db import RecipeEntry
+
+
+class CountingStream(io.BytesIO):
+    """ In-memory stream which tracks how many bytes have been read from it """
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.bytes_read += len(data)
+        return data
 
 
 class FakeFileStorage:
@@ -30,6 +55,16 @@ class FakeFileStorage:
         """
         self.src = src
         self.filename = filename
+        self.stream = open(src, 'rb')
+
+    @classmethod
+    def from_bytes(cls, data, filename):
+        """ Create a FakeFileStorage object uploading data """
+        self = cls.__new__(cls)
+        self.src = None
+        self.filename = filename
+        self.stream = CountingStream(data)
+        return self
 
     def save(self, dest):
         """ Copy file to dest location """
@@ -56,8 +91,379 @@ def test_save_to_assets(client):
     """ save_to_assets correctly stores file in assets dir """
     uploaded_file = FakeFileStorage(RESOURCES_DIR / 'test.png', 'foo.png')
     new_asset = save_to_assets(uploaded_file, 'mynewfile')
-    assert new_asset.startswith('mynewfile')
+    assert new_asset == fanout_path(new_asset)
+    assert new_asset.split('/')[2].startswith('mynewfile')
     assert new_asset.endswith('.png')
     response = client.get('/assets/{}'.format(new_asset))
     assert response == 200
     assert response.mimetype == 'image/png'
+
+
+def test_get_image_variant_fallback(client):
+    """ Requesting a size variant that isn't ready yet returns the original """
+    response = client.get('/assets/test.png?size=thumb')
+    assert response.status_code == 200
+    assert response.mimetype == 'image/png'
+
+
+def test_generate_variants(app, client):
+    """ generate_variants writes a resized jpeg for each size, served by size """
+    pytest.importorskip('PIL')
+    written = generate_variants(app.config['ASSETS_DIR'], 'test.png')
+    assert written == [variant_filename('test.png', size) for size in PHOTO_SIZES]
+    response = client.get('/assets/test.png?size=thumb')
+    assert response.mimetype == 'image/jpeg'
+    assert len(response.data) < (RESOURCES_DIR / 'test.png').stat().st_size
+    for variant in written:
+        (app.config['ASSETS_DIR'] / variant).unlink()
+
+
+def test_save_to_assets_schedules_variants(app, client):
+    """ save_to_assets generates variants in the background """
+    pytest.importorskip('PIL')
+    uploaded_file = FakeFileStorage(RESOURCES_DIR / 'test.png', 'foo.png')
+    future = schedule_variants(save_to_assets(uploaded_file, 'mynewfile'))
+    assert len(future.result(timeout=10)) == len(PHOTO_SIZES)
+
+
+def test_save_to_assets_dedupes(app, client):
+    """ Saving the same content twice stores one content addressed file """
+    first = save_to_assets(FakeFileStorage(RESOURCES_DIR / 'test.png', 'a.png'), 'recipe')
+    second = save_to_assets(FakeFileStorage(RESOURCES_DIR / 'test.png', 'b.png'), 'recipe')
+    assert first == second
+    assert content_hash(first) == hashlib.sha256((RESOURCES_DIR / 'test.png').read_bytes()).hexdigest()
+    assert not list(app.config['ASSETS_DIR'].glob('.tmp_*'))
+    assert get_asset_db().get_refcount(first) == 0
+    assert remove_asset(first)
+    assert get_asset_db().get_refcount(first) is None
+
+
+def test_remove_asset_in_use(app, client):
+    """ remove_asset keeps assets that a recipe still uses """
+    photo = save_to_assets(FakeFileStorage(RESOURCES_DIR / 'test.png', 'a.png'), 'recipe')
+    rdb = get_recipe_db()
+    recipe_id = rdb.add_recipe(RecipeEntry(name='Toast', description='', type_id=1, photo=photo))
+    assert get_asset_db().get_refcount(photo) == 1
+    assert not remove_asset(photo)
+    assert (app.config['ASSETS_DIR'] / photo).is_file()
+    rdb.delete_recipe(recipe_id)
+    assert get_asset_db().get_refcount(photo) == 0
+    assert remove_asset(photo)
+    assert not (app.config['ASSETS_DIR'] / photo).exists()
+
+
+def test_remove_asset_races_upload(app, client, monkeypatch):
+    """ An upload of the same content while an asset is being removed waits,
+    then stores the file again, rather than using the file being removed
+    """
+    photo = save_to_assets(FakeFileStorage(RESOURCES_DIR / 'test.png', 'a.png'), 'recipe')
+    unlink_asset_files = images._unlink_asset_files
+    results = []
+
+    def upload():
+        with app.app_context():
+            saved = save_to_assets(FakeFileStorage(RESOURCES_DIR / 'test.png', 'b.png'), 'recipe')
+            results.append(get_recipe_db().add_recipe(
+                RecipeEntry(name='Toast', description='', type_id=1, photo=saved)))
+
+    def racing_unlink(assets_dir, filename):
+        thread = threading.Thread(target=upload)
+        thread.start()
+        thread.join(0.5)  # blocked on the transaction
+        assert thread.is_alive()
+        racing_unlink.thread = thread
+        return unlink_asset_files(assets_dir, filename)
+
+    monkeypatch.setattr(images, '_unlink_asset_files', racing_unlink)
+    assert remove_asset(photo)
+    racing_unlink.thread.join(10)
+    assert results
+    assert (app.config['ASSETS_DIR'] / photo).is_file()
+    assert get_asset_db().get_refcount(photo) == 1
+
+
+def test_get_content_addressed_image(client):
+    """ Content addressed assets are sent with a strong ETag and cached forever """
+    photo = save_to_assets(FakeFileStorage(RESOURCES_DIR / 'test.png', 'a.png'), 'recipe')
+    response = client.get('/assets/{}'.format(photo))
+    assert response.headers['ETag'] == '"{}"'.format(content_hash(photo))
+    assert response.cache_control.immutable
+    assert response.cache_control.max_age == 365 * 24 * 60 * 60
+    response = client.get('/assets/{}'.format(photo),
+                          headers={'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 304
+    assert not client.get('/assets/test.png').cache_control.immutable
+
+
+def test_sniff_image_type():
+    """ Image types are recognised by their leading bytes """
+    assert sniff_image_type((RESOURCES_DIR / 'test.png').read_bytes()) == 'png'
+    assert sniff_image_type(b'\xff\xd8\xff\xe0\x00\x10JFIF') == 'jpeg'
+    assert sniff_image_type(b'GIF89a\x01\x00') == 'gif'
+    assert sniff_image_type(b'<svg xmlns=') is None
+    assert sniff_image_type(b'') is None
+
+
+@pytest.mark.parametrize('header, filename', [
+    (b'GIF89a', 'a.exe'),
+    (b'<html>', 'a.png'),
+    (b'GIF89a', 'a.png'),
+], ids=['extension', 'not-image', 'mismatch'])
+def test_save_to_assets_rejects_invalid(app, client, header, filename):
+    """ Uploads that aren't the image they claim to be are rejected unread """
+    before = set(app.config['ASSETS_DIR'].iterdir())
+    upload = FakeFileStorage.from_bytes(header + b'\0' * 1024 * 1024, filename)
+    with pytest.raises(InvalidAssetError):
+        save_to_assets(upload, 'rejected')
+    assert upload.stream.bytes_read <= 16
+    assert set(app.config['ASSETS_DIR'].iterdir()) == before
+
+
+def test_save_to_assets_size_limit(app, client):
+    """ Uploads are cut off as soon as they exceed MAX_PHOTO_SIZE """
+    app.config['MAX_PHOTO_SIZE'] = 256 * 1024
+    upload = FakeFileStorage.from_bytes(b'\xff\xd8\xff' + b'\0' * 1024 * 1024, 'a.JPG')
+    before = set(app.config['ASSETS_DIR'].iterdir())
+    with pytest.raises(InvalidAssetError):
+        save_to_assets(upload, 'recipe')
+    assert upload.stream.bytes_read < 512 * 1024
+    assert set(app.config['ASSETS_DIR'].iterdir()) == before
+    upload = FakeFileStorage.from_bytes(b'\xff\xd8\xff' + b'\0' * 1024, 'a.JPG')
+    assert save_to_assets(upload, 'recipe').endswith('.jpg')
+
+
+def _age_assets(seconds):
+    """ Make every unused asset look unused for another seconds """
+    get_asset_db().conn.execute('UPDATE asset SET unreferenced_at = unreferenced_at - ?',
+                                (seconds,))
+    get_asset_db().conn.commit()
+
+
+def test_collect_garbage(app, client):
+    """ Photos of deleted recipes are collected once the grace period is over """
+    photo = save_to_assets(FakeFileStorage(RESOURCES_DIR / 'test.png', 'a.png'), 'gc')
+    kept = save_to_assets(FakeFileStorage.from_bytes(b'GIF89a', 'b.gif'), 'gc')
+    rdb = get_recipe_db()
+    recipe_id = rdb.add_recipe(RecipeEntry(name='Toast', description='', type_id=1, photo=photo))
+    rdb.add_recipe(RecipeEntry(name='Jam', description='', type_id=1, photo=kept))
+    _age_assets(7200)
+    assert collect_garbage(3600) == (0, 0)
+
+    rdb.delete_recipe(recipe_id)
+    assert collect_garbage(3600) == (0, 0)
+    assert (app.config['ASSETS_DIR'] / photo).is_file()
+    _age_assets(7200)
+    removed, reclaimed = collect_garbage(3600, batch_size=1)
+    assert removed == 1
+    # size variants may have been generated in the background, and go too
+    assert reclaimed >= (RESOURCES_DIR / 'test.png').stat().st_size
+    assert not (app.config['ASSETS_DIR'] / photo).exists()
+    assert get_asset_db().get_refcount(photo) is None
+    assert (app.config['ASSETS_DIR'] / kept).is_file()
+    assert get_asset_db().get_refcount(kept) == 1
+
+
+def test_collect_garbage_reupload(app, client):
+    """ Uploading an unused asset again restarts its grace period """
+    photo = save_to_assets(FakeFileStorage(RESOURCES_DIR / 'test.png', 'a.png'), 'gc')
+    _age_assets(7200)
+    assert save_to_assets(FakeFileStorage(RESOURCES_DIR / 'test.png', 'b.png'), 'gc') == photo
+    assert collect_garbage(3600) == (0, 0)
+    _age_assets(7200)
+    assert collect_garbage(3600, max_batches=1)[0] == 1
+
+
+def test_collect_garbage_tracks_imported_photos(app, client):
+    """ Photos set on recipes without being uploaded are tracked too """
+    rdb = get_recipe_db()
+    recipe_id = rdb.add_recipe(RecipeEntry(name='Toast', description='', type_id=1,
+                                           photo='test.png'))
+    assert get_asset_db().get_refcount('test.png') == 1
+    rdb.delete_recipe(recipe_id)
+    _age_assets(60)
+    assert collect_garbage(0)[0] == 1
+    assert not (app.config['ASSETS_DIR'] / 'test.png').exists()
+
+
+def test_garbage_collected_in_background(app, client, monkeypatch):
+    """ Requests periodically schedule garbage collection """
+    calls = []
+    monkeypatch.setattr('omnom.images.collect_garbage', lambda *args, **kwargs: calls.append(args))
+    app.config['ASSET_GC_INTERVAL'] = 0
+    client.get('/')
+    client.get('/')
+    app.extensions['omnom_photo_workers'].shutdown(wait=True)
+    assert calls == [(app.config['ASSET_GC_GRACE_PERIOD'],)] * 2
+
+
+def test_fanout_path():
+    """ Assets fan out by content hash, or by name hash for older assets """
+    digest = 'abcd' + '0' * 60
+    assert fanout_path('recipe_{}.png'.format(digest)) == 'ab/cd/recipe_{}.png'.format(digest)
+    name_digest = hashlib.sha256(b'test.png').hexdigest()
+    assert fanout_path('test.png') == '{}/{}/test.png'.format(name_digest[:2], name_digest[2:4])
+    assert fanout_path(fanout_path('test.png')) == fanout_path('test.png')
+
+
+def test_get_image_either_layout(app, client):
+    """ Assets are served by either name, whichever layout they're stored in """
+    assets_dir = app.config['ASSETS_DIR']
+    fanned = fanout_path('test.png')
+    assert resolve_asset(assets_dir, 'test.png') == 'test.png'
+    assert client.get('/assets/{}'.format(fanned)).status_code == 200
+    (assets_dir / fanned).parent.mkdir(parents=True, exist_ok=True)
+    (assets_dir / 'test.png').rename(assets_dir / fanned)
+    try:
+        assert resolve_asset(assets_dir, 'test.png') == fanned
+        assert client.get('/assets/test.png').mimetype == 'image/png'
+        assert client.get('/assets/{}'.format(fanned)).mimetype == 'image/png'
+        assert client.get('/assets/{}?size=thumb'.format(fanned)).mimetype == 'image/png'
+    finally:
+        (assets_dir / fanned).unlink()
+    assert client.get('/assets/test.png').status_code == 404
+    assert client.get('/assets/../conftest.py').status_code == 404
+
+
+def test_migrate_assets(app, client):
+    """ migrate_assets moves flat assets and renames the photos using them """
+    assets_dir = app.config['ASSETS_DIR']
+    rdb = get_recipe_db()
+    recipe_id = rdb.add_recipe(RecipeEntry(name='Toast', description='', type_id=1,
+                                           photo='test.png'))
+    rdb.add_recipe(RecipeEntry(name='Jam', description='', type_id=1, photo='test.png'))
+    shutil.copy(assets_dir / 'test.png', assets_dir / variant_filename('test.png', 'thumb'))
+    fanned = fanout_path('test.png')
+    try:
+        assert migrate_assets(batch_size=1) == 1
+        assert rdb.get_recipe(recipe_id).photo == fanned
+        assert (assets_dir / fanned).is_file()
+        assert (assets_dir / variant_filename(fanned, 'thumb')).is_file()
+        assert not (assets_dir / 'test.png').exists()
+        assert get_asset_db().get_refcount(fanned) == 2
+        assert get_asset_db().get_refcount('test.png') is None
+        assert migrate_assets() == 0
+    finally:
+        _unlink_fanned(assets_dir, fanned)
+
+
+def test_migrate_assets_resumes(app, client):
+    """ Assets moved by an interrupted migration are still renamed """
+    assets_dir = app.config['ASSETS_DIR']
+    rdb = get_recipe_db()
+    recipe_id = rdb.add_recipe(RecipeEntry(name='Toast', description='', type_id=1,
+                                           photo='test.png'))
+    fanned = fanout_path('test.png')
+    (assets_dir / fanned).parent.mkdir(parents=True, exist_ok=True)
+    (assets_dir / 'test.png').rename(assets_dir / fanned)
+    try:
+        assert client.get('/assets/test.png').status_code == 200
+        assert migrate_assets() == 1
+        assert rdb.get_recipe(recipe_id).photo == fanned
+        assert client.get('/assets/{}'.format(fanned)).status_code == 200
+    finally:
+        _unlink_fanned(assets_dir, fanned)
+
+
+def _unlink_fanned(assets_dir, filename):
+    """ Remove filename and its variants from the shared assets dir """
+    for name in [filename] + [variant_filename(filename, size) for size in PHOTO_SIZES]:
+        (assets_dir / name).unlink(missing_ok=True)
+
+
+def _multipart_request(app, data, filename):
+    """ Request context posting data as file filename, reading the body from
+    a CountingStream
+    """
+    boundary = 'omnomboundary'
+    body = ('--{0}\r\nContent-Disposition: form-data; name="name"\r\n\r\nToast\r\n'
+            '--{0}\r\nContent-Disposition: form-data; name="recipe_img_file"; '
+            'filename="{1}"\r\nContent-Type: application/octet-stream\r\n\r\n').format(
+                boundary, filename).encode('ascii')
+    body += data + '\r\n--{}--\r\n'.format(boundary).encode('ascii')
+    stream = CountingStream(body)
+    context = app.test_request_context(
+        '/recipes/create', method='POST', input_stream=stream, content_length=len(body),
+        content_type='multipart/form-data; boundary={}'.format(boundary))
+    return context, stream
+
+
+def test_upload_streamed_into_assets_dir(app, client):
+    """ Uploads are written into the assets dir as they're parsed, then renamed """
+    # new content, so it isn't already stored
+    data = (RESOURCES_DIR / 'test.png').read_bytes() + os.urandom(16)
+    context, _ = _multipart_request(app, data, 'a.png')
+    with context:
+        upload = context.request.files['recipe_img_file'].stream
+        assert Path(upload.name).parent == app.config['ASSETS_DIR']
+        inode = os.stat(upload.name).st_ino
+        photo = save_to_assets(context.request.files['recipe_img_file'], 'stream')
+        assert (app.config['ASSETS_DIR'] / photo).stat().st_ino == inode
+        assert not Path(upload.name).exists()
+    _unlink_fanned(app.config['ASSETS_DIR'], photo)
+
+
+@pytest.mark.parametrize('header, filename', [
+    (b'GIF89a', 'a.exe'),
+    (b'<html>', 'a.png'),
+], ids=['extension', 'not-image'])
+def test_upload_rejected_while_parsing(app, client, header, filename):
+    """ Parsing stops at the first sign of a bad photo, long before the end """
+    before = set(app.config['ASSETS_DIR'].iterdir())
+    context, stream = _multipart_request(app, header + b'\0' * 4 * 1024 * 1024, filename)
+    with context:
+        with pytest.raises(InvalidAssetError):
+            context.request.files.get('recipe_img_file')
+    assert stream.bytes_read < 1024 * 1024
+    assert set(app.config['ASSETS_DIR'].iterdir()) == before
+
+
+def test_upload_size_limit_while_parsing(app, client):
+    """ Parsing stops once a photo grows past MAX_PHOTO_SIZE """
+    app.config['MAX_PHOTO_SIZE'] = 1024 * 1024
+    before = set(app.config['ASSETS_DIR'].iterdir())
+    context, stream = _multipart_request(app, b'GIF89a' + b'\0' * 8 * 1024 * 1024, 'a.gif')
+    with context:
+        with pytest.raises(PhotoTooLargeError):
+            context.request.files.get('recipe_img_file')
+    assert stream.bytes_read < 2 * 1024 * 1024
+    assert set(app.config['ASSETS_DIR'].iterdir()) == before
+
+
+def test_upload_elsewhere_not_streamed(app, client):
+    """ Files sent to views that don't take photos aren't treated as photos """
+    before = set(app.config['ASSETS_DIR'].iterdir())
+    response = client.post('/auth/login', content_type='multipart/form-data',
+                           data={'username': 'test', 'password': 'wrong',
+                                 'attachment': (io.BytesIO(b'hello'), 'a.txt')})
+    assert response.status_code == 200
+    client.get('/')
+    assert set(app.config['ASSETS_DIR'].iterdir()) == before
+
+
+@pytest.mark.parametrize('error, status', [
+    (InvalidAssetError('Photo is not a valid png image.'), 400),
+    (PhotoTooLargeError('Photo is too large, the limit is 1 MB.'), 413),
+], ids=['invalid', 'too-large'])
+def test_rejected_photo_status(app, client, error, status):
+    """ Photos rejected outside the recipe editor are client errors """
+    def view():
+        raise error
+    app.add_url_rule('/test-upload', 'test_upload', view, methods=['POST'])
+    response = client.post('/test-upload')
+    assert response.status_code == status
+    assert str(error).encode('utf-8') in response.data
+
+
+def test_unused_upload_removed(app, client, auth):
+    """ Uploads the request didn't keep are removed when it ends """
+    auth.login()
+    before = set(app.config['ASSETS_DIR'].iterdir())
+    with open(RESOURCES_DIR / 'test.png', 'rb') as photo:
+        response = client.post('/recipes/create', content_type='multipart/form-data',
+                               data={'name': '', 'description': '', 'food_type': '1',
+                                     'ingredients': '', 'instructions': '',
+                                     'recipe_img_file': (photo, 'a.png')})
+    assert b'Recipe name is required.' in response.data
+    # the test client keeps each request open until it makes the next one
+    client.get('/')
+    assert set(app.config['ASSETS_DIR'].iterdir()) == before
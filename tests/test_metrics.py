@@ -0,0 +1,118 @@
+#    Copyright 2021 Abigail Schubert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Tests for metrics """
+import pytest
+from omnom.metrics import Metric, Registry
+from omnom.page_cache import PageCache
+
+
+def test_histogram_exposition():
+    registry = Registry()
+    histogram = registry.histogram('test_seconds', 'A test', ['name'], buckets=(0.1, 1.0))
+    histogram.observe(0.05, name='a')
+    histogram.observe(0.5, name='a')
+    histogram.observe(5, name='a"b')
+    text = registry.expose()
+    assert '# TYPE test_seconds histogram' in text
+    assert 'test_seconds_bucket{name="a",le="0.1"} 1' in text
+    assert 'test_seconds_bucket{name="a",le="1.0"} 2' in text
+    assert 'test_seconds_bucket{name="a",le="+Inf"} 2' in text
+    assert 'test_seconds_count{name="a"} 2' in text
+    assert 'test_seconds_sum{name="a"} 0.55' in text
+    assert 'test_seconds_count{name="a\\"b"} 1' in text
+
+
+def test_counter_needs_labels():
+    registry = Registry()
+    counter = registry.counter('test_total', 'A test', ['name'])
+    counter.inc(name='a')
+    with pytest.raises(ValueError):
+        counter.inc(other='a')
+    assert 'test_total{name="a"} 1' in registry.expose()
+
+
+def test_processes_aggregate(tmp_path):
+    """ Registries sharing a directory (one per process) report combined totals """
+    registries = []
+    for _ in range(2):
+        registry = Registry()
+        registry.directory = tmp_path
+        registry.counter('test_total', 'A test').inc(3)
+        registries.append(registry)
+    # both write separate files, though the test runs them in one process
+    registries[0].flush(force=True)
+    assert 'test_total 6' in registries[1].expose()
+
+
+def test_metrics_endpoint(client, app):
+    assert client.get('/recipes/1').status_code == 200
+    assert client.get('/recipes/1').status_code == 200
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    text = response.get_data(as_text=True)
+    assert 'omnom_request_seconds_count{endpoint="recipes.full_recipe",method="GET"}' in text
+    assert 'omnom_requests_total{endpoint="recipes.full_recipe",method="GET",status="200"}' in text
+    assert 'omnom_response_bytes_count{endpoint="recipes.full_recipe"}' in text
+    assert 'omnom_page_cache_requests_total{result="hit"}' in text
+    assert 'omnom_db_query_seconds_count{statement="SELECT * from recipe WHERE id=?"}' in text
+    assert 'omnom_template_seconds_count{template="recipes/full_recipe.html"}' in text
+
+
+def test_exiting_process_retires_its_file(tmp_path):
+    """ An exiting process folds its samples into the retired file """
+    registries = []
+    for _ in range(2):
+        registry = Registry()
+        registry.directory = tmp_path
+        registry.counter('test_total', 'A test').inc(3)
+        registry.histogram('test_seconds', 'A test', buckets=(1.0,)).observe(0.5)
+        registry.flush(force=True)
+        registries.append(registry)
+    registries[0].retire()
+    registries[1].retire()
+    assert sorted(path.name for path in tmp_path.glob('metrics-*.json')) == [
+        'metrics-retired.json']
+    reader = Registry()
+    reader.directory = tmp_path
+    reader.counter('test_total', 'A test').inc()
+    reader.histogram('test_seconds', 'A test', buckets=(1.0,))
+    text = reader.expose()
+    assert 'test_total 7' in text
+    assert 'test_seconds_count 2' in text
+
+
+def test_dead_process_file_retired(tmp_path):
+    """ Files of processes that died without retiring are retired on scrape """
+    dead = Registry()
+    dead.directory = tmp_path
+    dead.counter('test_total', 'A test').inc(2)
+    dead.flush(force=True)
+    # a pid beyond pid_max never belongs to a live process
+    dead._filename().rename(tmp_path / 'metrics-{}-{}.json'.format(2 ** 31 - 1, dead._token))
+    registry = Registry()
+    registry.directory = tmp_path
+    registry.counter('test_total', 'A test').inc()
+    assert 'test_total 3' in registry.expose()
+    assert not list(tmp_path.glob('metrics-{}-*.json'.format(2 ** 31 - 1)))
+    assert (tmp_path / 'metrics-retired.json').exists()
+    # retired samples are counted once
+    assert 'test_total 3' in registry.expose()
+
+
+@pytest.mark.parametrize('cls', [Metric, PageCache])
+def test_abstract_bases(cls):
+    with pytest.raises(TypeError):
+        cls('test_total', 'A test') if cls is Metric else cls()
@@ -0,0 +1,111 @@
+#    Copyright 2021 Abigail Schubert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Tests for schema migrations """
+from pathlib import Path
+import pytest
+from omnom import migrate
+from omnom.db import connect
+from omnom.recipe_db import RecipeDB, RecipeEntry
+
+# The schema before migrations existed
+BASELINE_SCHEMA = '''
+CREATE TABLE food_type (id INTEGER PRIMARY KEY AUTOINCREMENT, food_type TEXT NOT NULL UNIQUE);
+CREATE TABLE recipe (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL,
+    description TEXT, type_id INTEGER, photo TEXT, ingredients TEXT, instructions TEXT,
+    FOREIGN KEY (type_id) REFERENCES food_type (id));
+CREATE TABLE user (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL UNIQUE,
+    password TEXT NOT NULL);
+INSERT INTO food_type (food_type) VALUES ('Pasta');
+INSERT INTO recipe (name, description, type_id, photo, ingredients) VALUES
+    ('Mac cheese', 'A tasty dish', 1, 'mac.jpg', '* Macaroni'),
+    ('Gone', 'Deleted', 1, NULL, NULL),
+    ('Pesto', 'Green', 1, 'mac.jpg', NULL);
+DELETE FROM recipe WHERE name = 'Gone';
+'''
+
+
+def test_upgrade_empty(tmp_path):
+    conn = connect(Path(tmp_path) / 'new.db')
+    applied = migrate.upgrade(conn)
+    assert [migration.version for migration in applied] == list(range(1, len(applied) + 1))
+    assert migrate.schema_version(conn) == len(migrate.find_migrations())
+    assert migrate.upgrade(conn) == []
+    assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+
+def test_upgrade_baseline(tmp_path):
+    """ A db from before migrations existed is upgraded keeping its data """
+    db_filename = Path(tmp_path) / 'old.db'
+    conn = connect(db_filename)
+    conn.executescript(BASELINE_SCHEMA)
+    migrate.upgrade(conn)
+
+    rdb = RecipeDB(conn=conn)
+    recipe = rdb.get_recipe(1)
+    assert recipe.name == 'Mac cheese'
+    assert recipe.version == 1
+    assert recipe.updated_at is not None
+    assert [result.recipe.id for result in rdb.search('pesto')] == [3]
+    assert conn.execute("SELECT refcount FROM asset WHERE filename='mac.jpg'").fetchone()[0] == 2
+    # ids of deleted recipes aren't reused
+    assert rdb.add_recipe(recipe) == 4
+
+
+def test_upgrade_unversioned_current(tmp_path):
+    """ A db created by the old init_db with today's schema is adopted as is """
+    rdb = RecipeDB(Path(tmp_path) / 'foo.db', init_db=True)
+    rdb.add_type('Pasta')
+    rdb.add_recipe(RecipeEntry(name='Soup', description='Hot', type_id=1))
+    rdb.conn.execute('PRAGMA user_version = 0')
+    migrate.upgrade(rdb.conn)
+    assert rdb.get_recipe(1).name == 'Soup'
+    assert rdb.get_book_version()[0] == 2
+
+
+def test_failed_migration_rolls_back(tmp_path):
+    migrations_dir = Path(tmp_path) / 'migrations'
+    migrations_dir.mkdir()
+    (migrations_dir / '0001_table.sql').write_text('CREATE TABLE a (id INTEGER);')
+    (migrations_dir / '0002_broken.sql').write_text(
+        'CREATE TABLE b (id INTEGER);\nINSERT INTO nonexistent VALUES (1);')
+    conn = connect(Path(tmp_path) / 'foo.db')
+    with pytest.raises(migrate.MigrationError):
+        migrate.upgrade(conn, migrate.find_migrations(migrations_dir))
+    assert migrate.schema_version(conn) == 1
+    tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+    assert tables == ['a']
+
+
+def test_missing_migration(tmp_path):
+    (Path(tmp_path) / '0001_a.sql').write_text('')
+    (Path(tmp_path) / '0003_c.sql').write_text('')
+    with pytest.raises(migrate.MigrationError):
+        migrate.find_migrations(tmp_path)
+
+
+def test_split_statements():
+    script = ('-- comment\nCREATE TABLE a (x);\n'
+              'CREATE TRIGGER t AFTER INSERT ON a BEGIN\n  DELETE FROM a;\nEND;\n-- done\n')
+    statements = list(migrate.split_statements(script))
+    assert len(statements) == 2
+    assert statements[1].endswith('END;')
+
+
+def test_db_upgrade_command(app):
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['db-upgrade'])
+    assert result.exit_code == 0
+    assert 'Applied' not in result.output
+    assert 'Database is at version {}.'.format(len(migrate.find_migrations())) in result.output
@@ -0,0 +1,110 @@
+#    Copyright 2021 Abigail Schubert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Unit tests for page_cache.py """
+from pathlib import Path
+import pytest
+from omnom.common import get_recipe_db
+from omnom.metrics import REGISTRY
+from omnom.page_cache import DiskPageCache, MemoryPageCache
+
+
+@pytest.fixture(params=['memory', 'disk'])
+def page_cache(request, tmp_path):
+    """ An empty page cache of each kind, holding up to 10 bytes """
+    if request.param == 'memory':
+        return MemoryPageCache(10)
+    return DiskPageCache(Path(tmp_path) / 'cache.sqlite', 10)
+
+
+def test_get_set(page_cache):
+    """ Cached pages are returned """
+    assert page_cache.get('a') is None
+    page_cache.set('a', b'1234', ['x'])
+    assert page_cache.get('a') == b'1234'
+    page_cache.set('a', b'5678', ['x'])
+    assert page_cache.get('a') == b'5678'
+
+
+def test_invalidate_tags(page_cache):
+    """ Invalidating a tag drops exactly the pages tagged with it """
+    page_cache.set('a', b'1', ['x'])
+    page_cache.set('b', b'2', ['x', 'y'])
+    page_cache.set('c', b'3', ['z'])
+    page_cache.invalidate_tags(['y'])
+    assert page_cache.get('a') == b'1'
+    assert page_cache.get('b') is None
+    page_cache.invalidate_tags(['x'])
+    assert page_cache.get('a') is None
+    assert page_cache.get('c') == b'3'
+
+
+def test_size_bound(page_cache):
+    """ The oldest pages are evicted to stay under max_bytes """
+    page_cache.set('a', b'1234', [])
+    page_cache.set('b', b'1234', [])
+    page_cache.set('c', b'1234', [])
+    page_cache.set('huge', b'12345678901', [])
+    assert page_cache.get('a') is None
+    assert page_cache.get('b') == b'1234'
+    assert page_cache.get('c') == b'1234'
+    assert page_cache.get('huge') is None
+
+
+def test_disk_cache_shared(tmp_path):
+    """ Disk caches opened on the same file share pages and invalidations """
+    first = DiskPageCache(Path(tmp_path) / 'cache.sqlite', 100)
+    second = DiskPageCache(Path(tmp_path) / 'cache.sqlite', 100)
+    first.set('a', b'1', ['x'])
+    assert second.get('a') == b'1'
+    second.invalidate_tags(['x'])
+    assert first.get('a') is None
+
+
+def _cache_results():
+    """ Page cache requests counted so far, by result """
+    return REGISTRY.collect()['omnom_page_cache_requests_total']
+
+
+def test_views_cached(client):
+    """ Recipe pages are served from the cache until the recipe changes """
+    before = _cache_results()
+    assert client.get('/recipes/2').headers['X-Cache'] == 'MISS'
+    assert client.get('/recipes/2').headers['X-Cache'] == 'HIT'
+    assert client.get('/').headers['X-Cache'] == 'MISS'
+    assert client.get('/').headers['X-Cache'] == 'HIT'
+    db = get_recipe_db()
+    recipe = db.get_recipe(2)
+    recipe.name = 'Fried Noodles'
+    db.update_recipe(recipe)
+    response = client.get('/recipes/2')
+    assert response.headers['X-Cache'] == 'MISS'
+    assert 'Fried Noodles' in str(response.data, encoding='utf-8')
+    assert client.get('/recipes/3').headers['X-Cache'] == 'MISS'
+    assert client.get('/').headers['X-Cache'] == 'MISS'
+    after = _cache_results()
+    assert after[('hit',)] - before.get(('hit',), 0) == 2
+    assert after[('miss',)] - before.get(('miss',), 0) == 5
+
+
+def test_invalidation_deferred_to_commit(client):
+    """ Changes made in a transaction invalidate pages when it commits """
+    client.get('/recipes/2')
+    db = get_recipe_db()
+    invalidated = []
+    db.on_change = invalidated.append
+    with db.transaction():
+        db.delete_recipe(2)
+        assert invalidated == []
+    assert invalidated == [('recipes', 'recipe:2')]
@@ -16,6 +16,7 @@
 from pathlib import Path
 import pytest
 from omnom.recipe_db import RecipeEntry, RecipeDB
+from omnom.render import render_version
 
 
 @pytest.fixture
@@ -169,3 +170,210 @@ def test_delete_missing_recipe(simple_db):
     """ rbd.delete_recipe for a nonexistent recipe is a noop """
     rdb = simple_db
     rdb.delete_recipe(5000)
+
+
+def test_add_recipe_renders_html(simple_db):
+    """ add_recipe stores rendered html alongside the markdown source """
+    recipe = simple_db.get_recipe(2)
+    assert '<li>Blueberries</li>' in recipe.ingredients_html
+    assert '<ol>' in recipe.instructions_html
+    assert recipe.render_version == render_version()
+
+
+def test_update_recipe_renders_html(simple_db):
+    """ update_recipe re-renders stored html """
+    recipe = simple_db.get_recipe(1)
+    recipe.ingredients = '* Macaroni\n* Cheese'
+    simple_db.update_recipe(recipe)
+    assert '<li>Cheese</li>' in simple_db.get_recipe(1).ingredients_html
+
+
+def test_render_stale_recipes(simple_db):
+    """ render_stale_recipes only re-renders rows with an outdated render_version """
+    simple_db.conn.execute("UPDATE recipe SET ingredients_html=NULL, render_version='0' WHERE id=2")
+    simple_db.conn.commit()
+    assert simple_db.render_stale_recipes() == [2]
+    assert '<li>Blueberries</li>' in simple_db.get_recipe(2).ingredients_html
+    assert simple_db.render_stale_recipes() == []
+    assert simple_db.render_stale_recipes(limit=2, force=True) == [1, 2]
+
+
+def test_get_recipes_page(simple_db):
+    """ get_recipes_page walks forwards and backwards through recipes by id """
+    rdb = simple_db
+    page = rdb.get_recipes_page(limit=3)
+    assert [recipe.id for recipe in page.recipes] == [1, 2, 3]
+    assert page.prev_cursor is None
+    assert page.next_cursor == 3
+    page = rdb.get_recipes_page(after_id=page.next_cursor, limit=3)
+    assert [recipe.id for recipe in page.recipes] == [4]
+    assert page.prev_cursor == 4
+    assert page.next_cursor is None
+    page = rdb.get_recipes_page(before_id=page.prev_cursor, limit=3)
+    assert [recipe.id for recipe in page.recipes] == [1, 2, 3]
+    assert page.prev_cursor is None
+    assert page.next_cursor == 3
+
+
+def test_get_recipes_page_desc(simple_db):
+    """ get_recipes_page supports newest-first ordering """
+    rdb = simple_db
+    page = rdb.get_recipes_page(limit=3, order='desc')
+    assert [recipe.id for recipe in page.recipes] == [4, 3, 2]
+    page = rdb.get_recipes_page(after_id=page.next_cursor, limit=3, order='desc')
+    assert [recipe.id for recipe in page.recipes] == [1]
+    page = rdb.get_recipes_page(before_id=page.prev_cursor, limit=3, order='desc')
+    assert [recipe.id for recipe in page.recipes] == [4, 3, 2]
+    with pytest.raises(ValueError):
+        rdb.get_recipes_page(order='sideways')
+
+
+def test_get_recipes_page_by_type(simple_db):
+    """ Pages can be limited to one food type, and carry food type names """
+    page = simple_db.get_recipes_page(limit=1, type_id=1)
+    assert [recipe.name for recipe in page.recipes] == ['Mac Cheese']
+    assert page.recipes[0].food_type == 'Pasta'
+    page = simple_db.get_recipes_page(after_id=page.next_cursor, limit=1, type_id=1)
+    assert [recipe.name for recipe in page.recipes] == ['Blueberry Muffins']
+    assert page.next_cursor is None
+    assert simple_db.get_recipes_page(type_id=4).recipes == []
+
+
+def test_get_categories(simple_db):
+    """ Food types with recipes are listed with counts, in one query """
+    statements = []
+    simple_db.conn.set_trace_callback(statements.append)
+    categories = simple_db.get_categories()
+    assert len(statements) == 1
+    assert [(cat.id, cat.name, cat.recipe_count) for cat in categories] == [
+        (2, 'Grains', 1), (1, 'Pasta', 2), (3, 'Salads', 1)]
+
+
+def test_get_categories_follows_changes(simple_db):
+    """ Category counts are kept up to date as recipes change, without
+    counting the recipe table
+    """
+    muffins = simple_db.get_recipe(2)
+    muffins.type_id = 3
+    simple_db.update_recipe(muffins)
+    simple_db.delete_recipe(4)
+    simple_db.add_recipe(RecipeEntry(name='Porridge', description='Oats', type_id=2))
+    statements = []
+    simple_db.conn.set_trace_callback(statements.append)
+    categories = simple_db.get_categories()
+    assert 'FROM recipe' not in statements[0]
+    assert [(cat.id, cat.name, cat.recipe_count) for cat in categories] == [
+        (2, 'Grains', 1), (1, 'Pasta', 1), (3, 'Salads', 2)]
+    simple_db.delete_recipe(1)
+    assert [cat.name for cat in simple_db.get_categories()] == ['Grains', 'Salads']
+
+
+def test_search(simple_db):
+    """ search finds recipes by any indexed column, best match first """
+    results = simple_db.search('muffin')
+    assert [result.recipe.name for result in results] == ['Blueberry Muffins']
+    assert '<mark>' in results[0].snippet
+    assert simple_db.search('kings')[0].recipe.name == 'Caesar Salad'
+    assert simple_db.search('rocks') == []
+    assert simple_db.search('   ') == []
+
+
+def test_search_escapes_query_and_snippet(simple_db):
+    """ search treats fts syntax in the query as text and escapes snippets """
+    simple_db.add_recipe(RecipeEntry(name='<b>Toast</b>', description='AND OR "NEAR"', type_id=4))
+    assert simple_db.search('"NEAR" OR')[0].recipe.name == '<b>Toast</b>'
+    assert '&lt;b&gt;<mark>Toast</mark>' in simple_db.search('toast')[0].snippet
+
+
+def test_search_tracks_changes(simple_db):
+    """ search index stays in sync with recipe updates and deletes """
+    recipe = simple_db.get_recipe(4)
+    recipe.name = 'Fried Noodles'
+    simple_db.update_recipe(recipe)
+    assert simple_db.search('rice') == []
+    assert simple_db.search('noodles')[0].recipe.id == 4
+    simple_db.delete_recipe(4)
+    assert simple_db.search('noodles') == []
+
+
+def test_rebuild_search_index(simple_db):
+    """ rebuild_search_index restores a missing index """
+    simple_db.conn.executescript('DROP TABLE recipe_fts;')
+    simple_db.rebuild_search_index()
+    assert simple_db.search('salad')[0].recipe.name == 'Caesar Salad'
+
+
+def test_add_types(empty_db):
+    """ add_types adds many food types and returns their ids """
+    ids = empty_db.add_types(['Pasta', 'Breakfast'])
+    assert empty_db.get_all_types() == {ids[0]: 'Pasta', ids[1]: 'Breakfast'}
+    assert empty_db.add_types([]) == []
+
+
+def test_add_recipes(no_recipe_db):
+    """ add_recipes adds many recipes from an iterator and returns their ids """
+    rdb = no_recipe_db
+    rdb.add_recipe(RecipeEntry(name='first', description='', type_id=1))
+    recipes = (RecipeEntry(name=str(i), description='', type_id=1, ingredients='* {}'.format(i))
+               for i in range(5))
+    ids = rdb.add_recipes(recipes)
+    assert len(ids) == 5
+    for i, recipe_id in enumerate(ids):
+        recipe = rdb.get_recipe(recipe_id)
+        assert recipe.name == str(i)
+        assert '<li>{}</li>'.format(i) in recipe.ingredients_html
+    assert rdb.search('3')[0].recipe.id == ids[3]
+
+
+def test_transaction_commits_at_end(simple_db, tmp_path):
+    """ Writes in a transaction block aren't visible elsewhere until it ends """
+    other_db = RecipeDB(Path(tmp_path) / 'foo.db')
+    with simple_db.transaction():
+        simple_db.add_type('Soup')
+        with simple_db.transaction():
+            simple_db.delete_recipe(1)
+        assert other_db.get_type_id('Soup') is None
+        assert other_db.get_recipe(1) is not None
+    assert other_db.get_type_id('Soup') is not None
+    assert other_db.get_recipe(1) is None
+
+
+def test_transaction_rolls_back_on_error(simple_db):
+    """ An exception in a transaction block discards all of its writes """
+    with pytest.raises(RuntimeError):
+        with simple_db.transaction():
+            simple_db.add_type('Soup')
+            simple_db.add_recipes([RecipeEntry(name='Stew', description='', type_id=1)])
+            raise RuntimeError()
+    assert simple_db.get_type_id('Soup') is None
+    assert len(simple_db.get_all_recipes()) == 4
+
+
+def test_food_types_cached(simple_db):
+    """ food type lookups don't re-read the food_type table when it hasn't changed """
+    simple_db.get_all_types()
+    statements = []
+    simple_db.conn.set_trace_callback(statements.append)
+    assert simple_db.get_type_id('Grains') == 2
+    assert simple_db.get_food_type('3') == 'Salads'
+    assert simple_db.get_food_type(None) == 'None'
+    assert not [sql for sql in statements if 'food_type' in sql]
+    simple_db.add_type('Soup')
+    assert 'Soup' in simple_db.get_all_types().values()
+
+
+def test_food_types_cache_sees_other_connections(simple_db, tmp_path):
+    """ food types added through another connection invalidate the cache """
+    assert simple_db.get_type_id('Soup') is None
+    RecipeDB(Path(tmp_path) / 'foo.db').add_type('Soup')
+    assert simple_db.get_type_id('Soup') == 5
+
+
+def test_food_types_cache_after_rollback(simple_db):
+    """ food types added in a rolled back transaction aren't cached """
+    with pytest.raises(RuntimeError):
+        with simple_db.transaction():
+            simple_db.add_type('Soup')
+            assert simple_db.get_type_id('Soup') == 5
+            raise RuntimeError()
+    assert simple_db.get_type_id('Soup') is None
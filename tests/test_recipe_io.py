@@ -0,0 +1,112 @@
+#    Copyright 2021 Abigail Schubert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Unit tests for recipe_io.py """
+import base64
+import hashlib
+import io
+import json
+from pathlib import Path
+import pytest
+from conftest import RESOURCES_DIR
+from omnom.common import get_recipe_db
+from omnom.images import fanout_path
+from omnom.recipe_db import RecipeDB, RecipeEntry
+from omnom.recipe_io import RecipeImportError, export_recipes, import_recipes
+
+
+@pytest.fixture
+def book_db(tmp_path):
+    """ A db with a few recipes, one with a photo """
+    rdb = RecipeDB(Path(tmp_path) / 'book.db', init_db=True)
+    rdb.add_types(['Pasta', 'Soup', 'Unused'])
+    rdb.add_recipe(RecipeEntry(name='Mac Cheese', description='A tasty dish', type_id=1,
+                               ingredients='* Macaroni\n* Cheese', photo='test.png'))
+    rdb.add_recipe(RecipeEntry(name='Stew', description='Warm', type_id=2,
+                               instructions='1. Simmer'))
+    return rdb
+
+
+def test_export_recipes(book_db):
+    """ export writes food types, then one recipe per line """
+    out = io.StringIO()
+    assert export_recipes(book_db, out) == 2
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [record['kind'] for record in records] == ['food_type'] * 3 + ['recipe'] * 2
+    assert records[3]['name'] == 'Mac Cheese'
+    assert records[3]['food_type'] == 'Pasta'
+    assert 'photo_data' not in records[3]
+
+
+def test_export_import_roundtrip(book_db, tmp_path):
+    """ recipes, food types and photos survive an export and import """
+    src_assets = Path(tmp_path) / 'src'
+    src_assets.mkdir()
+    (src_assets / 'test.png').write_bytes((RESOURCES_DIR / 'test.png').read_bytes())
+    out = io.StringIO()
+    export_recipes(book_db, out, assets_dir=src_assets)
+
+    dest_db = RecipeDB(Path(tmp_path) / 'dest.db', init_db=True)
+    dest_db.add_type('Soup')
+    dest_assets = Path(tmp_path) / 'dest'
+    dest_assets.mkdir()
+    lines = io.StringIO(out.getvalue())
+    assert import_recipes(dest_db, lines, assets_dir=dest_assets, batch_size=1) == 2
+
+    assert sorted(dest_db.get_all_types().values()) == ['Pasta', 'Soup', 'Unused']
+    recipes = list(dest_db.iter_recipes())
+    assert [recipe.name for recipe in recipes] == ['Mac Cheese', 'Stew']
+    assert dest_db.get_food_type(recipes[0].type_id) == 'Pasta'
+    assert dest_db.get_food_type(recipes[1].type_id) == 'Soup'
+    assert '<li>Cheese</li>' in dest_db.get_recipe(recipes[0].id).ingredients_html
+    # named after its content, like an upload
+    data = (RESOURCES_DIR / 'test.png').read_bytes()
+    assert recipes[0].photo == fanout_path('recipe_{}.png'.format(hashlib.sha256(data).hexdigest()))
+    assert (dest_assets / recipes[0].photo).read_bytes() == data
+    assert not list(dest_assets.glob('.tmp_*'))
+
+
+def test_import_bad_record(book_db):
+    """ import reports the line number of malformed records """
+    lines = ['{"kind": "food_type", "name": "Pie"}', '', '{"kind": "recipe"}']
+    with pytest.raises(RecipeImportError, match='line 3'):
+        import_recipes(book_db, lines)
+
+
+@pytest.mark.parametrize('photo, photo_data', [
+    ('a.png', 'not base64!'),
+    ('a.png', base64.b64encode(b'<html>').decode('ascii')),
+    ('a.exe', base64.b64encode((RESOURCES_DIR / 'test.png').read_bytes()).decode('ascii')),
+], ids=['base64', 'not-image', 'extension'])
+def test_import_bad_photo(book_db, tmp_path, photo, photo_data):
+    """ import reports the line number of bad photos, and doesn't store them """
+    lines = [json.dumps({'kind': 'recipe', 'name': 'Toast', 'photo': photo,
+                         'photo_data': photo_data})]
+    assets_dir = tmp_path / 'assets'
+    assets_dir.mkdir()
+    with pytest.raises(RecipeImportError, match='line 1'):
+        import_recipes(book_db, lines, assets_dir=assets_dir)
+    assert not list(assets_dir.iterdir())
+
+
+def test_export_import_commands(app, tmp_path):
+    """ flask export-recipes/import-recipes stream through files """
+    export_file = Path(tmp_path) / 'book.ndjson'
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['export-recipes', str(export_file)])
+    assert 'Exported 4 recipes' in result.output
+    result = runner.invoke(args=['import-recipes', str(export_file)])
+    assert 'Imported 4 recipes' in result.output
+    with app.app_context():
+        assert len(get_recipe_db().get_all_recipes()) == 8
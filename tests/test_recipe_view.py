@@ -12,7 +12,10 @@
 #
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import io
+from conftest import RESOURCES_DIR
 from omnom.common import get_recipe_db
+from omnom.render import render_version
 
 
 def test_index(client):
@@ -77,3 +80,167 @@ def test_edit_recipe_not_logged_in(client):
     """ Recipe editor redirects to login page if not logged in """
     response = client.get('/recipes/2/edit')
     assert response.headers['Location'] == 'http://localhost/auth/login'
+
+
+def test_full_recipe_missing(client):
+    """ Full recipe view returns 404 for unknown recipes """
+    assert client.get('/recipes/5000').status_code == 404
+
+
+def test_render_recipes_command(app):
+    """ render-recipes backfills html for rows created without it """
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['render-recipes', '--batch-size', '2'])
+    assert 'Rendered 4 recipes.' in result.output
+    with app.app_context():
+        recipe = get_recipe_db().get_recipe(1)
+    assert recipe.render_version == render_version()
+    assert recipe.ingredients_html == ''
+
+
+def test_index_pagination(app, client):
+    """ Index page links to the next/previous page of recipes """
+    app.config['RECIPES_PER_PAGE'] = 3
+    page = str(client.get('/').data, encoding='utf-8')
+    assert page.count('recipe-entry') == 3
+    assert '/?after=3' in page
+    assert 'Previous' not in page
+    page = str(client.get('/?after=3').data, encoding='utf-8')
+    assert page.count('recipe-entry') == 1
+    assert '/?before=4' in page
+    assert 'Next' not in page
+    assert client.get('/?order=sideways').status_code == 400
+
+
+def test_category(app, client):
+    """ Category pages list that food type's recipes, paginated as the index """
+    app.config['RECIPES_PER_PAGE'] = 1
+    page = str(client.get('/category/2').data, encoding='utf-8')
+    assert page.count('recipe-entry') == 1
+    assert 'Fried Rice' in page
+    assert '/category/2?after=2' in page
+    page = str(client.get('/category/2?after=2').data, encoding='utf-8')
+    assert 'Wild rice and greens' in page
+    assert '/category/2?before=3' in page
+    assert 'Next' not in page
+    assert client.get('/category/4').status_code == 200
+    assert client.get('/category/99').status_code == 404
+
+
+def test_category_sidebar(client):
+    """ Listing pages show each food type having recipes, with counts """
+    page = str(client.get('/').data, encoding='utf-8')
+    assert '<a href="/category/2">Grains</a>' in page
+    assert '<span class="recipe-count">2</span>' in page
+    # no recipes in it
+    assert 'Breakfast' not in page
+
+
+def test_search(client):
+    """ Search page lists matching recipes """
+    response = client.get('/search?q=rice')
+    assert response.status_code == 200
+    page = str(response.data, encoding='utf-8')
+    assert page.count('recipe-entry') == 2
+    assert 'Fried Rice' in page
+    page = str(client.get('/search?q=pizza').data, encoding='utf-8')
+    assert 'No recipes found' in page
+
+
+def test_create_recipe_with_photo(client, auth, app):
+    """ Uploading a photo with a new recipe stores it, and edits keep it """
+    auth.login('test', 'test')
+    form = {'name': 'Toast', 'description': 'Crunchy', 'food_type': '1',
+            'ingredients': '* Bread', 'instructions': '1. Toast it'}
+    with open(RESOURCES_DIR / 'test.png', 'rb') as photo:
+        response = client.post('/recipes/create', data=dict(form, recipe_img_file=(photo, 'a.png')),
+                               content_type='multipart/form-data')
+    recipe_id = int(response.headers['Location'].rsplit('/', 1)[1])
+    photo = get_recipe_db().get_recipe(recipe_id).photo
+    assert photo.endswith('.png')
+    assert (app.config['ASSETS_DIR'] / photo).is_file()
+    page = str(client.get('/recipes/{}'.format(recipe_id)).data, encoding='utf-8')
+    assert 'srcset=' in page
+
+    client.post('/recipes/{}/edit'.format(recipe_id), data=dict(form, name='Toast!'))
+    recipe = get_recipe_db().get_recipe(recipe_id)
+    assert recipe.name == 'Toast!'
+    assert recipe.photo == photo
+
+
+def test_create_recipe_invalid_photo(client, auth, app):
+    """ Uploads which aren't images are refused, and no recipe is created """
+    auth.login('test', 'test')
+    form = {'name': 'Toast', 'description': 'Crunchy', 'food_type': '1',
+            'ingredients': '* Bread', 'instructions': '1. Toast it',
+            'recipe_img_file': (io.BytesIO(b'#!/bin/sh\nrm -rf /\n'), 'a.png')}
+    response = client.post('/recipes/create', data=form, content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert b'Photo is not a valid png image.' in response.data
+    assert len(get_recipe_db().get_all_recipes()) == 4
+
+
+def test_create_recipe_too_large(client, auth, app):
+    """ Requests larger than MAX_CONTENT_LENGTH are refused """
+    auth.login('test', 'test')
+    app.config['MAX_CONTENT_LENGTH'] = 1024
+    form = {'name': 'Toast', 'description': 'Crunchy', 'food_type': '1',
+            'ingredients': '* Bread', 'instructions': '1. Toast it',
+            'recipe_img_file': (io.BytesIO(b'GIF89a' + b'\0' * 4096), 'a.gif')}
+    response = client.post('/recipes/create', data=form, content_type='multipart/form-data')
+    assert response.status_code == 413
+
+
+def test_full_recipe_not_modified(client, auth):
+    """ Full recipe view answers 304 to a current ETag, until the recipe changes """
+    response = client.get('/recipes/2')
+    etag = response.headers['ETag']
+    response = client.get('/recipes/2', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+    auth.login('test', 'test')
+    response = client.get('/recipes/2', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    user_etag = response.headers['ETag']
+    assert user_etag != etag
+    assert 'private' in response.headers['Cache-Control']
+
+    db = get_recipe_db()
+    recipe = db.get_recipe(2)
+    recipe.description = 'Yummier'
+    db.update_recipe(recipe)
+    response = client.get('/recipes/2', headers={'If-None-Match': user_etag})
+    assert response.status_code == 200
+    assert 'Yummier' in str(response.data, encoding='utf-8')
+
+
+def test_full_recipe_not_modified_since(client, monkeypatch):
+    """ If-Modified-Since can't miss a change of renderer, so isn't answered """
+    response = client.get('/recipes/2')
+    assert response.last_modified is None
+    monkeypatch.setattr('omnom.recipe_view.render_version', lambda: 'newer')
+    response = client.get('/recipes/2',
+                          headers={'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+    assert response.status_code == 200
+
+
+def test_render_stale_recipes_updates_timestamp(app):
+    """ Backfilled recipes get a new version and updated_at """
+    db = get_recipe_db()
+    db.conn.execute('UPDATE recipe SET updated_at = 0')
+    db.conn.commit()
+    db.render_stale_recipes(force=True)
+    version, updated_at = db.get_recipe_version(2)
+    assert version > 1
+    assert updated_at > 0
+
+
+def test_index_not_modified(client):
+    """ Index answers 304 to a current ETag, until any recipe changes """
+    etag = client.get('/').headers['ETag']
+    assert client.get('/', headers={'If-None-Match': etag}).status_code == 304
+    get_recipe_db().delete_recipe(4)
+    response = client.get('/', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
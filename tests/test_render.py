@@ -0,0 +1,91 @@
+#    Copyright 2021 Abigail Schubert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Tests for markdown rendering """
+import random
+import pytest
+from omnom.render import process_markdown, render_full, render_simple
+
+# Recipe text from the other tests and the sample book, plus awkward cases
+CORPUS = [
+    '* Blueberries\n* Muffin',
+    '1. Mix berries and muffin together\n1. Serve hot',
+    '* Blueberries\n* Muffins',
+    '1. Mix blueberries and muffins\n1. Serve hot',
+    '* Macaroni\n* Cheese',
+    '* Bread',
+    '1. Toast it',
+    'Preheat the oven.\nGrease a tin.\n1. Mix\n2. Bake\nServe warm',
+    '* 2 cups flour\n* 1/2 tsp salt\n\nSift together.',
+    '* a\r\n* b\r\n\r\nText\r\nMore',
+    'salt & pepper, 100% (approx) = 5+3; "hot" it\'s < 5 > 4!',
+    'Café ½ cup ²',
+    'a  b',
+    '\n\n* a\n\n\nb\n',
+    # outside the simple dialect
+    '* a\n\n* b',
+    '* a\n1. b',
+    '* 1. a',
+    '2 cups\n3 eggs',
+    'x *y* z',
+    'AT&amp;T',
+    'a<b>c</b>',
+    'trailing  \nbreak',
+    '    code',
+    '# Heading',
+    '- dash list',
+    'Title\n=====',
+    '<script>alert(1)</script>',
+    '[link](http://example.com)',
+]
+
+
+@pytest.mark.parametrize('text', CORPUS)
+def test_simple_matches_full(text):
+    """ The single pass renderer agrees with the full pipeline, or declines """
+    simple = render_simple(text)
+    assert simple is None or simple == render_full(text)
+    assert process_markdown(text) == render_full(text)
+
+
+def test_simple_handles_plain_recipes():
+    assert render_simple('* Blueberries\n* Muffin') == (
+        '<ul>\n<li>Blueberries</li>\n<li>Muffin</li>\n</ul>')
+    assert render_simple('Mix\n1. a & b\n2. c') == (
+        '<p>Mix</p>\n<ol>\n<li>a &amp; b</li>\n<li>c</li>\n</ol>')
+    assert render_simple('* a\n\n* b') is None
+    assert render_simple('x *y* z') is None
+
+
+def test_simple_matches_full_random():
+    """ Compare the renderers on random text of list items and paragraphs """
+    rnd = random.Random(1)
+    words = ['flour', 'Cup', '2', '250g', 'é', '½', 'Mix.', 'well,', '(ok)', '"hot"', "it's",
+             'AT&T', '&', '< 5', '>', '100%', 'Wow!', '1.5', '-', '&#39;', 'a<b', '*', '_']
+    markers = ['', '', '* ', '1. ', '12. ', ' ']
+    checked = 0
+    for _ in range(2000):
+        lines = []
+        for _ in range(rnd.randint(1, 8)):
+            if rnd.random() < 0.15:
+                lines.append('')
+            else:
+                lines.append(rnd.choice(markers) +
+                             ' '.join(rnd.choice(words) for _ in range(rnd.randint(1, 5))))
+        text = rnd.choice(['\n', '\r\n']).join(lines)
+        simple = render_simple(text)
+        if simple is not None:
+            assert simple == render_full(text), text
+            checked += 1
+    assert checked > 100
@@ -0,0 +1,93 @@
+#    Copyright 2021 Abigail Schubert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Tests for the slow query log """
+import pytest
+from omnom.app import create_app
+from omnom.common import get_recipe_db, get_user_db
+from omnom.slow_query_log import is_full_scan, redact_params
+
+
+@pytest.fixture
+def slow_app(app, tmp_path):
+    """ app logging every query """
+    return create_app({'TESTING': True,
+                       'DATABASE': app.config['DATABASE'],
+                       'SLOW_QUERY_THRESHOLD': 0,
+                       'SLOW_QUERY_LOG': tmp_path / 'slow.sqlite',
+                       }, instance_path=app.instance_path)
+
+
+def test_redact_params():
+    assert redact_params('SELECT * FROM user WHERE name=?', ('bob',)) == ('bob',)
+    assert redact_params('INSERT INTO user (name, password) VALUES (?, ?)',
+                         ('bob', 'hash')) == ('<redacted>', '<redacted>')
+    assert redact_params('SELECT ?', ('x' * 100,))[0] == 'x' * 80 + '...'
+
+
+def test_is_full_scan():
+    assert is_full_scan(['SCAN recipe'])
+    assert not is_full_scan(['SEARCH user USING INDEX sqlite_autoindex_user_1 (name=?)'])
+    assert not is_full_scan(['SCAN recipe USING COVERING INDEX recipe_type'])
+
+
+def test_slowlog_command(slow_app):
+    with slow_app.app_context():
+        get_recipe_db().get_all_recipes()
+        get_recipe_db().get_all_recipes()
+        udb = get_user_db()
+        udb.get_user_by_name('test')
+        udb.add_user('new', 'secret-hash')
+    runner = slow_app.test_cli_runner()
+    result = runner.invoke(args=['db-slowlog', '--reset'])
+    assert result.exit_code == 0
+    lines = result.output.splitlines()
+    # get_all_recipes reads the whole table
+    index = lines.index('    SELECT id, name, description, type_id, photo from recipe')
+    assert lines[index - 1].startswith('     2x')
+    assert lines[index - 1].endswith('FULL SCAN')
+    # finding a user by name uses the unique index on name
+    index = lines.index('    SELECT * from user WHERE name=?')
+    assert not lines[index - 1].endswith('FULL SCAN')
+    assert 'secret-hash' not in result.output
+    assert 'Cleared the slow query log.' in result.output
+
+    result = runner.invoke(args=['db-slowlog'])
+    assert 'No slow queries recorded.' in result.output
+
+
+def test_slowlog_disabled(app):
+    app = create_app({'TESTING': True, 'DATABASE': app.config['DATABASE'],
+                      'SLOW_QUERY_THRESHOLD': None}, instance_path=app.instance_path)
+    result = app.test_cli_runner().invoke(args=['db-slowlog'])
+    assert result.exit_code != 0
+    assert 'disabled' in result.output
+
+
+def test_slowlog_per_app(slow_app, tmp_path):
+    """ Each app records its own statements in its own log """
+    other_app = create_app({'TESTING': True, 'DATABASE': slow_app.config['DATABASE'],
+                            'SLOW_QUERY_THRESHOLD': 0,
+                            'SLOW_QUERY_LOG': tmp_path / 'other.sqlite',
+                            }, instance_path=slow_app.instance_path)
+    with other_app.app_context():
+        get_user_db().get_user_by_name('test')
+    with slow_app.app_context():
+        get_recipe_db().get_all_recipes()
+    result = slow_app.test_cli_runner().invoke(args=['db-slowlog'])
+    assert 'from recipe' in result.output
+    assert 'from user' not in result.output
+    result = other_app.test_cli_runner().invoke(args=['db-slowlog'])
+    assert 'from user' in result.output
+    assert 'from recipe' not in result.output
@@ -0,0 +1,109 @@
+#    Copyright 2021 Abigail Schubert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Tests for the static site export """
+import os
+import pytest
+from omnom.common import get_recipe_db
+from omnom.images import generate_variants
+
+
+def build(app, output_dir, *args):
+    result = app.test_cli_runner().invoke(args=['build-static', str(output_dir),
+                                                '--workers', '2'] + list(args))
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def test_build_static(app, tmp_path):
+    output = build(app, tmp_path)
+    assert 'Rendered 8 pages (0 unchanged, 0 removed)' in output
+    index = (tmp_path / 'index.html').read_text()
+    assert index.count('recipe-entry') == 4
+    assert 'Next' not in index
+    assert 'Fried Rice' in (tmp_path / 'recipes' / '2' / 'index.html').read_text()
+    assert (tmp_path / 'category' / '2' / 'index.html').read_text().count('recipe-entry') == 2
+    assert (tmp_path / 'static' / 'style.css').exists()
+    # assets are hard linked, not copied
+    asset = tmp_path / 'assets' / 'test.png'
+    assert os.path.samestat(asset.stat(), (app.config['ASSETS_DIR'] / 'test.png').stat())
+
+
+def test_build_static_incremental(app, tmp_path):
+    build(app, tmp_path)
+    assert 'Rendered 0 pages (8 unchanged, 0 removed), updated 0 files.' in build(app, tmp_path)
+
+    with app.app_context():
+        rdb = get_recipe_db()
+        recipe = rdb.get_recipe(4)
+        recipe.instructions = 'Toss'
+        rdb.update_recipe(recipe)
+    # just the recipe: listings don't show instructions
+    assert 'Rendered 1 pages (7 unchanged' in build(app, tmp_path)
+    assert 'Toss' in (tmp_path / 'recipes' / '4' / 'index.html').read_text()
+
+    with app.app_context():
+        get_recipe_db().delete_recipe(1)
+    # every listing's sidebar counts change, and Pasta is left empty so its page goes
+    assert 'Rendered 3 pages (3 unchanged, 2 removed)' in build(app, tmp_path)
+    assert not (tmp_path / 'recipes' / '1').exists()
+
+    assert 'Rendered 6 pages (0 unchanged' in build(app, tmp_path, '--full')
+
+
+def test_build_static_photo_variants(app, tmp_path):
+    """ Exported pages link variant files by path, the original until they exist """
+    pytest.importorskip('PIL')
+    with app.app_context():
+        rdb = get_recipe_db()
+        recipe = rdb.get_recipe(2)
+        recipe.photo = 'test.png'
+        rdb.update_recipe(recipe)
+    build(app, tmp_path)
+    page = (tmp_path / 'recipes' / '2' / 'index.html').read_text()
+    assert '?size=' not in page
+    assert 'src="/assets/test.png"' in page
+
+    written = generate_variants(app.config['ASSETS_DIR'], 'test.png')
+    try:
+        # the recipe page and the listings showing its thumbnail
+        assert 'Rendered 3 pages (5 unchanged' in build(app, tmp_path)
+        page = (tmp_path / 'recipes' / '2' / 'index.html').read_text()
+        assert 'src="/assets/test.medium.jpg"' in page
+        assert '/assets/test.full.jpg 1600w' in page
+        assert (tmp_path / 'assets' / 'test.medium.jpg').exists()
+        assert 'src="/assets/test.thumb.jpg"' in (tmp_path / 'index.html').read_text()
+    finally:
+        for variant in written:
+            (app.config['ASSETS_DIR'] / variant).unlink()
+
+
+def test_build_static_paginated(app, tmp_path):
+    """ Listings are exported a page at a time, linked by their files """
+    app.config['RECIPES_PER_PAGE'] = 2
+    assert 'Rendered 9 pages' in build(app, tmp_path)
+    first = (tmp_path / 'index.html').read_text()
+    second = (tmp_path / 'page' / '2' / 'index.html').read_text()
+    assert first.count('recipe-entry') == second.count('recipe-entry') == 2
+    assert 'href="/page/2">Next' in first
+    assert 'href="/">&laquo; Previous' in second
+    assert 'Next' not in second
+    assert '?' not in first + second
+    # the app's search and auth pages aren't exported
+    assert 'search-form' not in first
+    assert '/auth/login' not in first
+
+    app.config['RECIPES_PER_PAGE'] = 4
+    assert 'Rendered 1 pages (7 unchanged, 1 removed)' in build(app, tmp_path)
+    assert not (tmp_path / 'page' / '2' / 'index.html').exists()
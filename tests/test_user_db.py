@@ -0,0 +1,56 @@
+#    Copyright 2021 Abigail Schubert
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+""" Unit tests for the UserDB """
+from pathlib import Path
+import pytest
+from omnom.user_db import UserCache, UserDB
+
+
+@pytest.fixture
+def user_db(tmp_path):
+    """ A db with a single user """
+    udb = UserDB(Path(tmp_path) / 'foo.db', init_db=True)
+    udb.add_user('test', 'hash')
+    return udb
+
+
+def test_get_user_cached(user_db):
+    """ get_user only queries the db once per user """
+    assert user_db.get_user(1).name == 'test'
+    statements = []
+    user_db.conn.set_trace_callback(statements.append)
+    assert user_db.get_user(1).name == 'test'
+    assert statements == []
+
+
+def test_user_cache_reset_with_db(user_db):
+    """ resetting the db drops cached users """
+    user_db.get_user(1)
+    user_db.init_db()
+    assert user_db.get_user(1) is None
+    user_db.add_user('other', 'hash')
+    assert user_db.get_user(1).name == 'other'
+
+
+def test_user_cache_expiry():
+    """ UserCache entries expire after ttl and the oldest are evicted """
+    cache = UserCache(ttl=-1)
+    cache.put(1, 'user')
+    assert cache.get(1) is None
+    cache = UserCache(max_size=2)
+    for id_number in range(3):
+        cache.put(id_number, id_number)
+    assert cache.get(0) is None
+    assert cache.get(2) == 2